@@ -0,0 +1,238 @@
+"""
+Utilities for extracting source tables from the warehouse DB in ingest scripts.
+"""
+
+import os
+import time
+import logging
+import pandas as pd
+import pyarrow.parquet as pq
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import select, text
+
+# Default number of tables read from the warehouse at the same time
+DEFAULT_WORKERS = 4
+
+# Rows in the first chunk of a chunked read. Later chunks are sized using the memory used by the first.
+FIRST_CHUNK_ROWS = 10000
+
+# Environment variable with a directory of warehouse tables that were already extracted, as <table name>.parquet.
+# Set by the ingest orchestrator (../ingest_all.py), so tables used by more than one dashboard are read from the
+# warehouse once. Whole-table reads of a cached table (read_table(), table_reader(), read_chunked() and
+# iter_chunks() with a table name) use the cached copy instead of the DB.
+CACHE_DIR_ENV = "PRW_EXTRACT_CACHE"
+
+# Environment variable with the comma separated tables in CACHE_DIR_ENV that were extracted by the current run. Other
+# files in the directory, like those kept from an earlier run, are not used.
+CACHE_TABLES_ENV = "PRW_EXTRACT_TABLES"
+
+
+def table_reader(table_name: str, **kwargs):
+    """
+    Return a reader for read_tables() that reads a whole table. kwargs are passed to read_table().
+    """
+    return lambda conn: read_table(conn, table_name, **kwargs)
+
+
+def read_table(
+    conn, table_name: str, columns: list = None, index_col: str = None
+) -> pd.DataFrame:
+    """
+    Read a whole table, or only the given columns, from the extract cache if it has the table (see
+    CACHE_DIR_ENV), or otherwise from the DB
+    """
+    path = cached_table_path(table_name)
+    if path is None:
+        return pd.read_sql_table(table_name, conn, columns=columns, index_col=index_col)
+
+    if columns is not None and index_col is not None:
+        columns = [index_col] + columns
+    df = pd.read_parquet(path, columns=columns)
+    return df.set_index(index_col) if index_col else df
+
+
+def cached_table_path(table_name: str) -> str | None:
+    """
+    Return the path of the table in the extract cache, or None if the table was not extracted by the current run
+    """
+    cache_dir = os.environ.get(CACHE_DIR_ENV)
+    tables = os.environ.get(CACHE_TABLES_ENV, "").split(",")
+    if not cache_dir or table_name not in tables:
+        return None
+    path = os.path.join(cache_dir, f"{table_name}.parquet")
+    return path if os.path.exists(path) else None
+
+
+def extract_to_cache(engine, table_name: str, cache_dir: str) -> int:
+    """
+    Read a whole table from the DB and write it to cache_dir for later reads through CACHE_DIR_ENV.
+    The file is written under a temporary name first, so a partly written table is never read.
+    Returns the number of rows.
+    """
+    start = time.perf_counter()
+    with engine.connect() as conn:
+        df = pd.read_sql_table(table_name, conn)
+    path = os.path.join(cache_dir, f"{table_name}.parquet")
+    df.to_parquet(f"{path}.tmp", index=False)
+    os.replace(f"{path}.tmp", path)
+    logging.info(
+        f"Extracted {table_name}: {df.shape[0]:,} rows in {time.perf_counter() - start:.1f}s"
+    )
+    return df.shape[0]
+
+
+def read_tables(engine, readers: dict, workers: int = DEFAULT_WORKERS) -> dict:
+    """
+    Read independent tables concurrently on a thread pool.
+
+    readers maps a name to a function that takes a DB connection and returns a dataframe, for example
+    table_reader("prw_patients") or lambda conn: pd.read_sql_query(query, conn). Each read checks out its own
+    connection from the engine's pool, so at most workers connections are open at once. The time for each
+    table is logged, so the slowest table can be identified.
+
+    Returns a dict of name to dataframe, in the same order as readers. Raises the first error encountered.
+    """
+    workers = max(1, min(workers, len(readers)))
+
+    def read(name, reader):
+        start = time.perf_counter()
+        with engine.connect() as conn:
+            df = reader(conn)
+        logging.info(
+            f"Read {name}: {df.shape[0]:,} rows in {time.perf_counter() - start:.1f}s"
+        )
+        return df
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            name: executor.submit(read, name, reader)
+            for name, reader in readers.items()
+        }
+        ret = {name: future.result() for name, future in futures.items()}
+
+    logging.info(
+        f"Read {len(ret)} tables in {time.perf_counter() - start:.1f}s using {workers} workers"
+    )
+    return ret
+
+
+def chunked_reader(query, max_memory_mb: float, transform=None, index_col=None):
+    """
+    Return a reader for read_tables() that reads in chunks. See read_chunked().
+    """
+    return lambda conn: read_chunked(conn, query, max_memory_mb, transform, index_col)
+
+
+def read_chunked(
+    conn, query, max_memory_mb: float, transform=None, index_col=None
+) -> pd.DataFrame:
+    """
+    Read a table or query in chunks that each use about max_memory_mb of memory, apply transform to each chunk,
+    and return the concatenated results. query is a table name or SQLAlchemy query.
+
+    transform must work on each row independently, like filtering rows or deriving columns from the same row,
+    so that the result is the same as transforming the whole table at once. Peak memory is then bounded by the
+    chunk size plus the transformed rows, instead of the whole table.
+    """
+    transform = transform or (lambda df: df)
+    chunks = [
+        transform(df) for df in iter_chunks(conn, query, max_memory_mb, index_col)
+    ]
+    df = pd.concat(chunks)
+
+    # A column's type can be inferred differently in different chunks, for example object in a chunk where every
+    # value is None. Infer those columns again using all of the values, as reading all at once would.
+    for col in df.columns:
+        if len({chunk[col].dtype for chunk in chunks}) > 1:
+            df[col] = df[col].infer_objects()
+    return df
+
+
+def iter_chunks(conn, query, max_memory_mb: float, index_col=None):
+    """
+    Yield dataframes with the results of a table or query, in chunks that each use about max_memory_mb of memory.
+    Results are streamed from the DB, so only one chunk is held in memory at a time. Yields at least one, possibly
+    empty, dataframe.
+    """
+    if isinstance(query, str) and cached_table_path(query):
+        yield from _iter_cached_chunks(
+            cached_table_path(query), max_memory_mb, index_col
+        )
+        return
+    if isinstance(query, str):
+        query = select(text("*")).select_from(text(query))
+
+    result = conn.execution_options(stream_results=True).execute(query)
+    columns = list(result.keys())
+    fetch = lambda n_rows: pd.DataFrame.from_records(
+        result.fetchmany(n_rows), columns=columns, coerce_float=True
+    )
+    yield from _sized_chunks(fetch, max_memory_mb, index_col)
+
+
+def _iter_cached_chunks(path: str, max_memory_mb: float, index_col=None):
+    """iter_chunks() for a table in the extract cache"""
+    batches = pq.ParquetFile(path).iter_batches(batch_size=FIRST_CHUNK_ROWS)
+    pending = pd.DataFrame()
+
+    def fetch(n_rows):
+        # Batches are a fixed size, so combine or split them into chunks of n_rows
+        nonlocal pending
+        while len(pending) < n_rows:
+            batch = next(batches, None)
+            if batch is None:
+                break
+            pending = pd.concat([pending, batch.to_pandas()], ignore_index=True)
+        df, pending = pending.iloc[:n_rows], pending.iloc[n_rows:]
+        return df.reset_index(drop=True)
+
+    yield from _sized_chunks(fetch, max_memory_mb, index_col)
+
+
+def _sized_chunks(fetch, max_memory_mb: float, index_col=None):
+    """
+    Yield the dataframes returned by fetch(n_rows) until one is empty, with n_rows set so that each uses
+    about max_memory_mb of memory. Yields at least one, possibly empty, dataframe.
+    """
+    n_rows = FIRST_CHUNK_ROWS
+    offset = 0
+    while True:
+        df = fetch(n_rows)
+        if df.empty and offset > 0:
+            break
+
+        # Without an index column, number rows across chunks, as reading all at once would
+        if index_col:
+            df = df.set_index(index_col)
+        else:
+            df.index = pd.RangeIndex(offset, offset + len(df))
+        yield df
+
+        # Size the remaining chunks using the memory used per row in the first chunk
+        if offset == 0 and len(df) > 0:
+            row_bytes = df.memory_usage(deep=True).sum() / len(df)
+            n_rows = max(1, int(max_memory_mb * 2**20 / row_bytes))
+        offset += len(df)
+        if offset == 0:
+            break
+
+
+def stream_to_table(
+    conn, query, out_conn, table, max_memory_mb: float, transform=None
+) -> int:
+    """
+    Copy the results of a table or query to a datamart table, one chunk at a time (see iter_chunks()), applying
+    transform to each chunk. Only columns defined in the datamart table (a SQLModel class) are written, except for
+    the primary key, which is assigned by the datamart. Rows are appended, so clear the table first if needed.
+    Returns the number of rows written.
+    """
+    transform = transform or (lambda df: df)
+    columns = table.__table__.columns
+    n_rows = 0
+    for df in iter_chunks(conn, query, max_memory_mb):
+        df = transform(df)
+        df = df[[c for c in df.columns if c in columns and not columns[c].primary_key]]
+        df.to_sql(table.__tablename__, out_conn, if_exists="append", index=False)
+        n_rows += len(df)
+    return n_rows
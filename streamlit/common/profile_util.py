@@ -0,0 +1,168 @@
+"""
+Stage profiling for ingest scripts. Records the wall time, CPU time and peak memory of each stage of an ingest,
+the rows in each datamart table, and the sizes of the output files. Writes them to a JSON run report and a
+summary to the datamart meta table, so that changes in ingest duration can be tracked between runs.
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import resource
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from sqlalchemy import text
+
+# Seconds between samples of memory use while a stage runs
+RSS_SAMPLE_SECS = 0.05
+
+# Column added to the datamart meta table with the run summary, as JSON
+META_COLUMN = "ingest_profile"
+
+
+class StageProfiler:
+    """
+    Profile of one ingest run. Wrap each stage in stage(), for example:
+
+        profiler = StageProfiler("panel")
+        with profiler.stage("extract"):
+            src = read_source_tables(prw_engine)
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = datetime.now()
+        self.stages = {}
+        self.tables = {}
+        self.files = {}
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.process_time()
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Record the wall time, CPU time (of all threads in this process) and peak resident memory of the
+        enclosed code as the stage name
+        """
+        sampler = _RssSampler()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.stages[name] = {
+                "wall_secs": round(time.perf_counter() - wall_start, 3),
+                "cpu_secs": round(time.process_time() - cpu_start, 3),
+                "peak_rss_mb": round(sampler.stop(), 1),
+            }
+
+    def count_rows(self, engine):
+        """Record the number of rows in each table of a SQLite datamart"""
+        with engine.connect() as conn:
+            tables = conn.execute(
+                text(
+                    "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+                )
+            ).fetchall()
+            for (table,) in tables:
+                self.tables[table] = conn.execute(
+                    text(f'SELECT COUNT(*) FROM "{table}"')
+                ).scalar()
+
+    def add_files(self, *paths):
+        """Record the sizes of output files that exist"""
+        for path in paths:
+            if path and os.path.exists(path):
+                self.files[os.path.basename(path)] = os.path.getsize(path)
+
+    def report(self) -> dict:
+        return {
+            "ingest": self.name,
+            "started": self.started.isoformat(timespec="seconds"),
+            "wall_secs": round(time.perf_counter() - self._wall_start, 3),
+            "cpu_secs": round(time.process_time() - self._cpu_start, 3),
+            "peak_rss_mb": round(max_rss_mb(), 1),
+            "stages": self.stages,
+            "tables": self.tables,
+            "files": self.files,
+        }
+
+    def write_meta(self, engine):
+        """
+        Store the report so far in the latest row of the datamart meta table, in META_COLUMN. Call after
+        db_utils.write_meta() and before the datamart is encrypted, so later stages are not included. The
+        column is added if the meta table does not have it yet, like a datamart kept between runs.
+        """
+        with engine.begin() as conn:
+            columns = [row[1] for row in conn.execute(text("PRAGMA table_info(meta)"))]
+            if META_COLUMN not in columns:
+                conn.execute(text(f"ALTER TABLE meta ADD COLUMN {META_COLUMN} TEXT"))
+            conn.execute(
+                text(
+                    f"UPDATE meta SET {META_COLUMN} = :profile WHERE id = (SELECT MAX(id) FROM meta)"
+                ),
+                {"profile": json.dumps(self.report())},
+            )
+
+    def write_report(self, path: str = None):
+        """Log a summary of the run, and write the full report as JSON to path if given"""
+        report = self.report()
+        lines = [f"Ingest profile ({report['wall_secs']:.1f}s total):"]
+        for name, s in report["stages"].items():
+            lines.append(
+                f"  {name}: {s['wall_secs']:.1f}s wall, {s['cpu_secs']:.1f}s CPU, {s['peak_rss_mb']:,.0f} MB peak"
+            )
+        for table, n_rows in report["tables"].items():
+            lines.append(f"  table {table}: {n_rows:,} rows")
+        for file, size in report["files"].items():
+            lines.append(f"  file {file}: {size:,} bytes")
+        logging.info("\n".join(lines))
+
+        if path:
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2)
+            logging.info(f"Wrote run report to {path}")
+
+
+def current_rss_mb() -> float | None:
+    """Return the resident memory of this process in MB, or None if it is not available (no /proc)"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except OSError:
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def max_rss_mb() -> float:
+    """Return the peak resident memory of this process so far in MB"""
+    # ru_maxrss is in bytes on macOS and KB elsewhere
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 2**20 if sys.platform == "darwin" else max_rss / 2**10
+
+
+class _RssSampler:
+    """
+    Samples memory use on a background thread from creation until stop(). Where the current memory use is not
+    available, the peak of the whole process so far is used instead.
+    """
+
+    def __init__(self):
+        self._peak = current_rss_mb()
+        self._stop = threading.Event()
+        self._thread = None
+        if self._peak is not None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(RSS_SAMPLE_SECS):
+            self._peak = max(self._peak, current_rss_mb())
+
+    def stop(self) -> float:
+        if self._thread is None:
+            return max_rss_mb()
+        self._stop.set()
+        self._thread.join()
+        return max(self._peak, current_rss_mb())
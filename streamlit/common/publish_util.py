@@ -0,0 +1,312 @@
+"""
+Utilities for publishing ingest output files: encrypting them and uploading them to S3-compatible storage.
+
+Files are encrypted in chunks, each a separate Fernet token on its own line, so the encrypted bytes can be
+uploaded with an S3 multipart upload while the rest of the file is still being encrypted, instead of after.
+decrypt() reads both this format and the single token written by prw_common.encrypt.encrypt_file().
+
+To avoid publishing a datamart that has not changed, content_hash() hashes its logical content, and a manifest
+with the hash is written next to each published file (write_manifest()) for comparison on the next run.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+import itertools
+import boto3
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from botocore.exceptions import ClientError
+from cryptography.fernet import Fernet
+from prw_common import encrypt
+
+# Plaintext bytes encrypted into each Fernet token
+CHUNK_BYTES = 4 * 2**20
+
+# Encrypted bytes in each part of a multipart upload. S3 requires at least 5 MiB for every part but the last.
+PART_BYTES = 16 * 2**20
+
+# Parts of each file uploaded at the same time. Up to this many parts are held in memory while uploading.
+UPLOAD_WORKERS = 4
+
+# Files published at the same time by publish()
+PUBLISH_WORKERS = 8
+
+# Tables that change on every ingest even if the data did not, like the ingest time, so are not hashed
+UNHASHED_TABLES = ["meta"]
+
+# Rows read at a time when hashing a table
+HASH_BATCH_ROWS = 10000
+
+
+def encrypt_chunks(path: str, key: str, chunk_bytes: int = CHUNK_BYTES):
+    """
+    Yield the encrypted contents of a file, one line per chunk_bytes of plaintext. Yields at least one line,
+    so an empty file still decrypts to an empty file.
+    """
+    fernet = Fernet(key)
+    with open(path, "rb") as f:
+        chunk = f.read(chunk_bytes)
+        yield fernet.encrypt(chunk) + b"\n"
+        while chunk := f.read(chunk_bytes):
+            yield fernet.encrypt(chunk) + b"\n"
+
+
+def decrypt(data: bytes, key: str) -> bytes:
+    """Decrypt a file written by encrypt_chunks() or by prw_common.encrypt.encrypt_file()"""
+    tokens = data.split()
+    if len(tokens) <= 1:
+        return encrypt.decrypt(data, key)
+    fernet = Fernet(key)
+    return b"".join(fernet.decrypt(token) for token in tokens)
+
+
+def s3_client(s3_url: str, s3_auth: str):
+    """
+    Return a boto3 S3 client and bucket name for the ingest --s3url and --s3auth arguments. s3_url is the
+    bucket URL, <endpoint URL>/<bucket>, and s3_auth is <access key id>:<secret access key>. The endpoint
+    can be a local S3 stand-in, like http://localhost:9000/<bucket> for MinIO or moto_server.
+    """
+    url = urlparse(s3_url)
+    key_id, _, secret = s3_auth.partition(":")
+    client = boto3.client(
+        "s3",
+        endpoint_url=f"{url.scheme}://{url.netloc}",
+        region_name="auto",
+        aws_access_key_id=key_id,
+        aws_secret_access_key=secret,
+    )
+    return client, url.path.strip("/")
+
+
+def publish(files: list, key: str, s3_url: str = None, s3_auth: str = None) -> list:
+    """
+    Encrypt each (src, out) path pair in files to out and, if s3_url and s3_auth are given, upload each one
+    to S3 while it is encrypted (see encrypt_and_upload()). Objects are named after the file name of out.
+    Up to PUBLISH_WORKERS files are published in parallel. Returns the paths of the encrypted files.
+    """
+    client, bucket = s3_client(s3_url, s3_auth) if s3_url and s3_auth else (None, None)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=min(len(files), PUBLISH_WORKERS)) as executor:
+        futures = [
+            executor.submit(encrypt_and_upload, src, out, key, client, bucket)
+            for src, out in files
+        ]
+        ret = [future.result() for future in futures]
+
+    logging.info(
+        f"Published {len(files)} files in {time.perf_counter() - start:.1f}s"
+        + (f" to {s3_url}" if client else "")
+    )
+    return ret
+
+
+def encrypt_and_upload(
+    src: str,
+    out: str,
+    key: str,
+    client=None,
+    bucket: str = None,
+    part_bytes: int = PART_BYTES,
+    workers: int = UPLOAD_WORKERS,
+) -> str:
+    """
+    Encrypt src to out in chunks (see encrypt_chunks()). If client is given, each part_bytes of encrypted data is
+    also uploaded to bucket as soon as it is ready, as a part of a multipart upload of an object named after out,
+    with up to workers parts uploading at once. Returns out.
+    """
+    start = time.perf_counter()
+    parts = _parts(encrypt_chunks(src, key), part_bytes)
+    with open(out, "wb") as f:
+        if client is None:
+            for part in parts:
+                f.write(part)
+        else:
+            parts = _written(parts, f)
+            multipart_upload(client, bucket, os.path.basename(out), parts, workers)
+
+    logging.info(
+        f"Encrypted {os.path.basename(out)}: {os.path.getsize(out):,} bytes in {time.perf_counter() - start:.1f}s"
+        + (" and uploaded" if client else "")
+    )
+    return out
+
+
+def multipart_upload(client, bucket: str, obj: str, parts, workers: int):
+    """
+    Upload an object from an iterable of parts, with up to workers parts uploading at once. The next part is
+    not read until an upload slot is free, so at most workers + 1 parts are held in memory. Objects with only
+    one part are uploaded with a single PUT. The upload is aborted on error.
+    """
+    parts = iter(parts)
+    first, second = next(parts, b""), next(parts, None)
+    if second is None:
+        client.put_object(Bucket=bucket, Key=obj, Body=first)
+        return
+
+    upload_id = client.create_multipart_upload(Bucket=bucket, Key=obj)["UploadId"]
+    slots = threading.Semaphore(workers)
+
+    def upload_part(number, body):
+        try:
+            response = client.upload_part(
+                Bucket=bucket, Key=obj, UploadId=upload_id, PartNumber=number, Body=body
+            )
+            return {"PartNumber": number, "ETag": response["ETag"]}
+        finally:
+            slots.release()
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            for number, body in enumerate(itertools.chain([first, second], parts), 1):
+                slots.acquire()
+                if any(f.done() and f.exception() for f in futures):
+                    break
+                futures.append(executor.submit(upload_part, number, body))
+            uploaded = [future.result() for future in futures]
+
+        client.complete_multipart_upload(
+            Bucket=bucket,
+            Key=obj,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": uploaded},
+        )
+    except Exception:
+        client.abort_multipart_upload(Bucket=bucket, Key=obj, UploadId=upload_id)
+        raise
+
+
+def _parts(chunks, part_bytes: int):
+    """Combine chunks of bytes into parts of at least part_bytes, except for the last"""
+    buf = []
+    size = 0
+    for chunk in chunks:
+        buf.append(chunk)
+        size += len(chunk)
+        if size >= part_bytes:
+            yield b"".join(buf)
+            buf, size = [], 0
+    if buf:
+        yield b"".join(buf)
+
+
+def _written(parts, f):
+    """Yield each of parts after writing it to f"""
+    for part in parts:
+        f.write(part)
+        yield part
+
+
+# -------------------------------------------------------
+# Skip unchanged
+# -------------------------------------------------------
+def content_hash(
+    db_file: str, kv_files: list = (), exclude_tables: list = UNHASHED_TABLES
+) -> str:
+    """
+    Return a SHA-256 hex digest of the logical content of a SQLite datamart and its key/value JSON files: the
+    schema and rows of each table except exclude_tables, and the JSON data. Integer primary keys are left out
+    and JSON is hashed with sorted keys, so the hash does not change with the row IDs assigned on insert or
+    the layout of the file. Each table's rows are combined by adding their hashes, so it also does not change
+    with the order the warehouse returns rows in, without sorting the table.
+    """
+    h = hashlib.sha256()
+    conn = sqlite3.connect(f"file:{db_file}?mode=ro", uri=True)
+    try:
+        tables = conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+        ).fetchall()
+        for (table,) in tables:
+            if table in exclude_tables:
+                continue
+            columns = [
+                (name, col_type)
+                for _, name, col_type, _, _, pk in conn.execute(
+                    f'PRAGMA table_info("{table}")'
+                )
+                if not (pk and col_type.upper() == "INTEGER")
+            ]
+            names = ", ".join(f'"{name}"' for name, _ in columns)
+            cursor = conn.execute(f'SELECT {names} FROM "{table}"')
+            n_rows, rows_sum = 0, 0
+            while rows := cursor.fetchmany(HASH_BATCH_ROWS):
+                n_rows += len(rows)
+                rows_sum += sum(_row_hash(row) for row in rows)
+            h.update(repr((table, columns, n_rows, rows_sum % 2**128)).encode())
+    finally:
+        conn.close()
+
+    for path in kv_files:
+        with open(path) as f:
+            h.update(json.dumps(json.load(f), sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def _row_hash(row: tuple) -> int:
+    return int.from_bytes(
+        hashlib.blake2b(repr(row).encode(), digest_size=16).digest(), "little"
+    )
+
+
+def is_published(
+    content_hash: str, out: str, s3_url: str = None, s3_auth: str = None
+) -> bool:
+    """
+    Return whether the last published version of the output file out has the given content hash, according to
+    its manifest (see write_manifest()). The manifest is read from S3 if s3_url and s3_auth are given, and
+    otherwise from next to out, in which case out must also still exist.
+    """
+    manifest = read_manifest(out, s3_url, s3_auth)
+    if manifest is None or manifest.get("content_hash") != content_hash:
+        return False
+    return bool(s3_url and s3_auth) or os.path.exists(out)
+
+
+def read_manifest(out: str, s3_url: str = None, s3_auth: str = None) -> dict | None:
+    """Return the manifest for the output file out (see is_published()), or None if there is none"""
+    if s3_url and s3_auth:
+        client, bucket = s3_client(s3_url, s3_auth)
+        try:
+            response = client.get_object(Bucket=bucket, Key=_manifest_name(out))
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None
+            raise
+        return json.loads(response["Body"].read())
+
+    path = os.path.join(os.path.dirname(out), _manifest_name(out))
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(
+    content_hash: str, out: str, s3_url: str = None, s3_auth: str = None
+) -> str:
+    """
+    Write the manifest for a newly published output file out, next to out as <out>.manifest.json, and upload it
+    to S3 if s3_url and s3_auth are given. Write it only after out is published. Returns the local path.
+    """
+    manifest = {
+        "file": os.path.basename(out),
+        "content_hash": content_hash,
+        "published": datetime.now().isoformat(timespec="seconds"),
+    }
+    path = os.path.join(os.path.dirname(out), _manifest_name(out))
+    with open(path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    if s3_url and s3_auth:
+        client, bucket = s3_client(s3_url, s3_auth)
+        client.upload_file(path, bucket, _manifest_name(out))
+    return path
+
+
+def _manifest_name(out: str) -> str:
+    return f"{os.path.basename(out)}.manifest.json"
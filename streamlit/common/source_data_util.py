@@ -12,7 +12,7 @@ from sqlalchemy import create_engine
 
 # Import common modules from repo root
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
-from prw_common import encrypt
+from . import publish_util
 
 
 # Temporary storage when loading DB from memory
@@ -54,10 +54,11 @@ def fetch_from_s3(
         response = s3_client.get_object(Bucket=bucket, Key=obj)
         remote_bytes = response["Body"].read()
 
-        # Decrypt the database file using provided Fernet key
+        # Decrypt the database file using provided Fernet key. Files published by the ingest with
+        # --pipelined-publish are encrypted in chunks, which publish_util.decrypt() also handles.
         logging.info("Decrypting")
         decrypted_bytes = (
-            encrypt.decrypt(remote_bytes, data_key)
+            publish_util.decrypt(remote_bytes, data_key)
             if data_key is not None
             else remote_bytes
         )
@@ -90,6 +91,21 @@ def sqlite_engine_from_s3(
     return create_engine(f"sqlite://", creator=lambda: conn)
 
 
+def sqlite_file_from_s3(
+    s3_config: S3Config, bucket: str, obj: str, data_key: str = None
+) -> str:
+    """
+    Fetches the SQLite database file from a remote S3-compatible storage, decrypts it,
+    and writes it to a temporary file for querying with sqlite_pool_engine_from_file().
+    Returns the file path. The file is not removed by cleanup(), since it stays in use
+    after loading, so the caller removes it.
+    """
+    data = fetch_from_s3(s3_config, bucket, obj, data_key)
+    file = f"db_{datetime.now().strftime('%Y%m%d%H%M%S%f')}.sqlite3"
+    open(file, "wb").write(data)
+    return file
+
+
 def json_from_s3(
     s3_config: S3Config, bucket: str, obj: str, data_key: str = None
 ) -> dict:
@@ -121,6 +137,14 @@ def sqlite_engine_from_file(file):
     return create_engine(f"sqlite://", creator=lambda: conn)
 
 
+def sqlite_pool_engine_from_file(file):
+    """
+    Opens the specified SQLite database file read-only and returns a SQLAlchemy engine with a pool
+    of connections that can be used from any thread, for querying the file while the app runs.
+    """
+    return create_engine(f"sqlite:///file:{file}?mode=ro&uri=true")
+
+
 def json_from_file(file):
     """
     Reads the specified JSON file and returns a dictionary.
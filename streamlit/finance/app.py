@@ -7,7 +7,7 @@ import streamlit as st
 from streamlit_extras.floating_button import floating_button
 from src import route
 from src.model import source_data
-from src.dept import base
+from src.dept import base, consolidated
 from common import auth, st_util
 
 
@@ -31,6 +31,8 @@ def run():
     # Render page based on the route
     if src_data is None:
         st_util.st_center_text("No data available. Please contact administrator.")
+    elif route_id == route.ALL_DEPTS:
+        return consolidated.consolidated_page(src_data)
     elif route_id in route.DEPTS:
         return base.dept_page(src_data, route_id)
     else:
@@ -46,8 +48,9 @@ def show_index():
         st.logout()
         st.rerun()
 
-    # Create a dictionary mapping department names to their route IDs
-    dept_options = {base.configs.DEPT_CONFIG[r].name: r for r in route.DEPTS}
+    # Department names mapped to their route IDs, sorted by name
+    dept_options = base.configs.DEPT_OPTIONS
+    all_depts_name = "All Departments"
 
     # Create a centered container for the UI elements
     col1, col2, col3 = st.columns([1, 2, 1])
@@ -58,12 +61,12 @@ def show_index():
         # Create a combo box with all department options
         selected_dept_name = st.selectbox(
             "Select Dashboard",
-            options=sorted(dept_options.keys()),
+            options=[all_depts_name] + list(dept_options.keys()),
             label_visibility="collapsed",
         )
 
         # Get the route ID for the selected department
-        selected_dept_id = dept_options[selected_dept_name]
+        selected_dept_id = dept_options.get(selected_dept_name, route.ALL_DEPTS)
 
         # Create a Go to Dashboard button
         if st.button("Go to Dashboard", use_container_width=True, type="primary"):
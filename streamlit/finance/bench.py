@@ -0,0 +1,378 @@
+"""
+Benchmarks for the finance data layer, using synthetic source data for all departments in DEPT_CONFIG.
+
+Usage, from this directory:
+    python bench.py consolidated [--years 5]
+    python bench.py hours [--years 5]
+    python bench.py load [--years 5]
+    python bench.py query [--years 5]
+"""
+
+# Add main repo directory to include path to access common/ modules
+import sys, os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import argparse
+import gc
+import logging
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from src import route
+from src.model import source_data, income_statement_def
+from src.dept.base import configs
+from src.dept.base.hours_rollup import HOURS_COLUMNS
+
+BUDGET_COLUMNS = [
+    "budget_fte",
+    "budget_prod_hrs",
+    "budget_volume",
+    "budget_uos",
+    "budget_prod_hrs_per_uos",
+    "hourly_rate",
+]
+
+
+# -------------------------------------------------------
+# Synthetic data
+# -------------------------------------------------------
+def synthetic_source_data(
+    years: int = 5, accounts_per_dept: int = 30, seed: int = 0
+) -> source_data.SourceData:
+    """
+    Generate source data with the same schema as the datamart for every cost center in DEPT_CONFIG,
+    with monthly rows for the given number of years ending last year.
+    """
+    rng = np.random.default_rng(seed)
+    wd_ids = sorted(set(configs.all_wd_ids(list(configs.DEPT_CONFIG.values()))))
+    last_year = datetime.now().year - 1
+    months = [
+        f"{year:04d}-{month:02d}"
+        for year in range(last_year - years + 1, last_year + 1)
+        for month in range(1, 13)
+    ]
+
+    # One row per cost center per month
+    dept_month = pd.DataFrame(
+        [(wd_id, month) for wd_id in wd_ids for month in months],
+        columns=["dept_wd_id", "month"],
+    )
+    dept_month["dept_name"] = dept_month["dept_wd_id"]
+    n = dept_month.shape[0]
+
+    volumes_df = dept_month.assign(
+        volume=rng.integers(0, 1000, n), unit="Visits"
+    ).reset_index(names="id")
+    uos_df = dept_month.assign(
+        volume=rng.random(n) * 1000, unit="Procedures"
+    ).reset_index(names="id")
+    hours_df = dept_month.assign(
+        **{col: rng.random(n) * 2000 for col in HOURS_COLUMNS}
+    ).reset_index(names="id")
+
+    budget_df = pd.DataFrame({"dept_wd_id": wd_ids, "dept_name": wd_ids})
+    for col in BUDGET_COLUMNS:
+        budget_df[col] = rng.random(len(wd_ids)) * 1000
+    budget_df = budget_df.reset_index(names="id")
+
+    contracted_hours_df = pd.DataFrame(
+        [(wd_id, year) for wd_id in wd_ids for year in (last_year - 1, last_year)],
+        columns=["dept_wd_id", "year"],
+    )
+    contracted_hours_df["dept_name"] = contracted_hours_df["dept_wd_id"]
+    contracted_hours_df["hrs"] = rng.random(contracted_hours_df.shape[0]) * 500
+    contracted_hours_df = contracted_hours_df.reset_index(names="id")
+
+    # Each cost center uses a random subset of the ledger accounts in the income statement
+    # definition, with a few spend or revenue categories per account
+    accounts = _accounts(income_statement_def.INCOME_STATEMENT_DEF)
+    rows = []
+    for wd_id in wd_ids:
+        for i in rng.choice(
+            len(accounts), min(accounts_per_dept, len(accounts)), False
+        ):
+            account, category = accounts[i]
+            for cat in [category] if category not in (None, "*") else ["A", "B", ""]:
+                rows.append((wd_id, account, cat))
+    lines = pd.DataFrame(rows, columns=["dept_wd_id", "ledger_acct", "category"])
+    income_stmt_df = lines.merge(pd.DataFrame({"month": months}), how="cross")
+    is_revenue = income_stmt_df["ledger_acct"].str.startswith("4")
+    income_stmt_df["spend_category"] = np.where(
+        is_revenue, "", income_stmt_df["category"]
+    )
+    income_stmt_df["revenue_category"] = np.where(
+        is_revenue, income_stmt_df["category"], ""
+    )
+    income_stmt_df["dept_name"] = income_stmt_df["dept_wd_id"]
+    # Revenue is recorded as credits (negative values) in the ledger
+    sign = np.where(is_revenue, -1, 1)
+    for col in ["actual", "budget", "actual_ytd", "budget_ytd"]:
+        income_stmt_df[col] = sign * rng.random(income_stmt_df.shape[0]) * 10000
+    income_stmt_df = income_stmt_df.drop(columns=["category"]).reset_index(names="id")
+
+    return source_data.SourceData(
+        last_updated=datetime.now(),
+        volumes_df=volumes_df,
+        uos_df=uos_df,
+        budget_df=budget_df,
+        hours_df=hours_df,
+        contracted_hours_df=contracted_hours_df,
+        income_stmt_df=income_stmt_df,
+        contracted_hours_updated_month=f"{last_year:04d}-12-31",
+    )
+
+
+def _accounts(items: list, ret: list = None) -> list:
+    """Return a list of (account, category) for every account in the income statement definition"""
+    ret = [] if ret is None else ret
+    for item in items:
+        if "items" in item:
+            _accounts(item["items"], ret)
+        if "account" in item:
+            ret.append((item["account"], item.get("category")))
+    return ret
+
+
+def _time(fn, repeat: int = 5) -> float:
+    """Return the best wall time in seconds of repeat calls to fn"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _time_load(metadata, write) -> float:
+    """Return the wall time in seconds of write(engine) on a new datamart file with the tables in metadata"""
+    from prw_common import db_utils
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        engine = db_utils.get_db_connection(f"sqlite:///{tmp_dir}/datamart.sqlite3")
+        metadata.create_all(engine)
+        start = time.perf_counter()
+        write(engine)
+        elapsed = time.perf_counter() - start
+        engine.dispose()
+    return elapsed
+
+
+def _log_data_size(src: source_data.SourceData):
+    logging.info(
+        f"Synthetic data: {len(route.DEPTS)} departments, {src.income_stmt_df.shape[0]:,} income statement rows, "
+        + f"{src.hours_df.shape[0]:,} hours rows, {src.volumes_df['month'].nunique()} months"
+    )
+
+
+# -------------------------------------------------------
+# Benchmarks
+# -------------------------------------------------------
+def bench_consolidated(args):
+    """
+    Hospital-wide KPIs for all departments in one pass (dept.consolidated.data.calc_kpis)
+    """
+    from src.dept.consolidated import data
+
+    src = synthetic_source_data(years=args.years)
+    _log_data_size(src)
+    month = src.income_stmt_df["month"].max()
+    elapsed = _time(lambda: data.calc_kpis(src, month))
+    logging.info(f"consolidated: {elapsed * 1000:.0f} ms for {month}")
+
+
+def bench_hours(args):
+    """
+    Hours and FTE summaries for every month, totaled across all departments. Compares grouping the whole
+    hours table for each month, as dept.base.data previously did, to dept.base.hours_rollup, which totals
+    only the numeric columns once and looks up precomputed year to date sums.
+    """
+    from src.dept.base import hours_rollup
+
+    src = synthetic_source_data(years=args.years)
+    _log_data_size(src)
+    hours_df = src.hours_df
+    months = sorted(hours_df["month"].unique())
+
+    def group_all_columns():
+        for month in months:
+            df = hours_df.groupby("month").sum().reset_index()
+            df.loc[df["month"] == month, HOURS_COLUMNS].sum()
+            df.loc[
+                df["month"].str.startswith(month[:4]) & (df["month"] <= month),
+                HOURS_COLUMNS,
+            ].sum()
+
+    def rollup():
+        df = hours_rollup.total_by_month(hours_df)
+        for month in months:
+            hours_rollup.for_month(df, month)
+            hours_rollup.year_to_month(df, month)
+
+    before = _time(group_all_columns, repeat=3)
+    after = _time(rollup, repeat=3)
+    logging.info(
+        f"hours: {len(months)} months, group all columns {before * 1000:.0f} ms, "
+        + f"hours_rollup {after * 1000:.0f} ms ({before / after:.0f}x)"
+    )
+
+
+def bench_load(args):
+    """
+    Writing the income_stmt table to a new datamart file, using db_utils.clear_tables_and_insert_data(), as the
+    ingest does by default, and common.load_util.bulk_load() (ingest_datamart.py --bulk-load)
+    """
+    from sqlmodel import Session
+    from prw_common import db_utils
+    from common import load_util
+    from ingest import db
+
+    src = synthetic_source_data(years=args.years, accounts_per_dept=100)
+    tables = [db_utils.TableData(table=db.IncomeStmt, df=src.income_stmt_df)]
+
+    def insert(engine):
+        with Session(engine) as session:
+            db_utils.clear_tables_and_insert_data(session, tables)
+            session.commit()
+
+    def bulk_load(engine):
+        load_util.bulk_load(engine, tables)
+
+    metadata = db.DatamartModel.metadata
+    before = min(_time_load(metadata, insert) for _ in range(3))
+    after = min(_time_load(metadata, bulk_load) for _ in range(3))
+    logging.info(
+        f"load: {src.income_stmt_df.shape[0]:,} income_stmt rows, clear_tables_and_insert_data {before:.2f}s, "
+        + f"bulk_load {after:.2f}s ({before / after:.1f}x)"
+    )
+
+
+def bench_query(args):
+    """
+    Department dashboards with source data in memory, as the app does by default, and in query mode
+    (DATA_MODE = "query"), where the datamart stays open and each department is totaled by SQL queries.
+    Reports the time to load the source data and to process every department for the latest month, and the
+    memory held by the source data and department totals, which in query mode does not grow with the number
+    of months.
+    """
+    from sqlalchemy import create_engine
+    from common import source_data_util
+    from src.dept.base import data, rollup
+    from ingest import db
+
+    src = synthetic_source_data(years=args.years)
+    _log_data_size(src)
+    month = src.income_stmt_df["month"].max()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Write the synthetic tables to a datamart file, with the indexes defined by the ingest
+        db_file = os.path.join(tmp_dir, "datamart.sqlite3")
+        engine = create_engine(f"sqlite:///{db_file}")
+        with engine.begin() as conn:
+            for name, df in [
+                ("volumes", src.volumes_df),
+                ("uos", src.uos_df),
+                ("budget", src.budget_df),
+                ("hours", src.hours_df),
+                ("contracted_hours", src.contracted_hours_df),
+                ("income_stmt", src.income_stmt_df),
+            ]:
+                df.to_sql(name, conn, index=False)
+            pd.DataFrame({"modified": [src.last_updated]}).to_sql("meta", conn)
+        for table in db.DatamartModel.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(engine)
+        engine.dispose()
+        del src
+
+        def run(read_source_data):
+            data._process.clear()
+            rollup._build.clear()
+            start = time.perf_counter()
+            src_data = read_source_data()
+            src_data.contracted_hours_updated_month = f"{month[:4]}-12-31"
+            load_secs = time.perf_counter() - start
+            start = time.perf_counter()
+            stats = {}
+            for route_id in route.DEPTS:
+                config = configs.DEPT_CONFIG[route_id]
+                dept_id = "All" if len(config.wd_ids) > 1 else config.wd_ids[0]
+                settings = {"dept_id": dept_id, "month": month}
+                stats[route_id] = data.process(config, settings, src_data).stats
+            process_secs = time.perf_counter() - start
+            return stats, load_secs, process_secs
+
+        def allocated_mb(read_source_data):
+            # Memory held by the source data and department totals, measured separately since tracing
+            # allocations slows down processing
+            rollup._build.clear()
+            gc.collect()
+            tracemalloc.start()
+            src_data = read_source_data()
+            dept_rollup = rollup.get(src_data)
+            for config in configs.DEPT_CONFIG.values():
+                dept_rollup.node(config)
+            gc.collect()
+            ret = tracemalloc.get_traced_memory()[0] / 2**20
+            tracemalloc.stop()
+            return ret
+
+        def read_memory():
+            engine = source_data_util.sqlite_engine_from_file(db_file)
+            src_data = source_data.from_db(engine)
+            engine.dispose()
+            return src_data
+
+        def read_query():
+            engine = source_data_util.sqlite_pool_engine_from_file(db_file)
+            return source_data.from_db_query(engine)
+
+        memory_stats, *memory = run(read_memory)
+        query_stats, *query = run(read_query)
+        memory.append(allocated_mb(read_memory))
+        query.append(allocated_mb(read_query))
+
+    # Both modes should calculate the same KPIs
+    mismatches = [
+        f"{route_id}.{key}"
+        for route_id, s in memory_stats.items()
+        for key, value in s.items()
+        if isinstance(value, (int, float))
+        and not np.isclose(value, query_stats[route_id][key])
+    ]
+    for mode, (load_secs, process_secs, mem_mb) in [
+        ("memory", memory),
+        ("query", query),
+    ]:
+        logging.info(
+            f"query: {mode} mode, load {load_secs:.2f}s, {len(route.DEPTS)} departments in {process_secs:.2f}s, "
+            + f"{mem_mb:.0f} MB allocated"
+        )
+    logging.info(f"query: stats that differ between modes: {mismatches or 'none'}")
+
+
+BENCHMARKS = {
+    "consolidated": bench_consolidated,
+    "hours": bench_hours,
+    "load": bench_load,
+    "query": bench_query,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Finance data layer benchmarks.")
+    parser.add_argument("benchmark", choices=BENCHMARKS.keys())
+    parser.add_argument(
+        "--years", type=int, default=5, help="Years of synthetic data to generate"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    main()
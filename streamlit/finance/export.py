@@ -0,0 +1,186 @@
+"""
+Batch export of KPIs and income statements for every department dashboard, without the Streamlit UI.
+Source data is read once, then each department is processed for every month across a pool of processes.
+Also serves as a throughput benchmark for the data layer (dept.base.data.process).
+
+Usage, from this directory:
+    python export.py --db prh-finance.sqlite3 --json prh-finance.json --out reports/ [--format csv] [--workers 4]
+"""
+
+# Add main repo directory to include path to access common/ modules
+import sys, os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import argparse
+import logging
+import time
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from src import route
+from src.model import source_data
+from src.dept.base import configs, data
+from common import source_data_util
+
+# Source data for the current worker process, set once by _init_worker()
+_worker_src = None
+
+
+def read_source_data(db_file: str, json_file: str = None) -> source_data.SourceData:
+    """
+    Read source data from a local datamart file, as in source_data.from_file(), but without the Streamlit cache
+    """
+    engine = source_data_util.sqlite_engine_from_file(db_file)
+    src_data = source_data.from_db(engine)
+    engine.dispose()
+    kvdata = source_data_util.json_from_file(json_file) if json_file else {}
+    src_data.contracted_hours_updated_month = kvdata.get(
+        "contracted_hours_updated_month"
+    )
+    return src_data
+
+
+def all_months(src_data: source_data.SourceData) -> list:
+    """
+    Return all months in the month range of the source data, oldest first
+    """
+    return [
+        str(p)
+        for p in pd.period_range(src_data.min_month, src_data.max_month, freq="M")
+    ]
+
+
+def export_dept(
+    src_data: source_data.SourceData, route_id: str, months: list
+) -> tuple[list, pd.DataFrame]:
+    """
+    Process one department dashboard for each month, as shown with all sub-departments selected.
+    Returns a list of stats dicts, one per month, and the income statements for all months.
+    """
+    config = configs.DEPT_CONFIG[route_id]
+    dept_id = "All" if len(config.wd_ids) > 1 else config.wd_ids[0]
+
+    stats, income_stmts = [], []
+    for month in months:
+        dept_data = data.process(config, {"dept_id": dept_id, "month": month}, src_data)
+        stats.append({"dept": route_id, "month": month, **dept_data.stats})
+        income_stmts.append(dept_data.income_stmt.assign(dept=route_id, month=month))
+    return stats, pd.concat(income_stmts, ignore_index=True)
+
+
+def _init_worker(src_data: source_data.SourceData):
+    """Runs once in each worker process. The source data is sent to each worker only once."""
+    global _worker_src
+    _worker_src = src_data
+
+
+def _export_dept_in_worker(route_id: str, months: list) -> tuple[list, pd.DataFrame]:
+    return export_dept(_worker_src, route_id, months)
+
+
+def export_all(
+    src_data: source_data.SourceData, route_ids: list, months: list, workers: int
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Export all departments for all months. Each department is a separate task in the process pool,
+    so the department rollup (dept.base.rollup) is reused across months within a worker.
+    Returns the stats and income statement dataframes, in department and month order.
+    """
+    if workers <= 1:
+        results = [export_dept(src_data, r, months) for r in route_ids]
+    else:
+        with ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=(src_data,)
+        ) as executor:
+            results = list(
+                executor.map(
+                    _export_dept_in_worker, route_ids, [months] * len(route_ids)
+                )
+            )
+
+    stats_df = pd.DataFrame([s for stats, _ in results for s in stats])
+    income_stmt_df = pd.concat([df for _, df in results], ignore_index=True)
+    income_stmt_df = income_stmt_df[
+        ["dept", "month"]
+        + [c for c in income_stmt_df.columns if c not in ("dept", "month")]
+    ]
+    return stats_df, income_stmt_df
+
+
+def write_output(df: pd.DataFrame, out_dir: str, name: str, format: str) -> str:
+    path = os.path.join(out_dir, f"{name}.{format}")
+    if format == "parquet":
+        df.to_parquet(path, index=False)
+    else:
+        df.to_csv(path, index=False)
+    return path
+
+
+# -------------------------------------------------------
+# Main entry point
+# -------------------------------------------------------
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Export KPIs and income statements for all finance departments."
+    )
+    parser.add_argument("--db", required=True, help="Path to datamart SQLite file")
+    parser.add_argument(
+        "--json", help="Path to datamart JSON file with contracted hours metadata"
+    )
+    parser.add_argument("--out", required=True, help="Output directory")
+    parser.add_argument("--format", choices=["parquet", "csv"], default="parquet")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of worker processes. Defaults to the number of CPUs.",
+    )
+    parser.add_argument(
+        "--depts",
+        nargs="+",
+        choices=route.DEPTS,
+        help="Route IDs of departments to export. Defaults to all departments.",
+    )
+    parser.add_argument(
+        "--months",
+        nargs="+",
+        help="Months to export in YYYY-MM format. Defaults to all months in the data.",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    start = time.perf_counter()
+    src_data = read_source_data(args.db, args.json)
+    if src_data.contracted_hours_updated_month is None:
+        logging.error("ERROR: contracted_hours_updated_month not found, specify --json")
+        exit(1)
+    read_secs = time.perf_counter() - start
+
+    route_ids = args.depts or list(route.DEPTS)
+    months = args.months or all_months(src_data)
+    logging.info(
+        f"Exporting {len(route_ids)} departments x {len(months)} months with {args.workers} workers"
+    )
+
+    start = time.perf_counter()
+    stats_df, income_stmt_df = export_all(src_data, route_ids, months, args.workers)
+    process_secs = time.perf_counter() - start
+
+    os.makedirs(args.out, exist_ok=True)
+    for name, df in [("stats", stats_df), ("income_stmt", income_stmt_df)]:
+        path = write_output(df, args.out, name, args.format)
+        logging.info(f"Wrote {df.shape[0]:,} rows to {path}")
+
+    n = len(route_ids) * len(months)
+    logging.info(
+        f"Read source data: {read_secs:.1f}s. Processed {n} dashboards in {process_secs:.1f}s "
+        + f"({n / process_secs:.1f} per second)"
+    )
+
+
+if __name__ == "__main__":
+    main()
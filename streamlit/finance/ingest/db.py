@@ -1,3 +1,4 @@
+from sqlalchemy import Index
 from sqlalchemy.orm import registry
 from sqlmodel import Field, SQLModel, Relationship
 from typing import List, Optional
@@ -8,6 +9,14 @@ class DatamartModel(SQLModel, registry=registry()):
     pass
 
 
+def _dept_month_index(table_name: str) -> Index:
+    """
+    Index for tables by cost center and month, so the app can query one department's rows directly from the
+    datamart instead of loading whole tables (see query mode in ../src/model/source_data.py)
+    """
+    return Index(f"ix_{table_name}_dept_wd_id_month", "dept_wd_id", "month")
+
+
 class Meta(DatamartModel, table=True):
     __tablename__ = "meta"
     id: int | None = Field(default=None, primary_key=True)
@@ -16,6 +25,7 @@ class Meta(DatamartModel, table=True):
 
 class Volume(DatamartModel, table=True):
     __tablename__ = "volumes"
+    __table_args__ = (_dept_month_index("volumes"),)
     id: int | None = Field(default=None, primary_key=True)
     dept_wd_id: str = Field(max_length=10)
     dept_name: str | None = None
@@ -26,6 +36,7 @@ class Volume(DatamartModel, table=True):
 
 class UOS(DatamartModel, table=True):
     __tablename__ = "uos"
+    __table_args__ = (_dept_month_index("uos"),)
     id: int | None = Field(default=None, primary_key=True)
     dept_wd_id: str = Field(max_length=10)
     dept_name: str | None = None
@@ -49,6 +60,7 @@ class Budget(DatamartModel, table=True):
 
 class Hours(DatamartModel, table=True):
     __tablename__ = "hours"
+    __table_args__ = (_dept_month_index("hours"),)
     id: int | None = Field(default=None, primary_key=True)
     month: str = Field(max_length=7)
     dept_wd_id: str = Field(max_length=10)
@@ -72,6 +84,7 @@ class ContractedHours(DatamartModel, table=True):
 
 class IncomeStmt(DatamartModel, table=True):
     __tablename__ = "income_stmt"
+    __table_args__ = (_dept_month_index("income_stmt"),)
     id: int | None = Field(default=None, primary_key=True)
     month: str = Field(max_length=7)
     ledger_acct: str
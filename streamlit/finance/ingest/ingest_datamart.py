@@ -3,17 +3,26 @@ import os
 
 # Add repo root so we can import common modules
 sys.path.append(os.path.join(os.path.dirname(__file__), "..", ".."))
+# Add the finance app directory to reuse its data layer for the KPI summaries
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 
+import json
+import math
 import shutil
 import logging
 import pandas as pd
 import db
 from dataclasses import dataclass
-from sqlmodel import Session
+from sqlalchemy import text
+from sqlmodel import Session, delete
 from prw_common.encrypt import encrypt_file
 from prw_common import db_utils
 from prw_common import cli_utils
 from prw_common.remote_utils import upload_file_to_s3
+from common import extract_util, load_util, profile_util, publish_util
+import export
+from src import route
+from src.dept.base import configs
 
 
 # -------------------------------------------------------
@@ -43,37 +52,84 @@ class OutData:
     aged_ar_df: pd.DataFrame
 
 
+# Tables that can be extracted incrementally: SrcData field -> (source table, datamart table, watermark column).
+# The watermark column is a month (YYYY-MM) or date (YYYY-MM-DD) string. The budget table is small and always
+# read in full.
+INCREMENTAL_TABLES = {
+    "volumes_df": ("prw_volumes", db.Volume, "month"),
+    "uos_df": ("prw_uos", db.UOS, "month"),
+    "hours_df": ("prw_hours", db.Hours, "month"),
+    "contracted_hours_df": ("prw_contracted_hours", db.ContractedHours, "month"),
+    "income_stmt_df": ("prw_income_stmt", db.IncomeStmt, "month"),
+    "balance_sheet_df": ("prw_balance_sheet", db.BalanceSheet, "month"),
+    "aged_ar_df": ("prw_aged_ar", db.AgedAR, "date"),
+}
+
+# Large tables that are not transformed. With --max-memory, these are copied from the warehouse to the datamart
+# in chunks instead of being read into memory.
+STREAMED_TABLES = ["income_stmt_df"]
+
+
 # -------------------------------------------------------
 # Extract
 # -------------------------------------------------------
-def read_source_tables(prw_engine) -> SrcData:
+def read_watermarks(out_engine, lookback_months: int) -> dict:
+    """
+    Return the value to extract from for each table in INCREMENTAL_TABLES, based on the latest month in the
+    existing datamart. Extraction restarts lookback_months before the latest month, so that late entries and
+    adjustments to recently closed months are picked up. Tables with no data are not included, and are read in full.
     """
-    Read source tables from the warehouse DB
+    watermarks = {}
+    for field, (_, table, col) in INCREMENTAL_TABLES.items():
+        latest = pd.read_sql_query(
+            f"SELECT MAX({col}) FROM {table.__tablename__}", out_engine
+        ).iloc[0, 0]
+        if latest is None:
+            continue
+
+        start = pd.Period(latest[:7], freq="M") - lookback_months
+        watermarks[field] = str(start) if col == "month" else f"{start}-01"
+    return watermarks
+
+
+def read_source_tables(
+    prw_engine,
+    watermarks: dict = None,
+    workers: int = extract_util.DEFAULT_WORKERS,
+    exclude: list = (),
+) -> SrcData:
+    """
+    Read source tables from the warehouse DB, reading up to workers tables at the same time.
+    If watermarks are given, tables in INCREMENTAL_TABLES that have a watermark (see read_watermarks())
+    only include rows on or after it. Fields in exclude are not read and left as None.
     """
     logging.info("Reading source tables")
-
-    volumes_df = pd.read_sql_table("prw_volumes", prw_engine, index_col="id")
-    uos_df = pd.read_sql_table("prw_uos", prw_engine, index_col="id")
-    budget_df = pd.read_sql_table("prw_budget", prw_engine, index_col="id")
-    hours_df = pd.read_sql_table("prw_hours", prw_engine, index_col="id")
-    contracted_hours_df = pd.read_sql_table(
-        "prw_contracted_hours", prw_engine, index_col="id"
-    )
-    income_stmt_df = pd.read_sql_table("prw_income_stmt", prw_engine, index_col="id")
-    balance_sheet_df = pd.read_sql_table(
-        "prw_balance_sheet", prw_engine, index_col="id"
-    )
-    aged_ar_df = pd.read_sql_table("prw_aged_ar", prw_engine, index_col="id")
-
-    return SrcData(
-        volumes_df=volumes_df,
-        uos_df=uos_df,
-        budget_df=budget_df,
-        hours_df=hours_df,
-        contracted_hours_df=contracted_hours_df,
-        income_stmt_df=income_stmt_df,
-        balance_sheet_df=balance_sheet_df,
-        aged_ar_df=aged_ar_df,
+    watermarks = watermarks or {}
+
+    def table_reader(field):
+        if field not in watermarks:
+            src_table = INCREMENTAL_TABLES[field][0]
+            return extract_util.table_reader(src_table, index_col="id")
+        return lambda conn: pd.read_sql_query(
+            _source_query(field, watermarks), conn, index_col="id"
+        )
+
+    readers = {
+        field: table_reader(field)
+        for field in INCREMENTAL_TABLES
+        if field not in exclude
+    }
+    readers["budget_df"] = extract_util.table_reader("prw_budget", index_col="id")
+    return SrcData(**extract_util.read_tables(prw_engine, readers, workers))
+
+
+def _source_query(field: str, watermarks: dict):
+    """Query for the rows of a table in INCREMENTAL_TABLES on or after its watermark, or all rows"""
+    src_table, _, col = INCREMENTAL_TABLES[field]
+    if field not in watermarks:
+        return text(f"SELECT * FROM {src_table}")
+    return text(f"SELECT * FROM {src_table} WHERE {col} >= :start").bindparams(
+        start=watermarks[field]
     )
 
 
@@ -112,6 +168,175 @@ def transform(src: SrcData) -> OutData:
     )
 
 
+# -------------------------------------------------------
+# Load
+# -------------------------------------------------------
+def upsert_since_watermarks(session: Session, out: OutData, watermarks: dict):
+    """
+    Update an existing datamart with incrementally extracted data. For each table in INCREMENTAL_TABLES, rows
+    on or after the table's watermark are replaced by the extracted rows. Tables without a watermark, and the
+    budget table, are replaced entirely.
+    """
+    tables = [("budget_df", db.Budget, None, None)] + [
+        (field, table, col, watermarks.get(field))
+        for field, (_, table, col) in INCREMENTAL_TABLES.items()
+    ]
+    for field, table, col, start in tables:
+        # Streamed tables are not in memory. See stream_source_tables().
+        df = getattr(out, field)
+        if df is None:
+            continue
+        _delete_since(session, table, col, start)
+
+        # Only write the columns defined in the datamart table
+        df = df[[c for c in df.columns if c in table.__table__.columns]]
+        df.to_sql(
+            table.__tablename__, session.connection(), if_exists="append", index=False
+        )
+        logging.info(f"{table.__tablename__}: replaced {df.shape[0]} rows")
+
+
+def stream_source_tables(
+    prw_engine,
+    session: Session,
+    fields: list,
+    watermarks: dict,
+    max_memory_mb: float,
+):
+    """
+    Copy tables in INCREMENTAL_TABLES from the warehouse to the datamart in chunks of about max_memory_mb,
+    replacing rows on or after each table's watermark, or all rows if it has none.
+    """
+    watermarks = watermarks or {}
+    for field in fields:
+        _, table, col = INCREMENTAL_TABLES[field]
+        _delete_since(session, table, col, watermarks.get(field))
+        with prw_engine.connect() as prw_conn:
+            n_rows = extract_util.stream_to_table(
+                prw_conn,
+                _source_query(field, watermarks),
+                session.connection(),
+                table,
+                max_memory_mb,
+            )
+        logging.info(f"{table.__tablename__}: streamed {n_rows} rows")
+
+
+def _delete_since(session: Session, table, col: str, start: str):
+    """Delete rows from a datamart table where col is on or after start, or all rows if start is None"""
+    stmt = delete(table)
+    if start is not None:
+        stmt = stmt.where(getattr(table, col) >= start)
+    session.exec(stmt)
+
+
+def _write_all_tables(session: Session, out: OutData, bulk_load: bool = False):
+    tables = [
+        db_utils.TableData(table=db.Volume, df=out.volumes_df),
+        db_utils.TableData(table=db.UOS, df=out.uos_df),
+        db_utils.TableData(table=db.Budget, df=out.budget_df),
+        db_utils.TableData(table=db.Hours, df=out.hours_df),
+        db_utils.TableData(table=db.ContractedHours, df=out.contracted_hours_df),
+        db_utils.TableData(table=db.IncomeStmt, df=out.income_stmt_df),
+        db_utils.TableData(table=db.BalanceSheet, df=out.balance_sheet_df),
+        db_utils.TableData(table=db.AgedAR, df=out.aged_ar_df),
+    ]
+    # Streamed tables are not in memory. See stream_source_tables().
+    tables = [t for t in tables if t.df is not None]
+    if bulk_load:
+        load_util.bulk_load(session.get_bind(), tables)
+    else:
+        db_utils.clear_tables_and_insert_data(session, tables)
+
+
+# -------------------------------------------------------
+# Department KPI summaries
+# -------------------------------------------------------
+def write_dept_kpis(
+    db_file: str, json_file: str, out_dir: str, workers: int = None
+) -> list:
+    """
+    Calculate the KPIs and income statement for every department dashboard and month in the datamart,
+    using the same logic as the Streamlit app (dept.base.data), and write them as JSON files small enough
+    for the browser to fetch only what it shows:
+    - <dept>.json: the stats for every month, for the KPIs and trend graphs
+    - <dept>.<month>.json: the income statement for one month
+    - index.json: the departments and months, and the file names above
+    Files are written to out_dir without subdirectories, since uploaded objects are named after the file
+    name. Returns the paths of the files written.
+    """
+    logging.info("Calculating department KPIs")
+    src_data = export.read_source_data(db_file, json_file)
+    if src_data.contracted_hours_updated_month is None:
+        raise ValueError(f"contracted_hours_updated_month not found in {json_file}")
+
+    months = export.all_months(src_data)
+    stats_df, income_stmt_df = export.export_all(
+        src_data, list(route.DEPTS), months, workers or os.cpu_count()
+    )
+    stats_by_dept = dict(list(stats_df.groupby("dept", sort=False)))
+    income_stmt_by_dept = dict(list(income_stmt_df.groupby("dept", sort=False)))
+    last_updated = str(src_data.last_updated)
+
+    os.makedirs(out_dir, exist_ok=True)
+    files = []
+    for route_id in route.DEPTS:
+        stats = _records(stats_by_dept[route_id].drop(columns="dept"))
+        dept_json = {
+            "dept": route_id,
+            "name": configs.DEPT_CONFIG[route_id].name,
+            "last_updated": last_updated,
+            "months": [{"month": row["month"], "stats": row} for row in stats],
+        }
+        files.append(_write_json(dept_json, os.path.join(out_dir, f"{route_id}.json")))
+
+        income_stmts = income_stmt_by_dept[route_id].drop(columns="dept")
+        for month, income_stmt in income_stmts.groupby("month"):
+            month_json = {
+                "dept": route_id,
+                "month": month,
+                "last_updated": last_updated,
+                "income_stmt": _records(income_stmt.drop(columns="month")),
+            }
+            files.append(
+                _write_json(
+                    month_json, os.path.join(out_dir, f"{route_id}.{month}.json")
+                )
+            )
+
+    index_json = {
+        "last_updated": last_updated,
+        "months": months,
+        "files": {"stats": "{dept}.json", "income_stmt": "{dept}.{month}.json"},
+        "depts": [
+            {"dept": route_id, "name": configs.DEPT_CONFIG[route_id].name}
+            for route_id in route.DEPTS
+        ],
+    }
+    files.append(_write_json(index_json, os.path.join(out_dir, "index.json")))
+    logging.info(
+        f"Wrote KPIs for {len(route.DEPTS)} departments to {len(files)} files in {out_dir}"
+    )
+    return files
+
+
+def _records(df: pd.DataFrame) -> list:
+    """Rows of df as a list of dicts, with NaN values replaced by None so the output is valid JSON"""
+    return [
+        {
+            k: None if isinstance(v, float) and math.isnan(v) else v
+            for k, v in row.items()
+        }
+        for row in df.to_dict("records")
+    ]
+
+
+def _write_json(obj, path: str) -> str:
+    with open(path, "w") as f:
+        json.dump(obj, f, separators=(",", ":"), default=str)
+    return path
+
+
 # -------------------------------------------------------
 # Main entry point
 # -------------------------------------------------------
@@ -126,6 +351,60 @@ def parse_arguments():
         "--key",
         help="Encrypt with given key. Defaults to no encryption if not specified.",
     )
+    parser.add_argument(
+        "--incremental",
+        metavar="LOCAL_DB",
+        help="Keep an unencrypted copy of the datamart at this path between runs, and only extract months "
+        + "from the warehouse that are new or recently changed. The first run extracts everything.",
+    )
+    parser.add_argument(
+        "--lookback",
+        type=int,
+        default=2,
+        help="In incremental mode, number of months before the latest month in the datamart to extract again",
+    )
+    parser.add_argument(
+        "--kpi-out",
+        help="Also write per-department KPI summaries as JSON files to this directory",
+    )
+    parser.add_argument(
+        "--json",
+        help="Path to datamart JSON file with contracted hours metadata. Required with --kpi-out.",
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=float,
+        metavar="MB",
+        help="Copy large tables to the datamart in chunks of about this many MB, instead of reading them "
+        + "into memory all at once",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=extract_util.DEFAULT_WORKERS,
+        help="Number of source tables to read from the warehouse at the same time",
+    )
+    parser.add_argument(
+        "--bulk-load",
+        action="store_true",
+        help="Write the datamart with loading PRAGMAs and executemany(), and build indexes after loading. "
+        + "Ignored with --incremental, since the local datamart is kept between runs.",
+    )
+    parser.add_argument(
+        "--pipelined-publish",
+        action="store_true",
+        help="Encrypt output files in chunks and upload them to S3 as they are encrypted, all files in parallel. "
+        + "Requires dashboards that read chunk encrypted files (common.publish_util.decrypt()).",
+    )
+    parser.add_argument(
+        "--skip-unchanged",
+        action="store_true",
+        help="Skip encrypting and uploading if the datamart content is the same as the last published version",
+    )
+    parser.add_argument(
+        "--report",
+        help="Write a JSON run report with the time, CPU and memory used by each stage to this path",
+    )
     return parser.parse_args()
 
 
@@ -141,62 +420,119 @@ def main():
     encrypt_key = None if args.key is None or args.key.lower() == "none" else args.key
     s3_url = args.s3url
     s3_auth = args.s3auth
-    tmp_db_file = "datamart.sqlite3"
+    tmp_db_file = args.incremental or "datamart.sqlite3"
+    profiler = profile_util.StageProfiler("finance")
 
     logging.info(
-        f"Input: {db_utils.mask_conn_pw(prw_db_url)}, output: {output_db_file}, encrypt: {encrypt_key is not None}, upload: {s3_url}",
-        flush=True,
+        f"Input: {db_utils.mask_conn_pw(prw_db_url)}, output: {output_db_file}, encrypt: {encrypt_key is not None}, upload: {s3_url}"
     )
 
     # Create the sqlite output database and create the tables as defined in ../src/model/db.py
+    is_incremental = args.incremental and os.path.exists(args.incremental)
     out_engine = db_utils.get_db_connection(f"sqlite:///{tmp_db_file}")
     db.DatamartModel.metadata.create_all(out_engine)
 
+    # In incremental mode, only extract data after the watermarks of the existing local datamart
+    watermarks = None
+    if is_incremental:
+        watermarks = read_watermarks(out_engine, args.lookback)
+        logging.info(f"Incremental ingest, watermarks: {watermarks}")
+
     # Read from PRW warehouse (MSSQL in prod, sqlite in dev)
     prw_engine = db_utils.get_db_connection(prw_db_url)
-    src = read_source_tables(prw_engine)
+    streamed = STREAMED_TABLES if args.max_memory else []
+    with profiler.stage("extract"):
+        src = read_source_tables(prw_engine, watermarks, args.workers, exclude=streamed)
     if src is None:
         error_exit("ERROR: failed to read source data (see above)")
 
     # Transform data
-    out = transform(src)
+    with profiler.stage("transform"):
+        out = transform(src)
 
     # Write tables to datamart
-    session = Session(out_engine)
-    db_utils.clear_tables_and_insert_data(
-        session,
-        [
-            db_utils.TableData(table=db.Volume, df=out.volumes_df),
-            db_utils.TableData(table=db.UOS, df=out.uos_df),
-            db_utils.TableData(table=db.Budget, df=out.budget_df),
-            db_utils.TableData(table=db.Hours, df=out.hours_df),
-            db_utils.TableData(table=db.ContractedHours, df=out.contracted_hours_df),
-            db_utils.TableData(table=db.IncomeStmt, df=out.income_stmt_df),
-            db_utils.TableData(table=db.BalanceSheet, df=out.balance_sheet_df),
-            db_utils.TableData(table=db.AgedAR, df=out.aged_ar_df),
-        ],
-    )
-
-    # Update last ingest time and modified times for source data files
-    db_utils.write_meta(session, db.Meta)
-    session.commit()
-
-    # Finally encrypt output files
-    if encrypt_key and encrypt_key.lower() != "none":
-        encrypt_file(tmp_db_file, output_db_file, encrypt_key)
-    else:
-        # Copy files to output paths if no encryption key is provided
-        shutil.copy(tmp_db_file, output_db_file)
-
-    # Clean up tmp files
-    os.remove(tmp_db_file)
+    with profiler.stage("load"):
+        session = Session(out_engine)
+        if watermarks is not None:
+            upsert_since_watermarks(session, out, watermarks)
+        else:
+            _write_all_tables(session, out, args.bulk_load and not args.incremental)
+        stream_source_tables(prw_engine, session, streamed, watermarks, args.max_memory)
+
+        # Update last ingest time and modified times for source data files
+        db_utils.write_meta(session, db.Meta)
+        session.commit()
+
+    # Store rows per table and the stages so far in the meta table
+    profiler.count_rows(out_engine)
+    profiler.write_meta(out_engine)
+
+    # With --skip-unchanged, compare a hash of the content with the manifest of the last published version, and
+    # skip encrypting and uploading if they are the same
+    upload = encrypt_key and s3_url and s3_auth
+    s3_args = (s3_url, s3_auth) if upload else ()
+    content_hash, unchanged = None, False
+    if args.skip_unchanged:
+        with profiler.stage("hash"):
+            content_hash = publish_util.content_hash(tmp_db_file)
+            unchanged = publish_util.is_published(
+                content_hash, output_db_file, *s3_args
+            )
+
+    # Precompute KPI summaries from the new datamart, so clients can download them instead of the whole datamart
+    kpi_files = []
+    if args.kpi_out and not unchanged:
+        if not args.json:
+            error_exit("ERROR: --json is required with --kpi-out")
+        with profiler.stage("kpi"):
+            kpi_files = write_dept_kpis(tmp_db_file, args.json, args.kpi_out)
+
+    # Finally encrypt output files. With --pipelined-publish, files are uploaded to S3 as they are encrypted.
+    with profiler.stage("publish" if args.pipelined_publish else "encrypt"):
+        if unchanged:
+            logging.info(
+                "Content is unchanged since the last publish, skipping encrypt and upload"
+            )
+        elif encrypt_key and args.pipelined_publish:
+            enc_files = [f"{file}.enc" for file in kpi_files]
+            publish_util.publish(
+                [(tmp_db_file, output_db_file), *zip(kpi_files, enc_files)],
+                encrypt_key,
+                s3_url,
+                s3_auth,
+            )
+            for file in kpi_files:
+                os.remove(file)
+            kpi_files = enc_files
+        elif encrypt_key and encrypt_key.lower() != "none":
+            encrypt_file(tmp_db_file, output_db_file, encrypt_key)
+            for i, file in enumerate(kpi_files):
+                encrypt_file(file, f"{file}.enc", encrypt_key)
+                os.remove(file)
+                kpi_files[i] = f"{file}.enc"
+        else:
+            # Copy files to output paths if no encryption key is provided
+            shutil.copy(tmp_db_file, output_db_file)
+
+    # Clean up tmp files. The local datamart is kept for the next incremental run.
+    if not args.incremental:
+        os.remove(tmp_db_file)
     prw_engine.dispose()
     out_engine.dispose()
 
     # Upload to S3. Only upload encrypted content.
-    if encrypt_key and s3_url and s3_auth:
-        upload_file_to_s3(s3_url, s3_auth, output_db_file)
-
+    if upload and not unchanged and not args.pipelined_publish:
+        with profiler.stage("upload"):
+            upload_file_to_s3(s3_url, s3_auth, output_db_file)
+            for file in kpi_files:
+                upload_file_to_s3(s3_url, s3_auth, file)
+
+    # Record the published content, for the next run with --skip-unchanged
+    if content_hash and not unchanged:
+        publish_util.write_manifest(content_hash, output_db_file, *s3_args)
+
+    profiler.add_files(output_db_file, *kpi_files)
+    profiler.write_report(args.report)
     logging.info("Done")
 
 
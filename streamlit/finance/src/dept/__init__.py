@@ -1 +1,2 @@
 from .base import dept_page
+from .consolidated import consolidated_page
@@ -128,6 +128,9 @@ DEPT_CONFIG = {
     ),
 }
 
+# Department dashboard names mapped to route IDs, sorted by name, for selecting a dashboard
+DEPT_OPTIONS = dict(sorted((DEPT_CONFIG[r].name, r) for r in route.DEPTS))
+
 
 def config_from_route(route_id: str):
     """
@@ -135,3 +138,20 @@ def config_from_route(route_id: str):
     route_id is generated by route.route_by_query() based on the "dept" URL query param.
     """
     return DEPT_CONFIG.get(route_id, None)
+
+
+def all_wd_ids(item) -> list:
+    """
+    Recursively find all Workday ID strings in a DeptConfig, a single ID, or a mixed list of IDs and DeptConfig objects
+    """
+    if isinstance(item, str):
+        # ID is just one string, return it as single element in list
+        return [item]
+    elif isinstance(item, DeptConfig):
+        return all_wd_ids(item.wd_ids)
+    else:
+        # Return all strings in wd_ids and recurse into any embedded DeptConfigs
+        ret = []
+        for id in item:
+            ret += all_wd_ids(id)
+        return ret
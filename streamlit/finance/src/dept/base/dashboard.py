@@ -1,5 +1,5 @@
 import streamlit as st
-from . import configs, data, ui, figs
+from . import configs, data, ui, figs, prefetch
 from ...model import source_data
 
 
@@ -21,3 +21,6 @@ def dept_page(src_data: source_data.SourceData, route_id: str):
 
     # Show main content
     ui.show(dept_config, user_settings, dept_data)
+
+    # Precompute the months the user is likely to select next while the page is idle
+    prefetch.schedule(dept_config, user_settings, src_data)
@@ -3,13 +3,18 @@ Transform source data into department specific data that can be displayed on das
 """
 
 import pandas as pd
-import math
+import numpy as np
+import streamlit as st
 from dataclasses import dataclass
 from datetime import date, datetime
 from .configs import DeptConfig
+from . import rollup, hours_rollup
 from ... import util
 from ...model import source_data, static_data, income_statement
 
+# Number of months of KPI history to calculate, up to and including the selected month
+KPI_HISTORY_MONTHS = 24
+
 
 @dataclass(frozen=True)
 class DeptData:
@@ -17,6 +22,9 @@ class DeptData:
     dept: str
     month: str
 
+    # Version of the source data (SourceData.last_updated)
+    version: datetime
+
     # Patient volumes from stats report card
     volumes: pd.DataFrame
 
@@ -33,6 +41,9 @@ class DeptData:
     # Single value calculations, like YTD volume
     stats: dict
 
+    # Year to month KPIs as of each of the last KPI_HISTORY_MONTHS months, for trends
+    kpi_history: pd.DataFrame
+
 
 def process(
     config: DeptConfig, settings: dict, src: source_data.SourceData
@@ -42,36 +53,38 @@ def process(
     Partitions and computes statistics to be displayed by the app.
     settings contains any configuration from the sidebar that the user selects.
     """
-    dept_id, month = (
-        settings["dept_id"],
-        settings["month"],
+    return _process(
+        src.last_updated, config, settings["dept_id"], settings["month"], src
     )
 
-    # Get department IDs that we will be matching
-    wd_ids = _get_all_wd_ids(config if dept_id == "All" else dept_id)
 
-    # Group volume data by department and month
-    volumes_df = src.volumes_df[src.volumes_df["dept_wd_id"].isin(wd_ids)]
-    volumes = _calc_volumes_history(volumes_df)
+@st.cache_data(max_entries=100, show_spinner=False)
+def _process(
+    version, config: DeptConfig, dept_id, month: str, _src: source_data.SourceData
+) -> DeptData:
+    # Keyed by data version and the sidebar settings, so returning to a department and month that was
+    # already shown, or rerunning the page for a widget outside of the sidebar, does not recalculate.
+    # The source data itself is not hashed.
+    src = _src
+    settings = {"dept_id": dept_id, "month": month}
+
+    # Get precomputed aggregates for the department, or the selected sub-department
+    node = rollup.get(src).node(config if dept_id == "All" else dept_id)
+    wd_ids = node.wd_ids
 
-    # Group UOS data by department and month
-    uos_df = src.uos_df[src.uos_df["dept_wd_id"].isin(wd_ids)]
-    uos = _calc_volumes_history(uos_df)
+    # Volume and UOS data totaled by month
+    volumes = node.volumes
+    uos = node.uos
 
     # Organize income statement data into a human readable table grouped into categories
-    income_stmt_df = src.income_stmt_df[src.income_stmt_df["dept_wd_id"].isin(wd_ids)]
+    income_stmt_df = node.income_stmt
     income_stmt = _calc_income_stmt_for_month(income_stmt_df, month)
 
     # Create summary tables for hours worked by month and year
-    hours_df = src.hours_df[src.hours_df["dept_wd_id"].isin(wd_ids)]
+    hours_df = node.hours
     hours = _calc_hours_history(hours_df)
-    hours_for_month = _calc_hours_for_month(hours_df, month)
-    hours_ytm = _calc_hours_ytm(hours_df, month)
-
-    # Summary table for contracted hours
-    contracted_hours_df = src.contracted_hours_df[
-        src.contracted_hours_df["dept_wd_id"].isin(wd_ids)
-    ]
+    hours_for_month = hours_rollup.for_month(hours_df, month)
+    hours_ytm = hours_rollup.year_to_month(hours_df, month)
 
     # Pre-calculate statistics that are individual numbers, like overall revenue per encounter
     stats = _calc_stats(
@@ -82,118 +95,41 @@ def process(
         uos,
         income_stmt_df,
         hours_df,
-        contracted_hours_df,
+        node.budget,
+        node.contracted_hours,
+    )
+
+    # The same KPIs as of the end of each month leading up to the selected month, for trend charts
+    kpi_history = _calc_kpi_history(
+        wd_ids,
+        month,
+        volumes,
+        uos,
+        income_stmt_df,
+        hours_df,
+        node.budget,
+        node.contracted_hours,
     )
 
     return DeptData(
         dept=wd_ids,
         month=month,
+        version=src.last_updated,
         volumes=volumes,
         hours=hours,
         hours_for_month=hours_for_month,
         hours_ytm=hours_ytm,
         income_stmt=income_stmt,
         stats=stats,
+        kpi_history=kpi_history,
     )
 
 
-def _get_all_wd_ids(id_list):
-    """Recursively find all ID strings in a mixed list of IDs and DeptConfig objects"""
-    if isinstance(id_list, str):
-        # ID is just one string, return it as single element in list
-        return [id_list]
-    elif isinstance(id_list, DeptConfig):
-        return _get_all_wd_ids(id_list.wd_ids)
-    else:
-        # Return all strings in wd_ids and recurse into any embedded DeptConfigs
-        ret = []
-        for id in id_list:
-            if isinstance(id, DeptConfig):
-                ret += _get_all_wd_ids(id.wd_ids)
-            else:
-                ret.append(id)
-        return ret
-
-
-def _calc_volumes_history(df: pd.DataFrame) -> pd.DataFrame:
-    """
-    Returns volumes for each month totaled across all departments in data set, sorted in reverse chronologic order by month
-    """
-    # Group rows by month. Sum the volume and keep the first value for unit.
-    df = (
-        df.groupby("month")
-        .agg(
-            volume=("volume", "sum"),
-            unit=("unit", "first"),
-        )
-        .reset_index()
-    )
-    return df.sort_values(by=["month"], ascending=[False])
-
-
-def _calc_hours_for_month(df: pd.DataFrame, month: str) -> pd.DataFrame:
-    """
-    Given a month, summarize the regular, overtime, productive/non-productive hours and total FTE
-    month should be in the format YYYY-MM
-    """
-    # Find the rows for the latest month
-    df = df[df["month"] == month].reset_index(drop=True)
-
-    # Return the columns that are displayed in the FTE tab summary table
-    columns = [
-        "reg_hrs",
-        "overtime_hrs",
-        "prod_hrs",
-        "nonprod_hrs",
-        "total_hrs",
-        "total_fte",
-    ]
-    if df.shape[0] > 0:
-        return df.loc[:, columns].sum()
-    else:
-        return pd.DataFrame(columns=columns)
-
-
-def _calc_hours_ytm(df: pd.DataFrame, month: str) -> pd.DataFrame:
-    """
-    Return a dataframe with a single row containing the sum of the productive/non-productive hours across all departments for this year
-    """
-    # Filter all rows that are in the same year and come before the given month
-    [year_num, month_num] = month.split("-")
-    df = df[df["month"].str.startswith(year_num) & (df["month"] <= month)]
-
-    # Sum all rows, except FTE. Return columns that are displayed in the FTE tab summary table.
-    # FTE needs to be recalculated based on the month number in the year.
-    columns = [
-        "reg_hrs",
-        "overtime_hrs",
-        "prod_hrs",
-        "nonprod_hrs",
-        "total_hrs",
-        "total_fte",
-    ]
-    if df.shape[0] > 0:
-        df = df[columns]
-        ret = df.sum()
-
-        # For January, just use data in FTE column. Do not recalculate total_fte using hours. Use calculation for
-        # subsequent months.
-        month_num = int(month_num)
-        if month_num > 1:
-            ret["total_fte"] = ret["total_hrs"] / (
-                util.fte_hrs_in_year(int(year_num))
-                * util.pct_of_year_through_date(month)
-            )
-        return ret
-    else:
-        return pd.DataFrame(columns=columns)
-
-
 def _calc_hours_history(df: pd.DataFrame) -> pd.DataFrame:
     """
-    Returns productive / non-productive hours and FTE for each month totaled across departments, sorted in reverse chronologic order by month
+    Returns productive / non-productive hours and FTE for each month, sorted in chronologic order by month.
+    df is already totaled across departments by month (see hours_rollup.total_by_month()).
     """
-    df = df.groupby("month").sum().reset_index()
     df = df.sort_values(by=["month"], ascending=[True])
     return df[
         [
@@ -227,7 +163,8 @@ def _calc_stats(
     volumes: pd.DataFrame,  # volumes for each sub-department, all months
     uos: pd.DataFrame,  # Unit of service (UOS) for each sub-department, all months
     income_stmt_df: pd.DataFrame,  # all income statment data for sub-departments, all months
-    hours: pd.DataFrame,  # prod/non-prod hours and FTE for each sub-department
+    hours: pd.DataFrame,  # prod/non-prod hours and FTE totaled by month
+    budget: pd.Series,  # sum of budget rows for all sub-departments
     contracted_hours_df: pd.DataFrame,  # traveler hours, currently pulled from manual entries in spreadsheet
 ) -> dict:
     """Precalculate statistics from raw data that will be displayed on dashboard"""
@@ -289,34 +226,7 @@ def _calc_stats(
 
     # There is one budget row for each department. Sum them for overall budget,
     # and divide by the months in the year so far for the YTD volume and hours budgets.
-    budget_df = src.budget_df[src.budget_df["dept_wd_id"].isin(wd_ids)]
-    budget_df = budget_df[
-        [
-            "budget_fte",
-            "budget_prod_hrs",
-            "budget_volume",
-            "budget_uos",
-            "budget_prod_hrs_per_uos",
-            "hourly_rate",
-        ]
-    ].sum()
-    # If there is more than one department, recalculate values that cannot just be summed across depts
-    if len(wd_ids) > 1:
-        # Prefer using UOS data to volume. If no data available, zero out the budgeted hrs per UOS
-        if budget_df["budget_uos"] > 0:
-            budget_df["budget_prod_hrs_per_uos"] = (
-                budget_df["budget_prod_hrs"] / budget_df["budget_uos"]
-            )
-        elif uos.empty and budget_df["budget_volume"] > 0:
-            budget_df["budget_prod_hrs_per_uos"] = (
-                budget_df["budget_prod_hrs"] / budget_df["budget_volume"]
-            )
-        else:
-            budget_df["budget_prod_hrs_per_uos"] = 0
-
-        # Calculate average of hourly rates - this is not entirely accurate, since pay/hours are not distributed
-        # evenly across departments. When possible, this will be recalulated below using (YTD salary / YTD hours)
-        budget_df["hourly_rate"] = budget_df["hourly_rate"] / len(wd_ids)
+    budget_df = _calc_budget(wd_ids, budget, uos)
 
     # Get the YTD budgeted volume based on the proportion of the annual budgeted volume
     # for the number of months of the year for which we have revenue / income statement information
@@ -355,7 +265,7 @@ def _calc_stats(
 
     # Hours data - table has one row per department with columns for types of hours,
     # eg. productive, non-productive, overtime, ...
-    hours_ytd = _calc_hours_ytm(hours, month_max)
+    hours_ytd = hours_rollup.year_to_month(hours, month_max)
     ytd_prod_hours = hours_ytd["prod_hrs"].sum() + contracted_hours_this_year_df["hrs"]
     ytd_hours = hours_ytd["total_hrs"].sum() + contracted_hours_this_year_df["hrs"]
 
@@ -414,46 +324,19 @@ def _calc_stats(
     s["budget_fte"] = budget_df.at["budget_fte"]
 
     # KPIs
-    s["revenue_per_volume"] = ytd_revenue / kpi_ytd_volume if kpi_ytd_volume > 0 else 0
-    s["expense_per_volume"] = ytd_expense / kpi_ytd_volume if kpi_ytd_volume > 0 else 0
-
-    if ytd_budget_volume_for_kpi and ytd_budget_revenue and ytd_budget_expense:
-        s["target_revenue_per_volume"] = ytd_budget_revenue / ytd_budget_volume_for_kpi
-        s["variance_revenue_per_volume"] = math.trunc(
-            (s["revenue_per_volume"] / s["target_revenue_per_volume"] - 1) * 100
-        )
-        s["target_expense_per_volume"] = ytd_budget_expense / ytd_budget_volume_for_kpi
-        s["variance_expense_per_volume"] = math.trunc(
-            (s["expense_per_volume"] / s["target_expense_per_volume"] - 1) * 100
-        )
-    else:
-        s["target_revenue_per_volume"] = 0
-        s["variance_revenue_per_volume"] = 0
-        s["target_expense_per_volume"] = 0
-        s["variance_expense_per_volume"] = 0
-
-    s["hours_per_volume"] = ytd_prod_hours / kpi_ytd_volume if kpi_ytd_volume > 0 else 0
-    s["target_hours_per_volume"] = budget_df.at["budget_prod_hrs_per_uos"]
-    s["variance_hours_per_volume"] = (
-        s["target_hours_per_volume"] - s["hours_per_volume"]
-    )
-    s["variance_hours_per_volume_pct"] = (
-        math.trunc(-s["variance_hours_per_volume"] / s["target_hours_per_volume"] * 100)
-        if s["target_hours_per_volume"] > 0
-        else 0
+    kpis = _calc_kpis(
+        ytd_revenue=ytd_revenue,
+        ytd_budget_revenue=ytd_budget_revenue,
+        ytd_expense=ytd_expense,
+        ytd_budget_expense=ytd_budget_expense,
+        ytd_salary=ytd_salary,
+        kpi_ytd_volume=kpi_ytd_volume,
+        ytd_budget_volume=ytd_budget_volume_for_kpi,
+        ytd_prod_hours=ytd_prod_hours,
+        ytd_hours=ytd_hours,
+        target_hours_per_volume=budget_df.at["budget_prod_hrs_per_uos"],
     )
-    if ytd_hours:
-        # prefer to calculate hourly rate directly vs using data from Dashboard Supporting Data
-        s["hourly_rate"] = ytd_salary / ytd_hours
-        s["fte_variance"] = (s["variance_hours_per_volume"] * kpi_ytd_volume) / (
-            static_data.FTE_HOURS_PER_YEAR * (ytd_prod_hours / ytd_hours)
-        )
-        s["fte_variance_dollars"] = (
-            s["variance_hours_per_volume"] * kpi_ytd_volume * s["hourly_rate"]
-        )
-    else:
-        s["fte_variance"] = 0
-        s["fte_variance_dollars"] = 0
+    s.update({key: value.item() for key, value in kpis.items()})
 
     # Contracted hours. This data is manually entered in the data spreadsheet currently, so we just
     # provide the specific data points for last year and this year
@@ -467,6 +350,221 @@ def _calc_stats(
     return s
 
 
+def _calc_kpis(
+    ytd_revenue,
+    ytd_budget_revenue,
+    ytd_expense,
+    ytd_budget_expense,
+    ytd_salary,
+    kpi_ytd_volume,  # YTD UOS, or volume if there is no UOS data
+    ytd_budget_volume,  # YTD portion of the annual budgeted UOS or volume
+    ytd_prod_hours,
+    ytd_hours,
+    target_hours_per_volume,
+) -> dict:
+    """
+    KPI formulas, evaluated element-wise. Arguments can be single numbers, or arrays with one value per month.
+    Returns a dict of numpy arrays, with KPIs that cannot be calculated, like ratios to a zero volume, set to 0.
+    """
+    (
+        ytd_revenue,
+        ytd_budget_revenue,
+        ytd_expense,
+        ytd_budget_expense,
+        ytd_salary,
+        kpi_ytd_volume,
+        ytd_budget_volume,
+        ytd_prod_hours,
+        ytd_hours,
+        target_hours_per_volume,
+    ) = np.broadcast_arrays(
+        *[
+            np.asarray(x, dtype=float)
+            for x in (
+                ytd_revenue,
+                ytd_budget_revenue,
+                ytd_expense,
+                ytd_budget_expense,
+                ytd_salary,
+                kpi_ytd_volume,
+                ytd_budget_volume,
+                ytd_prod_hours,
+                ytd_hours,
+                target_hours_per_volume,
+            )
+        ]
+    )
+    k = {}
+
+    # Revenue and expense per UOS compared to the budgeted targets
+    has_volume = kpi_ytd_volume > 0
+    has_target = (
+        (ytd_budget_volume != 0) & (ytd_budget_revenue != 0) & (ytd_budget_expense != 0)
+    )
+    k["revenue_per_volume"] = _div(ytd_revenue, kpi_ytd_volume, has_volume)
+    k["expense_per_volume"] = _div(ytd_expense, kpi_ytd_volume, has_volume)
+    k["target_revenue_per_volume"] = _div(
+        ytd_budget_revenue, ytd_budget_volume, has_target
+    )
+    k["variance_revenue_per_volume"] = _trunc(
+        (_div(k["revenue_per_volume"], k["target_revenue_per_volume"], has_target) - 1)
+        * 100,
+        has_target,
+    )
+    k["target_expense_per_volume"] = _div(
+        ytd_budget_expense, ytd_budget_volume, has_target
+    )
+    k["variance_expense_per_volume"] = _trunc(
+        (_div(k["expense_per_volume"], k["target_expense_per_volume"], has_target) - 1)
+        * 100,
+        has_target,
+    )
+
+    # Productive hours per UOS compared to budget
+    k["hours_per_volume"] = _div(ytd_prod_hours, kpi_ytd_volume, has_volume)
+    k["target_hours_per_volume"] = target_hours_per_volume
+    k["variance_hours_per_volume"] = target_hours_per_volume - k["hours_per_volume"]
+    has_hours_target = target_hours_per_volume > 0
+    k["variance_hours_per_volume_pct"] = _trunc(
+        _div(-k["variance_hours_per_volume"], target_hours_per_volume, has_hours_target)
+        * 100,
+        has_hours_target,
+    )
+
+    # Prefer to calculate hourly rate directly vs using data from Dashboard Supporting Data.
+    # FTE variance is the hours variance converted to FTEs, adjusted for the proportion of productive hours.
+    has_hours = ytd_hours != 0
+    k["hourly_rate"] = _div(ytd_salary, ytd_hours, has_hours)
+    prod_hours_ratio = _div(ytd_prod_hours, ytd_hours, has_hours)
+    k["fte_variance"] = _div(
+        k["variance_hours_per_volume"] * kpi_ytd_volume,
+        static_data.FTE_HOURS_PER_YEAR * prod_hours_ratio,
+        has_hours & (prod_hours_ratio != 0),
+    )
+    k["fte_variance_dollars"] = np.where(
+        has_hours,
+        k["variance_hours_per_volume"] * kpi_ytd_volume * k["hourly_rate"],
+        0,
+    )
+    return k
+
+
+def _div(num: np.ndarray, denom: np.ndarray, where: np.ndarray) -> np.ndarray:
+    """Element-wise num / denom where the condition is true, otherwise 0"""
+    return np.divide(num, denom, out=np.zeros(np.shape(num)), where=where)
+
+
+def _trunc(x: np.ndarray, where: np.ndarray) -> np.ndarray:
+    """Element-wise truncation to integer where the condition is true, otherwise 0"""
+    return np.where(where, np.trunc(x), 0).astype(int)
+
+
+def _calc_kpi_history(
+    wd_ids: list,
+    month: str,
+    volumes: pd.DataFrame,
+    uos: pd.DataFrame,
+    income_stmt_df: pd.DataFrame,
+    hours: pd.DataFrame,
+    budget: pd.Series,
+    contracted_hours_df: pd.DataFrame,
+) -> pd.DataFrame:
+    """
+    Returns year to month KPIs as of the end of each of the KPI_HISTORY_MONTHS months up to and including month,
+    in chronologic order. Uses the same formulas as _calc_stats(), evaluated for all months at once.
+    """
+    months = pd.period_range(end=month, periods=KPI_HISTORY_MONTHS, freq="M")
+    month_strs = months.strftime("%Y-%m")
+
+    # Monthly volumes and hours from the start of the first year, so that cumulative sums are year to date
+    all_months = pd.period_range(start=f"{months[0].year}-01", end=month, freq="M")
+    all_month_strs = all_months.strftime("%Y-%m")
+    years = pd.Series(all_months.year, index=all_month_strs)
+
+    def ytd(df: pd.DataFrame, columns: list) -> pd.DataFrame:
+        df = df[df["month"].isin(all_month_strs)].groupby("month")[columns].sum()
+        df = df.reindex(all_month_strs, fill_value=0).astype(float)
+        return df.groupby(years).cumsum().loc[month_strs]
+
+    # If UOS data is available, use it for KPIs. Otherwise, use volume data.
+    kpi_ytd_volume = ytd(volumes if uos.empty else uos, ["volume"])["volume"]
+    ytd_hours = ytd(hours, ["prod_hrs", "total_hrs"])
+
+    # Contracted hours are a year to date total for this year only (see _calc_stats())
+    contracted_hours = np.where(
+        months.year == date.today().year,
+        contracted_hours_df.loc[
+            contracted_hours_df["year"] == date.today().year, "hrs"
+        ].sum(),
+        0,
+    )
+
+    # Income statement rows already contain YTD values, so only sum the revenue, expense and salary lines
+    stmt = income_stmt_df[income_stmt_df["month"].isin(month_strs)]
+    weights = income_statement.total_weights(stmt)
+    income = (
+        pd.DataFrame(
+            {
+                "month": stmt["month"],
+                "ytd_revenue": weights["revenue"] * stmt["actual_ytd"],
+                "ytd_budget_revenue": weights["revenue"] * stmt["budget_ytd"],
+                "ytd_expense": weights["expense"] * stmt["actual_ytd"],
+                "ytd_budget_expense": weights["expense"] * stmt["budget_ytd"],
+                "ytd_salary": weights["salary"] * stmt["actual_ytd"],
+            }
+        )
+        .groupby("month")
+        .sum()
+        .reindex(month_strs, fill_value=0)
+    )
+
+    budget_df = _calc_budget(wd_ids, budget, uos)
+    budget_volume_for_kpi = (
+        budget_df.at["budget_uos"] if not uos.empty else budget_df.at["budget_volume"]
+    )
+
+    kpis = _calc_kpis(
+        ytd_revenue=income["ytd_revenue"],
+        ytd_budget_revenue=income["ytd_budget_revenue"],
+        ytd_expense=income["ytd_expense"],
+        ytd_budget_expense=income["ytd_budget_expense"],
+        ytd_salary=income["ytd_salary"],
+        kpi_ytd_volume=kpi_ytd_volume,
+        ytd_budget_volume=budget_volume_for_kpi * (months.month / 12),
+        ytd_prod_hours=ytd_hours["prod_hrs"] + contracted_hours,
+        ytd_hours=ytd_hours["total_hrs"] + contracted_hours,
+        target_hours_per_volume=budget_df.at["budget_prod_hrs_per_uos"],
+    )
+    return pd.DataFrame({"month": month_strs, **kpis})
+
+
+def _calc_budget(wd_ids: list, budget: pd.Series, uos: pd.DataFrame) -> pd.Series:
+    """
+    Return the budget totaled across all sub-departments. The sum is precomputed and shared, so
+    it is copied before recalculating values that cannot just be summed across departments.
+    """
+    budget_df = budget.copy()
+    # If there is more than one department, recalculate values that cannot just be summed across depts
+    if len(wd_ids) > 1:
+        # Prefer using UOS data to volume. If no data available, zero out the budgeted hrs per UOS
+        if budget_df["budget_uos"] > 0:
+            budget_df["budget_prod_hrs_per_uos"] = (
+                budget_df["budget_prod_hrs"] / budget_df["budget_uos"]
+            )
+        elif uos.empty and budget_df["budget_volume"] > 0:
+            budget_df["budget_prod_hrs_per_uos"] = (
+                budget_df["budget_prod_hrs"] / budget_df["budget_volume"]
+            )
+        else:
+            budget_df["budget_prod_hrs_per_uos"] = 0
+
+        # Calculate average of hourly rates - this is not entirely accurate, since pay/hours are not distributed
+        # evenly across departments. When possible, this will be recalulated below using (YTD salary / YTD hours)
+        budget_df["hourly_rate"] = budget_df["hourly_rate"] / len(wd_ids)
+
+    return budget_df
+
+
 def _max_month_to_display(
     volumes: pd.DataFrame,
     uos: pd.DataFrame,
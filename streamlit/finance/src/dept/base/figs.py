@@ -1,9 +1,9 @@
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
+import plotly.io as pio
 import streamlit as st
 from datetime import datetime
-from st_aggrid import AgGrid, GridOptionsBuilder, ColumnsAutoSizeMode, JsCode
 from ... import util
 
 
@@ -11,6 +11,19 @@ from ... import util
 def kpi_gauge(
     title, variance_pct, yellow_threshold, red_threshold, gauge_max, key=None
 ):
+    _show_cached_fig(
+        "kpi_gauge",
+        (title, variance_pct, yellow_threshold, red_threshold, gauge_max),
+        lambda: _kpi_gauge(
+            title, variance_pct, yellow_threshold, red_threshold, gauge_max
+        ),
+        key=key,
+    )
+
+
+def _kpi_gauge(
+    title, variance_pct, yellow_threshold, red_threshold, gauge_max
+) -> go.Figure:
     color = "#238823"
     textcolor = color
     if abs(variance_pct) >= red_threshold:
@@ -72,121 +85,192 @@ def kpi_gauge(
             height=100,
         )
     )
-    st.plotly_chart(fig, use_container_width=True, key=key)
+    return fig
 
 
-def aggrid_income_stmt(df, month=None):
-    # Bold these Ledger Account rows
-    bold_rows = [
-        "Operating Revenues",
-        "Total Revenue",
-        "Net Revenue",
-        "Expenses",
-        "Total Operating Expenses",
-        "Operating Margin",
-        "Contribution Margin",
+# Display a small line chart of a KPI over time with its target as a dotted line
+def kpi_trend(df, value_col, target_col, tickformat, cache_key, key=None):
+    _show_cached_fig(
+        "kpi_trend",
+        cache_key + (value_col, target_col, tickformat),
+        lambda: _kpi_trend(df, value_col, target_col, tickformat),
+        key=key,
+    )
+
+
+def _kpi_trend(df, value_col, target_col, tickformat) -> go.Figure:
+    fig = go.Figure()
+    fig.add_trace(
+        go.Scatter(
+            x=df["month"],
+            y=df[target_col],
+            name="Target",
+            mode="lines",
+            line=dict(color="gray", width=1, dash="dot"),
+        )
+    )
+    fig.add_trace(
+        go.Scatter(
+            x=df["month"],
+            y=df[value_col],
+            name="Actual",
+            mode="lines+markers",
+            line=dict(color=px.colors.qualitative.D3[0], width=2),
+            marker=dict(size=4),
+        )
+    )
+    fig.update_traces(hovertemplate=f"%{{y:{tickformat}}}")
+    fig.update_layout(
+        dict(
+            showlegend=False,
+            margin=dict(l=0, r=0, b=0, t=10, pad=0),
+            height=100,
+            hovermode="x unified",
+            xaxis={"tickformat": "%b %Y", "showgrid": False},
+            yaxis={"tickformat": tickformat, "nticks": 3},
+        )
+    )
+    return fig
+
+
+# Bold these Ledger Account rows in the income statement
+INCOME_STMT_BOLD_ROWS = [
+    "Operating Revenues",
+    "Total Revenue",
+    "Net Revenue",
+    "Expenses",
+    "Total Operating Expenses",
+    "Operating Margin",
+    "Contribution Margin",
+]
+
+# Money columns in the income statement: Actual, Budget, YTD Actual, YTD Budget
+INCOME_STMT_VALUE_COLUMNS = ["Actual", "Budget", "YTD Actual", "YTD Budget"]
+
+
+def income_stmt_tree(df, month, cache_key, key="income_stmt"):
+    """
+    Show the income statement as an expandable tree. Only top level rows are shown at first. Selecting a row
+    with children expands or collapses it, and only the rows that are visible are sent to the browser.
+    df is DeptData.income_stmt, with a hier column containing each row's path separated by |.
+    """
+    tree = _income_stmt_tree(cache_key, df)
+
+    # Paths of expanded rows are kept for the session, so they stay open when changing months
+    expanded = st.session_state.setdefault(f"{key}_expanded", set())
+    visible = _visible_rows(tree, expanded)
+
+    labels = [
+        "\u2003" * depth + ("▾ " if path in expanded else "▸ " if has_children else "")
+        for path, depth, has_children in zip(
+            visible["path"], visible["depth"], visible["has_children"]
+        )
     ]
+    display_df = visible[INCOME_STMT_VALUE_COLUMNS].assign(
+        **{"Ledger Account": [l + a for l, a in zip(labels, visible["label"])]}
+    )[["Ledger Account"] + INCOME_STMT_VALUE_COLUMNS]
+    styler = display_df.style.format(
+        # Rows with no amounts this month, such as headers with no accounts under them, are left blank
+        lambda v: "" if pd.isna(v) else util.format_finance(round(v)),
+        subset=INCOME_STMT_VALUE_COLUMNS,
+    ).apply(
+        lambda row: ["font-weight: bold" if visible["bold"].iat[row.name] else ""]
+        * len(row),
+        axis=1,
+    )
 
     # Update YTD column headers for the specific month
-    if month:
-        # Convert month from format "2023-01" to "Jan 2023"
-        month = datetime.strptime(month, "%Y-%m").strftime("%b %Y")
-        df.columns.values[-2] = f"Actual, Year to {month}"
-        df.columns.values[-1] = f"Budget, Year to {month}"
-
-    # Create AgGrid display configuration to do row grouping and bolding
-    gb = GridOptionsBuilder.from_dataframe(df)
-    gb.configure_grid_options(
-        # Auto-size columns, based width on content, not header
-        skipHeaderOnAutoSize=True,
-        suppressColumnVirtualisation=True,
-        # Bold columns based on contents of the Legder Account column
-        getRowStyle=JsCode(
-            f"""
-              function(params) {{
-                  if ({ str(bold_rows) }.includes(params?.data?.['Ledger Account'])) {{
-                      return {{'font-weight': 'bold'}}
-                  }}
-              }}
-              """
+    month_str = datetime.strptime(month, "%Y-%m").strftime("%b %Y")
+
+    # Selecting a row toggles it. The dataframe key changes after each toggle to clear the selection.
+    counter_key = f"{key}_n"
+    df_key = f"{key}_{st.session_state.get(counter_key, 0)}"
+    st.dataframe(
+        styler,
+        key=df_key,
+        on_select=lambda: _toggle_income_stmt_row(
+            df_key, counter_key, list(visible["path"]), expanded
         ),
-        # Row grouping
-        autoGroupColumnDef=dict(
-            # Don't show a column name
-            headerName="",
-            maxWidth=90,
-            # Don't add suffice with count of grouped up rows - eg. "> Supplies (10)"
-            # And innerRenderer() returning null results in blank text for grouped rows
-            cellRendererParams=dict(
-                suppressCount=True, innerRenderer=JsCode("function() {}")
+        selection_mode="single-row",
+        column_config={
+            "Ledger Account": st.column_config.TextColumn(
+                "Ledger Account", pinned=True
             ),
-            # For grouped rows (those that have a hier value with a |), use the
-            # default renderer agGroupCellRenderer, which will show the toggle button
-            # and call innerRenderer to determine the text to show.
-            #
-            # For non-grouped rows, just return an empty <span> so no text is shown.
-            cellRendererSelector=JsCode(
-                """
-                function(params) {
-                    class EmptyRenderer {
-                        getGui() { return document.createElement('span') }
-                        refresh() { return true; }
-                    }
-                    if (params.value && !params.value.indexOf('|')) {
-                        return null
-                    } else {
-                        return {
-                            component: 'agGroupCellRenderer',
-                        };
-                    }
-                }
-                """,
-            ),
-        ),
-        # Row grouping is actually using AgGrid Tree Data mode. See _hierarchy_from_row_groups() for
-        # how the tree paths are generated.
-        treeData=True,
-        getDataPath=JsCode("function(data) { return data.hier.split('|'); }"),
-        animateRows=True,
-        groupDefaultExpanded=1,
-    )
-    # gb.configure_column("i", headerName="Row", valueGetter="node.rowIndex", pinned="left", width=30)
-    gb.configure_column("hier", hide=True)
-    gb.configure_column("Month", hide=True)
-
-    # Configure decimals, commas, etc when displaying of money and percent columns, which are the last 4 columns of the dataframe:
-    # Actual, Budget, Actual Year to MM/YYYY, Budget Year to MM/YYYY
-    gb.configure_columns(
-        df.columns[-4:],
-        type=["numericColumn", "numberColumnFilter", "customNumericFormat"],
-        aggFunc="sum",
-        valueFormatter=JsCode(
-            "function(params) { return (params.value == null) ? params.value : params.value.toLocaleString('en-US', {style:'currency', currency:'USD', currencySign: 'accounting', maximumFractionDigits: 0}) }"
-        ),
+            "YTD Actual": st.column_config.TextColumn(f"Actual, Year to {month_str}"),
+            "YTD Budget": st.column_config.TextColumn(f"Budget, Year to {month_str}"),
+        },
+        hide_index=True,
+        use_container_width=True,
+        height=35 * (len(display_df) + 1) + 3,
     )
 
-    # Finally show data table
-    AgGrid(
-        df,
-        height=810,
-        gridOptions=gb.build(),
-        # columns_auto_size_mode=ColumnsAutoSizeMode.FIT_CONTENTS,
-        allow_unsafe_jscode=True,
+
+@st.cache_data(max_entries=100, show_spinner=False)
+def _income_stmt_tree(cache_key, _df) -> pd.DataFrame:
+    """
+    Returns one row per income statement row, in order, with columns path, parent (empty for top level rows),
+    label, depth, has_children, bold, and INCOME_STMT_VALUE_COLUMNS. Rows with children are totaled from the
+    rows under them, which is how the tree was previously aggregated in the browser.
+    """
+    paths = _df["hier"]
+    parts = paths.str.split("|")
+    tree = pd.DataFrame(
+        {
+            "path": paths,
+            "parent": parts.str[:-1].str.join("|"),
+            "label": _df["Ledger Account"],
+            "depth": parts.str.len() - 1,
+        }
+    ).reset_index(drop=True)
+    tree["has_children"] = tree["path"].isin(set(tree["parent"]))
+    tree["bold"] = tree["label"].isin(INCOME_STMT_BOLD_ROWS)
+    values = _df[INCOME_STMT_VALUE_COLUMNS].reset_index(drop=True).astype(float)
+
+    # Add each leaf row to all of the rows above it
+    leaves = ~tree["has_children"]
+    ancestors = parts.reset_index(drop=True)[leaves].apply(
+        lambda p: ["|".join(p[:i]) for i in range(1, len(p))]
     )
-    # Work around to ensure that AgGrid height doesn't collapse when in non-active tab after user interactions
-    st.markdown(
-        """
-        <style>
-            .element-container iframe {
-                min-height: 810px;
-            }
-        </style>
-        """,
-        unsafe_allow_html=True,
+    totals = (
+        values[leaves]
+        .assign(ancestor=ancestors)
+        .explode("ancestor")
+        .dropna(subset=["ancestor"])
+        .groupby("ancestor")[INCOME_STMT_VALUE_COLUMNS]
+        .sum()
+    )
+    values.loc[~leaves] = totals.reindex(tree.loc[~leaves, "path"]).fillna(0).to_numpy()
+    return pd.concat([tree, values], axis=1)
+
+
+def _visible_rows(tree, expanded) -> pd.DataFrame:
+    """Rows whose parents are all expanded. Parents come before their children in the tree."""
+    shown = set()
+    keep = []
+    for path, parent in zip(tree["path"], tree["parent"]):
+        is_shown = parent == "" or (parent in shown and parent in expanded)
+        if is_shown:
+            shown.add(path)
+        keep.append(is_shown)
+    return tree[keep].reset_index(drop=True)
+
+
+def _toggle_income_stmt_row(df_key, counter_key, paths, expanded):
+    rows = st.session_state[df_key].selection.rows
+    if rows:
+        expanded.symmetric_difference_update([paths[rows[0]]])
+        st.session_state[counter_key] = st.session_state.get(counter_key, 0) + 1
+
+
+def volumes_fig(src, group_by_month, cache_key):
+    _show_cached_fig(
+        "volumes",
+        cache_key + (group_by_month,),
+        lambda: _volumes_fig(src, group_by_month),
     )
 
 
-def volumes_fig(src, group_by_month):
+def _volumes_fig(src, group_by_month) -> go.Figure:
     if group_by_month:
         # Groups data by month, show a bar for each year above each month
         df = util.group_data_by_month(src, month_col="month", value_col="volume")
@@ -218,7 +302,7 @@ def volumes_fig(src, group_by_month):
         xaxis_title=None,
         yaxis_title=None,
     )
-    st.plotly_chart(fig, use_container_width=True)
+    return fig
 
 
 def hours_table(month, hours_for_month, hours_ytd):
@@ -326,7 +410,15 @@ def contracted_hours_table(stats):
     st.markdown(styled_df.to_html(), unsafe_allow_html=True)
 
 
-def fte_fig(src, budget_fte, group_by_month):
+def fte_fig(src, budget_fte, group_by_month, cache_key):
+    _show_cached_fig(
+        "fte",
+        cache_key + (budget_fte, group_by_month),
+        lambda: _fte_fig(src, budget_fte, group_by_month),
+    )
+
+
+def _fte_fig(src, budget_fte, group_by_month) -> go.Figure:
     if group_by_month:
         # Groups data by month, show a bar for each year above each month
         df = util.group_data_by_month(src, month_col="month", value_col="total_fte")
@@ -380,10 +472,18 @@ def fte_fig(src, budget_fte, group_by_month):
             orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1
         ),  # show legend horizontally on top right
     )
-    st.plotly_chart(fig, use_container_width=True)
+    return fig
+
+
+def hours_fig(src, cache_key):
+    _show_cached_fig(
+        "hours",
+        cache_key,
+        lambda: _hours_fig(src),
+    )
 
 
-def hours_fig(src):
+def _hours_fig(src) -> go.Figure:
     df = src[["month", "prod_hrs", "nonprod_hrs", "total_hrs"]].copy()
     df.columns = [
         "Month",
@@ -433,10 +533,18 @@ def hours_fig(src):
     fig.update_layout(
         margin={"t": 25},
     )
-    st.plotly_chart(fig, use_container_width=True)
+    return fig
+
+
+def compare_hours_fig(src, cache_key):
+    _show_cached_fig(
+        "compare_hours",
+        cache_key,
+        lambda: _compare_hours_fig(src),
+    )
 
 
-def compare_hours_fig(src):
+def _compare_hours_fig(src) -> go.Figure:
     # Show a graph with hours grouped by month across years. Don't separate prod/nonprod for this graph since that display requires
     # stacked bars and we are going to use grouped bars.
     df = util.group_data_by_month(src, month_col="month", value_col="total_hrs")
@@ -465,4 +573,23 @@ def compare_hours_fig(src):
         ),  # show legend horizontally on top right
     )
 
-    st.plotly_chart(fig, use_container_width=True)
+    return fig
+
+
+# -----------------------------------
+# Figure cache
+# -----------------------------------
+def _show_cached_fig(fig_type, cache_key, build, key=None):
+    """
+    Show a Plotly figure, reusing the serialized figure from a previous run if available.
+    cache_key must identify all inputs to the figure, like (department, month, data version, options).
+    build() returns the figure and is only called on a cache miss.
+    """
+    fig = pio.from_json(_fig_json(fig_type, cache_key, build))
+    st.plotly_chart(fig, use_container_width=True, key=key)
+
+
+@st.cache_data(max_entries=1000, show_spinner=False)
+def _fig_json(fig_type, cache_key, _build) -> str:
+    # _build is not hashed, so the figure is cached only by type and key
+    return _build().to_json()
@@ -0,0 +1,73 @@
+"""
+Hours and FTE totaled by month, with year to date sums precomputed so that summaries for a month
+or year to month are row lookups. Only the numeric hours columns are aggregated.
+"""
+
+import pandas as pd
+from ... import util
+
+# Numeric columns in the hours table that are totaled
+HOURS_COLUMNS = [
+    "reg_hrs",
+    "overtime_hrs",
+    "prod_hrs",
+    "nonprod_hrs",
+    "total_hrs",
+    "total_fte",
+]
+
+# Cumulative sums of HOURS_COLUMNS from the start of each year
+YTD_COLUMNS = [f"ytd_{col}" for col in HOURS_COLUMNS]
+
+
+def total_by_month(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Total hours across departments by month, and add YTD_COLUMNS.
+    df has a month column in the format YYYY-MM and HOURS_COLUMNS, and may have more than one row per month.
+    Returns one row per month in chronologic order.
+    """
+    df = df.groupby("month", as_index=False)[HOURS_COLUMNS].sum()
+    ytd = df.groupby(df["month"].str[:4])[HOURS_COLUMNS].cumsum()
+    df[YTD_COLUMNS] = ytd.to_numpy()
+    return df
+
+
+def for_month(df: pd.DataFrame, month: str) -> pd.Series:
+    """
+    Given a month, return the regular, overtime, productive/non-productive hours and total FTE.
+    df is the output of total_by_month(). month should be in the format YYYY-MM.
+    Returns an empty dataframe if there is no data for the month.
+    """
+    i = df["month"].searchsorted(month)
+    if i < df.shape[0] and df["month"].iat[i] == month:
+        return _row(df, i, HOURS_COLUMNS)
+    else:
+        return pd.DataFrame(columns=HOURS_COLUMNS)
+
+
+def year_to_month(df: pd.DataFrame, month: str) -> pd.Series:
+    """
+    Return the sum of hours for the year up to and including the given month, with total FTE recalculated from
+    total hours. df is the output of total_by_month(). Returns an empty dataframe if there is no data for the year.
+    """
+    # The last row in the same year that is not after the given month holds the year to date sums
+    year_num, month_num = month.split("-")
+    i = df["month"].searchsorted(month, side="right") - 1
+    if i < 0 or not df["month"].iat[i].startswith(year_num):
+        return pd.DataFrame(columns=HOURS_COLUMNS)
+
+    ret = _row(df, i, YTD_COLUMNS)
+    ret.index = HOURS_COLUMNS
+
+    # For January, just use data in FTE column. Do not recalculate total_fte using hours. Use calculation for
+    # subsequent months.
+    if int(month_num) > 1:
+        ret["total_fte"] = ret["total_hrs"] / (
+            util.fte_hrs_in_year(int(year_num)) * util.pct_of_year_through_date(month)
+        )
+    return ret
+
+
+def _row(df: pd.DataFrame, i: int, columns: list) -> pd.Series:
+    """Return the values in the given columns of row number i as a series indexed by column name"""
+    return pd.Series([df[col].iat[i] for col in columns], index=columns, dtype=float)
@@ -0,0 +1,70 @@
+"""
+Speculative precompute of department data for the months a user is likely to select next. Users usually step
+back through the month selector one month at a time, so after a page is shown for a month, the previous month
+and the same month in the prior year are processed in the background. Results are stored in the data.process
+cache, so the next selection is a cache hit.
+"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .configs import DeptConfig
+from . import data
+from ... import util
+from ...model import source_data
+
+# Background threads shared by all sessions. Kept low so speculative work does not compete with
+# interactive requests.
+MAX_WORKERS = 1
+
+# Maximum number of requests waiting or running across all sessions. Further requests are dropped
+# rather than queued, since they are only a guess at what will be needed.
+MAX_QUEUED = 8
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="prefetch")
+_lock = threading.Lock()
+_queued = set()
+
+
+def neighbor_months(month: str) -> list:
+    """
+    Return the months likely to be selected after the given month: the previous month and the same month
+    in the prior year. All in the format YYYY-MM.
+    """
+    year, month_num = util.split_YYYY_MM(month)
+    prev_year, prev_month_num = (
+        (year - 1, 12) if month_num == 1 else (year, month_num - 1)
+    )
+    return [f"{prev_year:04d}-{prev_month_num:02d}", f"{year - 1:04d}-{month_num:02d}"]
+
+
+def schedule(config: DeptConfig, settings: dict, src: source_data.SourceData) -> list:
+    """
+    Queue data.process() for the neighbor months of settings["month"] that are within the month range of
+    the source data. Returns the months that were queued.
+    """
+    ret = []
+    for month in neighbor_months(settings["month"]):
+        if not (src.min_month <= month <= src.max_month):
+            continue
+
+        key = (src.last_updated, config.name, repr(settings["dept_id"]), month)
+        with _lock:
+            if key in _queued or len(_queued) >= MAX_QUEUED:
+                continue
+            _queued.add(key)
+
+        neighbor_settings = {**settings, "month": month}
+        _executor.submit(_process, key, config, neighbor_settings, src)
+        ret.append(month)
+    return ret
+
+
+def _process(key, config: DeptConfig, settings: dict, src: source_data.SourceData):
+    try:
+        data.process(config, settings, src)
+    except Exception:
+        logging.exception(f"Error precomputing {config.name} for {settings['month']}")
+    finally:
+        with _lock:
+            _queued.discard(key)
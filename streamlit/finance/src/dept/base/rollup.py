@@ -0,0 +1,329 @@
+"""
+Bottom-up aggregation of source data for every node in the department hierarchy defined in configs.DEPT_CONFIG.
+Leaf cost centers are aggregated once, and each parent node is computed by combining its children's results.
+In query mode (see source_data.from_db_query()), each node is instead aggregated by the datamart, as needed.
+"""
+
+import functools
+import pandas as pd
+import streamlit as st
+from dataclasses import dataclass
+from sqlalchemy import bindparam, text
+from .configs import DeptConfig, DEPT_CONFIG, all_wd_ids
+from .hours_rollup import HOURS_COLUMNS, total_by_month
+from ...model import source_data
+
+# Numeric columns that are summed across departments
+BUDGET_COLUMNS = [
+    "budget_fte",
+    "budget_prod_hrs",
+    "budget_volume",
+    "budget_uos",
+    "budget_prod_hrs_per_uos",
+    "hourly_rate",
+]
+INCOME_STMT_KEYS = ["month", "ledger_acct", "spend_category", "revenue_category"]
+INCOME_STMT_VALUES = ["actual", "budget", "actual_ytd", "budget_ytd"]
+
+
+@dataclass(frozen=True)
+class NodeData:
+    """
+    Aggregated data for one node in the department hierarchy. Shared across sessions, so must not be modified.
+    """
+
+    # All Workday cost center IDs under this node
+    wd_ids: list
+
+    # Volumes and UOS totaled by month, in reverse chronologic order. Columns: month, volume, unit
+    volumes: pd.DataFrame
+    uos: pd.DataFrame
+
+    # Hours and FTE totaled by month, in chronologic order, with year to date sums.
+    # Columns: month + HOURS_COLUMNS + YTD_COLUMNS (see hours_rollup.total_by_month())
+    hours: pd.DataFrame
+
+    # Sum of budget rows for all cost centers. Index: BUDGET_COLUMNS
+    budget: pd.Series
+
+    # Contracted hours rows for all cost centers
+    contracted_hours: pd.DataFrame
+
+    # Income statement line items totaled by month, ledger account and category
+    income_stmt: pd.DataFrame
+
+
+class DeptRollup:
+    """
+    Precomputed NodeData for every department, sub-department and cost center in DEPT_CONFIG.
+    Nodes are keyed by the tuple of Workday IDs they contain, so identical groupings are only computed once.
+    """
+
+    def __init__(self, src: source_data.SourceData):
+        self._empty = _empty_partial(src)
+        self._leaves = _leaf_partials(src, self._empty)
+        self._partials = {}
+        self.nodes = {}
+        for config in DEPT_CONFIG.values():
+            self._rollup(config)
+
+    def node(self, item) -> NodeData:
+        """
+        Return the NodeData for a DeptConfig, a single Workday ID, or a list of IDs and DeptConfigs
+        """
+        key = tuple(all_wd_ids(item))
+        if key not in self.nodes:
+            self._rollup(item)
+        return self.nodes[key]
+
+    def _rollup(self, item) -> "_Partial":
+        """
+        Compute partial aggregates for item and all of its children, then publish the NodeData for each
+        """
+        key = tuple(all_wd_ids(item))
+        if key in self._partials:
+            return self._partials[key]
+
+        if isinstance(item, str):
+            partial = self._leaves.get(item, self._empty)
+        else:
+            children = item.wd_ids if isinstance(item, DeptConfig) else item
+            partial = _combine([self._rollup(child) for child in children])
+
+        self._partials[key] = partial
+        self.nodes[key] = partial.to_node(list(key))
+        return partial
+
+
+def _totals(columns: list) -> str:
+    """SQL select list that totals each column under its own name"""
+    return ", ".join(f"TOTAL({col}) AS {col}" for col in columns)
+
+
+# Queries for QueryRollup, where :wd_ids is the list of cost centers in a node. Volumes keep the unit of the
+# first source row in each month: in SQLite, a bare column in a query with MIN() comes from the minimum row.
+_VOLUMES_SQL = """
+    SELECT month, SUM(volume) AS volume, unit, MIN(id) AS pos FROM {table}
+    WHERE dept_wd_id IN :wd_ids GROUP BY month
+"""
+_HOURS_SQL = f"""
+    SELECT month, {_totals(HOURS_COLUMNS)} FROM hours
+    WHERE dept_wd_id IN :wd_ids GROUP BY month
+"""
+_BUDGET_SQL = (
+    f"SELECT {_totals(BUDGET_COLUMNS)} FROM budget WHERE dept_wd_id IN :wd_ids"
+)
+_CONTRACTED_HOURS_SQL = "SELECT * FROM contracted_hours WHERE dept_wd_id IN :wd_ids"
+_INCOME_STMT_SQL = f"""
+    SELECT {", ".join(INCOME_STMT_KEYS)}, {_totals(INCOME_STMT_VALUES)} FROM income_stmt
+    WHERE dept_wd_id IN :wd_ids GROUP BY {", ".join(INCOME_STMT_KEYS)} ORDER BY MIN(id)
+"""
+
+
+class QueryRollup:
+    """
+    NodeData for departments in query mode, with the same interface as DeptRollup. Each node is totaled by
+    SQL queries that only read the rows for its cost centers, using the (dept_wd_id, month) indexes in the
+    datamart. Only the most recently used nodes are kept, so memory does not grow with the number of
+    departments viewed.
+    """
+
+    # Number of nodes kept. Users usually view several months of the same department in a row.
+    MAX_NODES = 8
+
+    def __init__(self, src: source_data.SourceData):
+        self._engine = src.db_engine
+        self._node = functools.lru_cache(maxsize=self.MAX_NODES)(self._query)
+
+    def node(self, item) -> NodeData:
+        """
+        Return the NodeData for a DeptConfig, a single Workday ID, or a list of IDs and DeptConfigs
+        """
+        return self._node(tuple(all_wd_ids(item)))
+
+    def _query(self, wd_ids: tuple) -> NodeData:
+        wd_ids_param = bindparam("wd_ids", list(wd_ids), expanding=True)
+        with self._engine.connect() as conn:
+            read = lambda sql: pd.read_sql_query(
+                text(sql).bindparams(wd_ids_param), conn
+            )
+            volumes = read(_VOLUMES_SQL.format(table="volumes"))
+            uos = read(_VOLUMES_SQL.format(table="uos"))
+            hours = read(_HOURS_SQL)
+            budget = read(_BUDGET_SQL)
+            contracted_hours = read(_CONTRACTED_HOURS_SQL)
+            income_stmt = read(_INCOME_STMT_SQL)
+
+        return NodeData(
+            wd_ids=list(wd_ids),
+            volumes=_finish_volumes(volumes),
+            uos=_finish_volumes(uos),
+            hours=total_by_month(hours.astype(dict.fromkeys(HOURS_COLUMNS, float))),
+            budget=budget.iloc[0],
+            contracted_hours=contracted_hours,
+            income_stmt=income_stmt,
+        )
+
+
+def get(src: source_data.SourceData) -> DeptRollup | QueryRollup:
+    """
+    Return the DeptRollup for this version of the source data, computing it on first use,
+    or a QueryRollup in query mode
+    """
+    return _build(src.last_updated, src)
+
+
+@st.cache_resource(max_entries=2, show_spinner="Calculating...")
+def _build(version, _src: source_data.SourceData) -> DeptRollup | QueryRollup:
+    # Keyed only by data version. The source data itself is not hashed.
+    if _src.db_engine is not None:
+        return QueryRollup(_src)
+    return DeptRollup(_src)
+
+
+# -----------------------------------
+# Partial aggregates
+# -----------------------------------
+@dataclass(frozen=True)
+class _Partial:
+    """
+    Intermediate aggregates that can be combined across nodes. Volumes and UOS carry the
+    position of their first source row, so the reported unit matches the source data order.
+    """
+
+    volumes: pd.DataFrame
+    uos: pd.DataFrame
+    hours: pd.DataFrame
+    budget: pd.Series
+    contracted_hours: pd.DataFrame
+    income_stmt: pd.DataFrame
+
+    def to_node(self, wd_ids: list) -> NodeData:
+        return NodeData(
+            wd_ids=wd_ids,
+            volumes=_finish_volumes(self.volumes),
+            uos=_finish_volumes(self.uos),
+            hours=total_by_month(self.hours),
+            budget=self.budget,
+            contracted_hours=self.contracted_hours,
+            income_stmt=self.income_stmt,
+        )
+
+
+def _leaf_partials(src: source_data.SourceData, empty: "_Partial") -> dict:
+    """
+    Aggregate each source table by cost center in a single pass, and return a _Partial for each Workday ID
+    """
+    volumes = _split(_group_volumes(src.volumes_df, by=["dept_wd_id", "month"]))
+    uos = _split(_group_volumes(src.uos_df, by=["dept_wd_id", "month"]))
+    hours = _split(
+        src.hours_df.groupby(["dept_wd_id", "month"], as_index=False)[
+            HOURS_COLUMNS
+        ].sum()
+    )
+    budget = src.budget_df.groupby("dept_wd_id")[BUDGET_COLUMNS].sum()
+    contracted_hours = _split(src.contracted_hours_df, drop_key=False)
+    income_stmt = _split(
+        src.income_stmt_df.groupby(
+            ["dept_wd_id"] + INCOME_STMT_KEYS, sort=False, dropna=False, as_index=False
+        )[INCOME_STMT_VALUES].sum()
+    )
+
+    wd_ids = (
+        set(volumes)
+        | set(uos)
+        | set(hours)
+        | set(budget.index)
+        | set(contracted_hours)
+        | set(income_stmt)
+    )
+    return {
+        wd_id: _Partial(
+            volumes=volumes.get(wd_id, empty.volumes),
+            uos=uos.get(wd_id, empty.uos),
+            hours=hours.get(wd_id, empty.hours),
+            budget=budget.loc[wd_id] if wd_id in budget.index else empty.budget,
+            contracted_hours=contracted_hours.get(wd_id, empty.contracted_hours),
+            income_stmt=income_stmt.get(wd_id, empty.income_stmt),
+        )
+        for wd_id in wd_ids
+    }
+
+
+def _empty_partial(src: source_data.SourceData) -> _Partial:
+    return _Partial(
+        volumes=pd.DataFrame(columns=["month", "volume", "unit", "pos"]),
+        uos=pd.DataFrame(columns=["month", "volume", "unit", "pos"]),
+        hours=pd.DataFrame(columns=["month"] + HOURS_COLUMNS).astype(
+            dict.fromkeys(HOURS_COLUMNS, float)
+        ),
+        budget=pd.Series(0, index=BUDGET_COLUMNS, dtype=float),
+        contracted_hours=src.contracted_hours_df.iloc[0:0],
+        income_stmt=pd.DataFrame(columns=INCOME_STMT_KEYS + INCOME_STMT_VALUES),
+    )
+
+
+def _combine(partials: list) -> _Partial:
+    """
+    Combine the partial aggregates of child nodes into the partial for their parent
+    """
+    if len(partials) == 1:
+        return partials[0]
+
+    volumes = _concat([p.volumes for p in partials], ignore_index=True)
+    uos = _concat([p.uos for p in partials], ignore_index=True)
+    hours = _concat([p.hours for p in partials], ignore_index=True)
+    income_stmt = _concat([p.income_stmt for p in partials], ignore_index=True)
+    return _Partial(
+        volumes=_group_volumes(volumes.sort_values("pos", kind="stable"), by=["month"]),
+        uos=_group_volumes(uos.sort_values("pos", kind="stable"), by=["month"]),
+        hours=hours.groupby("month", as_index=False)[HOURS_COLUMNS].sum(),
+        budget=pd.concat([p.budget for p in partials], axis=1).sum(axis=1),
+        contracted_hours=_concat([p.contracted_hours for p in partials]),
+        income_stmt=income_stmt.groupby(
+            INCOME_STMT_KEYS, sort=False, dropna=False, as_index=False
+        )[INCOME_STMT_VALUES].sum(),
+    )
+
+
+def _concat(dfs: list, ignore_index: bool = False) -> pd.DataFrame:
+    """
+    Concatenate dataframes, leaving out empty ones like the leaf partials from _empty_partial(), which pandas
+    would otherwise use to determine the column types. Returns the first dataframe if all are empty.
+    """
+    non_empty = [df for df in dfs if not df.empty]
+    if not non_empty:
+        return dfs[0]
+    return pd.concat(non_empty, ignore_index=ignore_index)
+
+
+def _group_volumes(df: pd.DataFrame, by: list) -> pd.DataFrame:
+    """
+    Sum volumes and keep the first unit within each group. Source rows are numbered by position if not already.
+    """
+    if "pos" not in df.columns:
+        df = df.assign(pos=range(df.shape[0]))
+    return df.groupby(by, as_index=False).agg(
+        volume=("volume", "sum"),
+        unit=("unit", "first"),
+        pos=("pos", "min"),
+    )
+
+
+def _finish_volumes(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Return volumes with index labels in chronologic order and rows in reverse chronologic order
+    """
+    df = df.sort_values(by=["month"]).reset_index(drop=True)
+    return df[["month", "volume", "unit"]].sort_values(by=["month"], ascending=[False])
+
+
+def _split(df: pd.DataFrame, drop_key: bool = True) -> dict:
+    """
+    Split a dataframe into a dict of {dept_wd_id: rows}, optionally dropping the dept_wd_id column
+    """
+    drop = ["dept_wd_id"] if drop_key else []
+    return {
+        wd_id: rows.drop(columns=drop)
+        for wd_id, rows in df.groupby("dept_wd_id", sort=False)
+    }
@@ -6,7 +6,7 @@ sys.path.append(os.path.join(os.path.dirname(__file__), "..", "..", "..", ".."))
 import pandas as pd
 import streamlit as st
 from streamlit_extras.add_vertical_space import add_vertical_space
-from datetime import datetime
+from datetime import date, datetime
 from dateutil.relativedelta import relativedelta
 from . import configs, data, figs
 from ... import util
@@ -30,20 +30,12 @@ def show_settings(config: configs.DeptConfig, src_data: source_data.SourceData)
         else:
             dept_id = config.wd_ids[0]
 
-        # Get the minimum and maximum months in the data
-        min_month = min(
-            src_data.volumes_df["month"].min(),
-            src_data.hours_df["month"].min(),
-            src_data.income_stmt_df["month"].min(),
-        )
-        max_month = min(
-            src_data.volumes_df["month"].max(),
-            src_data.hours_df["month"].max(),
-            src_data.income_stmt_df["month"].max(),
-        )
+        # Only offer months with data for the selected department
         month = st.selectbox(
             label="Month",
-            options=_enumerate_months(min_month, max_month),
+            options=_available_months(
+                src_data, config if dept_id == "All" else dept_id
+            ),
             format_func=lambda m: datetime.strptime(m, "%Y-%m").strftime("%b %Y"),
         )
 
@@ -79,7 +71,8 @@ def show_settings(config: configs.DeptConfig, src_data: source_data.SourceData)
 
 def show(config: configs.DeptConfig, settings: dict, data: data.DeptData):
     """
-    Render main content for department
+    Render main content for department. Each section is a fragment, so changing a widget within a
+    section, like the period shown in a graph, only reruns that section.
     """
     s = data.stats
 
@@ -113,6 +106,7 @@ def show(config: configs.DeptConfig, settings: dict, data: data.DeptData):
     _show_income_stmt(settings, data)
 
 
+@st.fragment
 def _show_kpi(settings: dict, data: data.DeptData):
     s = data.stats
 
@@ -140,6 +134,15 @@ def _show_kpi(settings: dict, data: data.DeptData):
             12,
             key="variance_revenue_per_volume",
         )
+    with col4:
+        figs.kpi_trend(
+            data.kpi_history,
+            "revenue_per_volume",
+            "target_revenue_per_volume",
+            "$,.0f",
+            _fig_key(data),
+            key="revenue_per_volume_trend",
+        )
     col1.metric(
         "Revenue per UOS",
         f"${s['revenue_per_volume']:,.0f}",
@@ -159,6 +162,15 @@ def _show_kpi(settings: dict, data: data.DeptData):
             12,
             key="variance_expense_per_volume",
         )
+    with col4:
+        figs.kpi_trend(
+            data.kpi_history,
+            "expense_per_volume",
+            "target_expense_per_volume",
+            "$,.0f",
+            _fig_key(data),
+            key="expense_per_volume_trend",
+        )
     col1.metric(
         "Expense per UOS",
         f"${s['expense_per_volume']:,.0f}",
@@ -182,6 +194,15 @@ def _show_kpi(settings: dict, data: data.DeptData):
             12,
             key="variance_hours_per_volume_pct",
         )
+    with col4:
+        figs.kpi_trend(
+            data.kpi_history,
+            "hours_per_volume",
+            "target_hours_per_volume",
+            ",.2f",
+            _fig_key(data),
+            key="hours_per_volume_trend",
+        )
     col1.metric("Hours per UOS", f"{s['hours_per_volume']:,.2f}")
     col2.metric("Target Hours per UOS", f"{s['target_hours_per_volume']:,.2f}")
 
@@ -197,6 +218,7 @@ def _show_kpi(settings: dict, data: data.DeptData):
     )
 
 
+@st.fragment
 def _show_volumes(settings: dict, data: data.DeptData):
 
     if all(
@@ -257,9 +279,10 @@ def _show_volumes(settings: dict, data: data.DeptData):
     with col_graph:
         df = _filter_by_period(data.volumes, volumes_period)
         group_by_month = volumes_period == "Compare"
-        figs.volumes_fig(df, group_by_month)
+        figs.volumes_fig(df, group_by_month, _fig_key(data, volumes_period))
 
 
+@st.fragment
 def _show_hours(settings: dict, data: data.DeptData):
     if data.hours is None or data.hours.shape[0] == 0:
         return st.write("No data for this month")
@@ -300,16 +323,27 @@ def _show_hours(settings: dict, data: data.DeptData):
     group_by_month = sel_period == "Compare"
 
     with col1:
-        figs.fte_fig(df, data.stats["budget_fte"], group_by_month)
+        figs.fte_fig(
+            df, data.stats["budget_fte"], group_by_month, _fig_key(data, sel_period)
+        )
     with col2:
         if group_by_month:
-            figs.compare_hours_fig(df)
+            figs.compare_hours_fig(df, _fig_key(data, sel_period))
         else:
-            figs.hours_fig(df)
+            figs.hours_fig(df, _fig_key(data, sel_period))
 
 
+@st.fragment
 def _show_income_stmt(settings: dict, data: data.DeptData):
-    figs.aggrid_income_stmt(data.income_stmt, settings["month"])
+    figs.income_stmt_tree(data.income_stmt, settings["month"], _fig_key(data))
+
+
+def _fig_key(data: data.DeptData, *options) -> tuple:
+    """
+    Return the key for caching figures: department, month, data version, and any display options.
+    Periods like "12 Months" are relative to today, so the date is included as well.
+    """
+    return (tuple(data.dept), data.month, data.version, date.today(), *options)
 
 
 def _dept_name(key):
@@ -320,6 +354,21 @@ def _dept_name(key):
     return static_data.WDID_TO_DEPT_NAME.get(key, f"Unknown Department {key}")
 
 
+def _available_months(src_data: source_data.SourceData, item) -> list:
+    """
+    Return the months, latest first, with data for any cost center in item (a DeptConfig or Workday ID),
+    within the month range of the source data. If there are none, return all months in the range.
+    """
+    months = set()
+    for wd_id in configs.all_wd_ids(item):
+        months.update(src_data.months_by_wd_id.get(wd_id, []))
+    months = sorted(
+        (m for m in months if src_data.min_month <= m <= src_data.max_month),
+        reverse=True,
+    )
+    return months or _enumerate_months(src_data.min_month, src_data.max_month)
+
+
 def _enumerate_months(min_month, max_month):
     min_month = datetime.strptime(min_month, "%Y-%m")
     cur_month = datetime.strptime(max_month, "%Y-%m")
@@ -0,0 +1 @@
+from .dashboard import consolidated_page
@@ -0,0 +1,16 @@
+from . import data, ui
+from ...model import source_data
+
+
+def consolidated_page(src_data: source_data.SourceData):
+    """
+    Show hospital-wide Streamlit page with KPIs for all departments
+    """
+    # Get sidebar user settings
+    user_settings = ui.show_settings(src_data)
+
+    # Calculate KPIs for every department in one pass over the source data
+    consolidated_data = data.process(user_settings, src_data)
+
+    # Show main content
+    ui.show(user_settings, consolidated_data)
@@ -0,0 +1,230 @@
+"""
+Transform source data into a consolidated, hospital-wide view with KPIs for every department.
+All departments are calculated together in one grouped pass over the source tables.
+"""
+
+import pandas as pd
+import numpy as np
+import streamlit as st
+from dataclasses import dataclass
+from sqlalchemy import text
+from ..base import configs
+from ... import route, util
+from ...model import source_data, income_statement
+
+# Row label for totals across all departments
+TOTAL = "Total"
+
+
+@dataclass(frozen=True)
+class ConsolidatedData:
+    # Settings
+    month: str
+
+    # One row of KPIs for each department dashboard in route.DEPTS, indexed by route ID
+    depts: pd.DataFrame
+
+    # Same KPIs for the whole hospital. Each cost center is counted once, even if it is part
+    # of more than one department dashboard.
+    totals: pd.Series
+
+
+def process(settings: dict, src: source_data.SourceData) -> ConsolidatedData:
+    """
+    Receives raw source data from database and calculates KPIs for all departments for the selected month.
+    settings contains any configuration from the sidebar that the user selects.
+    """
+    return _process(src.last_updated, settings["month"], src)
+
+
+@st.cache_data(max_entries=24, show_spinner=False)
+def _process(version, month: str, _src: source_data.SourceData) -> ConsolidatedData:
+    # Keyed by data version and month. The source data itself is not hashed.
+    src = _src if _src.db_engine is None else _query_source_data(_src, month)
+    df = calc_kpis(src, month)
+    return ConsolidatedData(
+        month=month,
+        depts=df.drop(index=TOTAL),
+        totals=df.loc[TOTAL],
+    )
+
+
+def calc_kpis(src: source_data.SourceData, month: str) -> pd.DataFrame:
+    """
+    Returns a dataframe with one row of year to month KPIs per department, plus a TOTAL row.
+
+    KPIs follow dept.base.data._calc_stats(), except that every department uses the same month instead
+    of its own latest month with data, and hours do not include contracted (traveler) hours.
+    """
+    year, month_num = util.split_YYYY_MM(month)
+    first_month = f"{year:04d}-01"
+
+    # Map each cost center to every department that includes it, and to the hospital-wide total
+    dept_map = _dept_map()
+
+    # Income statement rows already contain YTD values, so only the selected month is needed.
+    # Sum revenue, expense and salary lines for each cost center.
+    stmt = src.income_stmt_df[src.income_stmt_df["month"] == month]
+    weights = income_statement.total_weights(stmt)
+    by_wd = pd.DataFrame(
+        {
+            "dept_wd_id": stmt["dept_wd_id"],
+            "ytd_revenue": weights["revenue"] * stmt["actual_ytd"],
+            "ytd_budget_revenue": weights["revenue"] * stmt["budget_ytd"],
+            "ytd_expense": weights["expense"] * stmt["actual_ytd"],
+            "ytd_budget_expense": weights["expense"] * stmt["budget_ytd"],
+            "ytd_salary": weights["salary"] * stmt["actual_ytd"],
+        }
+    )
+    by_wd = [by_wd.groupby("dept_wd_id").sum()]
+
+    # Volumes, UOS and hours, year to the selected month
+    in_ytd = lambda df: df[(df["month"] >= first_month) & (df["month"] <= month)]
+    by_wd.append(
+        in_ytd(src.volumes_df)
+        .groupby("dept_wd_id")["volume"]
+        .sum()
+        .rename("ytd_volume")
+    )
+    by_wd.append(
+        in_ytd(src.uos_df).groupby("dept_wd_id")["volume"].sum().rename("ytd_uos")
+    )
+    by_wd.append(
+        pd.Series(True, index=src.uos_df["dept_wd_id"].unique(), name="has_uos")
+    )
+    by_wd.append(
+        in_ytd(src.hours_df)
+        .groupby("dept_wd_id")[["prod_hrs", "total_hrs"]]
+        .sum()
+        .rename(columns={"prod_hrs": "ytd_prod_hrs", "total_hrs": "ytd_hrs"})
+    )
+    by_wd.append(
+        src.hours_df[src.hours_df["month"] == month]
+        .groupby("dept_wd_id")["total_fte"]
+        .sum()
+        .rename("fte")
+    )
+    by_wd.append(
+        src.budget_df.groupby("dept_wd_id")[
+            [
+                "budget_fte",
+                "budget_prod_hrs",
+                "budget_volume",
+                "budget_uos",
+                "budget_prod_hrs_per_uos",
+            ]
+        ].sum()
+    )
+    by_wd = pd.concat(by_wd, axis=1)
+    by_wd["has_uos"] = by_wd["has_uos"].notna()
+
+    # Total every cost center into each department it belongs to
+    df = dept_map.join(by_wd, on="dept_wd_id", how="left")
+    df["has_uos"] = df["has_uos"].fillna(False).astype(bool)
+    df = (
+        df.fillna(0)
+        .groupby("dept", sort=False)
+        .agg({**{c: "sum" for c in by_wd.columns if c != "has_uos"}, "has_uos": "any"})
+    )
+    n_wd_ids = dept_map.groupby("dept", sort=False).size().reindex(df.index)
+
+    # Prefer UOS to volume as the KPI denominator, and for the budgeted volume
+    kpi_volume = np.where(df["has_uos"], df["ytd_uos"], df["ytd_volume"])
+    ytd_budget_volume = np.where(
+        df["has_uos"], df["budget_uos"], df["budget_volume"]
+    ) * (month_num / 12)
+
+    # Budgeted hours per UOS can only be summed for a single cost center. Recalculate otherwise.
+    target_hours_per_volume = np.where(
+        n_wd_ids == 1,
+        df["budget_prod_hrs_per_uos"],
+        _div(
+            df["budget_prod_hrs"],
+            np.where(df["budget_uos"] > 0, df["budget_uos"], df["budget_volume"]),
+        ),
+    )
+
+    ret = pd.DataFrame(index=df.index)
+    ret["name"] = [
+        "All Departments" if dept == TOTAL else configs.DEPT_CONFIG[dept].name
+        for dept in df.index
+    ]
+    ret["ytd_revenue"] = df["ytd_revenue"]
+    ret["ytd_budget_revenue"] = df["ytd_budget_revenue"]
+    ret["ytd_expense"] = df["ytd_expense"]
+    ret["ytd_budget_expense"] = df["ytd_budget_expense"]
+    ret["ytd_margin"] = df["ytd_revenue"] - df["ytd_expense"]
+    ret["kpi_ytd_volume"] = kpi_volume
+    ret["revenue_per_volume"] = _div(df["ytd_revenue"], kpi_volume)
+    ret["target_revenue_per_volume"] = _div(df["ytd_budget_revenue"], ytd_budget_volume)
+    ret["variance_revenue_per_volume"] = _variance_pct(
+        ret["revenue_per_volume"], ret["target_revenue_per_volume"]
+    )
+    ret["expense_per_volume"] = _div(df["ytd_expense"], kpi_volume)
+    ret["target_expense_per_volume"] = _div(df["ytd_budget_expense"], ytd_budget_volume)
+    ret["variance_expense_per_volume"] = _variance_pct(
+        ret["expense_per_volume"], ret["target_expense_per_volume"]
+    )
+    ret["ytd_prod_hrs"] = df["ytd_prod_hrs"]
+    ret["hours_per_volume"] = _div(df["ytd_prod_hrs"], kpi_volume)
+    ret["target_hours_per_volume"] = target_hours_per_volume
+    ret["variance_hours_per_volume_pct"] = _variance_pct(
+        ret["hours_per_volume"], ret["target_hours_per_volume"]
+    )
+    ret["hourly_rate"] = _div(df["ytd_salary"], df["ytd_hrs"])
+    ret["fte"] = df["fte"]
+    ret["budget_fte"] = df["budget_fte"]
+    return ret
+
+
+def _query_source_data(
+    src: source_data.SourceData, month: str
+) -> source_data.SourceData:
+    """
+    In query mode, read only the rows that calc_kpis() uses for the given month: the income statement for the
+    month, and volumes, UOS and hours from the start of the year. The UOS table also gets one row with no month
+    for each cost center that has UOS data in any month, since calc_kpis() prefers UOS for those.
+    """
+    year, _ = util.split_YYYY_MM(month)
+    params = {"first_month": f"{year:04d}-01", "month": month}
+    read = lambda sql: pd.read_sql_query(text(sql), src.db_engine, params=params)
+    ytd = "month >= :first_month AND month <= :month"
+    return source_data.SourceData(
+        last_updated=src.last_updated,
+        income_stmt_df=read("SELECT * FROM income_stmt WHERE month = :month"),
+        volumes_df=read(f"SELECT * FROM volumes WHERE {ytd}"),
+        uos_df=read(f"""
+            SELECT dept_wd_id, month, volume FROM uos WHERE {ytd}
+            UNION ALL SELECT DISTINCT dept_wd_id, '', 0 FROM uos
+            """),
+        hours_df=read(f"SELECT * FROM hours WHERE {ytd}"),
+        budget_df=read("SELECT * FROM budget"),
+        contracted_hours_df=read("SELECT * FROM contracted_hours"),
+    )
+
+
+def _dept_map() -> pd.DataFrame:
+    """
+    Returns a dataframe with columns dept (route ID or TOTAL) and dept_wd_id, with one row for
+    each cost center in each department, and one TOTAL row for each unique cost center.
+    """
+    rows = [
+        (dept, wd_id)
+        for dept in route.DEPTS
+        for wd_id in dict.fromkeys(configs.all_wd_ids(configs.DEPT_CONFIG[dept]))
+    ]
+    rows += [(TOTAL, wd_id) for wd_id in dict.fromkeys(wd_id for _, wd_id in rows)]
+    return pd.DataFrame(rows, columns=["dept", "dept_wd_id"])
+
+
+def _div(num, denom):
+    """Element-wise num / denom, or 0 where denom is 0"""
+    num, denom = np.asarray(num, dtype=float), np.asarray(denom, dtype=float)
+    return np.divide(num, denom, out=np.zeros_like(num), where=denom != 0)
+
+
+def _variance_pct(value, target):
+    """Percent above or below target, truncated to an integer, or 0 if there is no target"""
+    return np.where(
+        np.asarray(target) != 0, np.trunc((_div(value, target) - 1) * 100), 0
+    )
@@ -0,0 +1,143 @@
+# Add main repo directory to include path to access common/ modules
+import sys, os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "..", "..", ".."))
+
+import streamlit as st
+from streamlit_extras.add_vertical_space import add_vertical_space
+from datetime import datetime
+from . import data
+from ... import util
+from ...model import source_data
+from common import st_util
+
+
+def show_settings(src_data: source_data.SourceData) -> dict:
+    """
+    Render the sidebar and return the dict with configuration options set by the user.
+    """
+    with st.sidebar:
+        st_util.st_sidebar_prh_logo()
+
+        # KPIs are calculated from the income statement, so only offer months that have one
+        month = st.selectbox(
+            label="Month",
+            options=src_data.income_stmt_months,
+            format_func=lambda m: datetime.strptime(m, "%Y-%m").strftime("%b %Y"),
+        )
+
+        add_vertical_space(2)
+        if st.button(
+            "Back to Dashboard List",
+            icon=":material/arrow_back:",
+            use_container_width=True,
+        ):
+            st.query_params.clear()
+            st.rerun()
+        if st.button(
+            "Log out", key="logout", icon=":material/logout:", use_container_width=True
+        ):
+            st.logout()
+            st.rerun()
+
+    return {"month": month}
+
+
+def show(settings: dict, data: data.ConsolidatedData):
+    """
+    Render main content for all departments
+    """
+    st.title("All Departments")
+    month_str = util.YYYY_MM_to_month_str(settings["month"])
+    st.header(f"Year to {month_str}", divider="gray")
+    _show_totals(data)
+
+    st.header("Departments", divider="gray")
+    st.caption(
+        "\* Unit of Service (UOS) is each department's UOS if available, otherwise volume. "
+        + "Hours exclude contracted (traveler) hours."
+    )
+    _show_depts_table(data)
+
+
+def _show_totals(data: data.ConsolidatedData):
+    t = data.totals
+    card = st_util.st_card_container(
+        "totals_container", padding_css="18px 16px 0px 16px"
+    )
+    col1, col2, col3, col4 = card.columns(4)
+    col1.metric(
+        "Revenue",
+        util.format_finance(round(t["ytd_revenue"])),
+        f"Budget {util.format_finance(round(t['ytd_budget_revenue']))}",
+        delta_color="off",
+    )
+    col2.metric(
+        "Expense",
+        util.format_finance(round(t["ytd_expense"])),
+        f"Budget {util.format_finance(round(t['ytd_budget_expense']))}",
+        delta_color="off",
+    )
+    col3.metric("Operating Margin", util.format_finance(round(t["ytd_margin"])))
+    col4.metric(
+        f"FTE ({util.YYYY_MM_to_month_str(data.month)})",
+        f"{t['fte']:,.1f}",
+        f"Budget {t['budget_fte']:,.1f}",
+        delta_color="off",
+    )
+
+
+def _show_depts_table(data: data.ConsolidatedData):
+    # Link each row to the department's dashboard
+    df = data.depts.sort_values(by="name")
+    df = df.assign(link="?dept=" + df.index)
+
+    money = lambda label: st.column_config.NumberColumn(label, format="dollar")
+    st.dataframe(
+        df,
+        column_order=[
+            "name",
+            "link",
+            "ytd_revenue",
+            "ytd_budget_revenue",
+            "ytd_expense",
+            "ytd_budget_expense",
+            "ytd_margin",
+            "revenue_per_volume",
+            "variance_revenue_per_volume",
+            "expense_per_volume",
+            "variance_expense_per_volume",
+            "hours_per_volume",
+            "variance_hours_per_volume_pct",
+            "fte",
+            "budget_fte",
+        ],
+        column_config={
+            "name": st.column_config.TextColumn("Department", pinned=True),
+            "link": st.column_config.LinkColumn("Dashboard", display_text="Open"),
+            "ytd_revenue": money("Revenue"),
+            "ytd_budget_revenue": money("Budget Revenue"),
+            "ytd_expense": money("Expense"),
+            "ytd_budget_expense": money("Budget Expense"),
+            "ytd_margin": money("Margin"),
+            "revenue_per_volume": money("Revenue per UOS"),
+            "variance_revenue_per_volume": st.column_config.NumberColumn(
+                "% Variance", format="%d%%"
+            ),
+            "expense_per_volume": money("Expense per UOS"),
+            "variance_expense_per_volume": st.column_config.NumberColumn(
+                "% Variance", format="%d%%"
+            ),
+            "hours_per_volume": st.column_config.NumberColumn(
+                "Hours per UOS", format="%.2f"
+            ),
+            "variance_hours_per_volume_pct": st.column_config.NumberColumn(
+                "% Variance", format="%d%%"
+            ),
+            "fte": st.column_config.NumberColumn("FTE", format="%.1f"),
+            "budget_fte": st.column_config.NumberColumn("Budget FTE", format="%.1f"),
+        },
+        hide_index=True,
+        use_container_width=True,
+        height=35 * (len(df) + 1) + 3,
+    )
@@ -1,6 +1,23 @@
 import pandas as pd
+import numpy as np
 from .income_statement_def import INCOME_STATEMENT_DEF
 
+# Income statement rows that are totaled for KPIs, as lists of path prefixes in the generated
+# income statement "hier" column. Matches the rows summed in dept.base.data._calc_stats().
+KPI_TOTALS = {
+    "revenue": [
+        "Operating Revenues|Patient Revenues",
+        "Operating Revenues|Other",
+    ],
+    "expense": ["Expenses|"],
+    "salary": [
+        "Expenses|Salaries",
+        "Expenses|Professional Fees|60221:Temp Labor",
+        "Expenses|Professional Fees|60222:Locum Tenens",
+    ],
+}
+
+
 def generate_income_stmt(src_df):
     # Create new column that combines Spend and Revenue Categories
     src_df = src_df.copy()
@@ -28,8 +45,9 @@ def generate_income_stmt(src_df):
     for item in INCOME_STATEMENT_DEF:
         _apply_statment_def_item(item, src_df, income_stmt, "")
 
-    if len(src_df["dept_wd_id"].unique()) > 0:
-        # When there is more than one department in the data, sum rows with the same Ledger Account.
+    if src_df.shape[0] > 0:
+        # When there is more than one department in the data, or the data is already totaled
+        # across departments (see dept/base/rollup.py), sum rows with the same Ledger Account.
         # Sort=False to maintain row order as they originally appear.
         income_stmt = (
             income_stmt.groupby(["hier", "Ledger Account"], sort=False, dropna=False)
@@ -191,4 +209,72 @@ def _add_total_row(statement_def_item, income_stmt, path):
         budget,
         actual_ytd,
         budget_ytd,
-    ]    
\ No newline at end of file
+    ]
+
+
+def total_weights(src_df, totals: dict = KPI_TOTALS) -> pd.DataFrame:
+    """
+    Vectorized alternative to generating an income statement and summing rows by path.
+    Returns a dataframe with the same index as src_df, and one column for each named total in
+    totals, containing the multiplier (usually 1, -1 or 0) to apply to that source row's values
+    so that summing them gives the same result as summing the matching income statement rows.
+    """
+    keys = pd.DataFrame(
+        {
+            "ledger_acct": src_df["ledger_acct"].to_numpy(),
+            "category": np.where(
+                src_df["spend_category"] != "",
+                src_df["spend_category"],
+                src_df["revenue_category"],
+            ),
+        }
+    )
+
+    # Calculate multipliers once for each unique ledger account and category combination
+    rules = list(_leaf_rules(INCOME_STATEMENT_DEF, ""))
+    uniq = keys.drop_duplicates().reset_index(drop=True)
+    for name, prefixes in totals.items():
+        matching = [
+            rule
+            for rule in rules
+            if any(rule[0].startswith(prefix.replace("/", "|")) for prefix in prefixes)
+        ]
+        uniq[name] = [
+            sum(
+                sign
+                for _hier, rule_acct, rule_cat, sign in matching
+                if rule_acct == acct and _category_matches(rule_cat, cat)
+            )
+            for acct, cat in zip(uniq["ledger_acct"], uniq["category"])
+        ]
+
+    weights = keys.merge(uniq, on=["ledger_acct", "category"], how="left")
+    weights.index = src_df.index
+    return weights[list(totals.keys())].astype(float)
+
+
+def _leaf_rules(items, path):
+    """
+    Yield (hier, account, category, sign) for each account item in the income statement definition.
+    hier is the path of the row (or header row for category "*") generated by _apply_statment_def_item().
+    """
+    for item in items:
+        if "name" in item and "items" in item:
+            cur_path = item["name"] if path == "" else f"{path}|{item['name']}"
+            yield from _leaf_rules(item["items"], cur_path)
+        if "account" in item:
+            account = item["account"]
+            category = item.get("category")
+            row = account if category in (None, "*") else f"{account}-{category}"
+            hier = row if path == "" else f"{path}|{row}"
+            yield hier, account, category, -1 if item.get("negative") else 1
+
+
+def _category_matches(rule_category, category):
+    if rule_category is None:
+        # No category specified, all rows for the account are included
+        return True
+    if rule_category == "*":
+        # One row for each category. Rows with a missing category are not matched (see _apply_statment_def_item())
+        return not pd.isna(category)
+    return rule_category == category
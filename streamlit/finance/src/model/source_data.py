@@ -1,5 +1,6 @@
 """
-Source data as in-memory copy of all DB tables as dataframes
+Source data as in-memory copy of all DB tables as dataframes, or in query mode, as an open connection to the
+datamart that is queried for each department as needed
 """
 
 import logging
@@ -10,6 +11,7 @@ import streamlit as st
 import requests
 from dataclasses import dataclass, field
 from datetime import datetime, timedelta
+from sqlalchemy import Engine
 from common import source_data_util
 
 # Remote URL in Cloudflare R2
@@ -25,10 +27,14 @@ DATA_JSON = st.secrets.get("DATA_JSON")
 # Encryption key for remote database
 DATA_KEY = st.secrets.get("DATA_KEY")
 
+# Set to "query" to keep the datamart open and query it for each department, instead of reading all tables into
+# memory. Memory use then does not grow with the size of the data, at the cost of a query per department.
+DATA_MODE = st.secrets.get("DATA_MODE", "memory")
+
 
 @dataclass(eq=True)
 class SourceData:
-    """In-memory copy of DB tables"""
+    """In-memory copy of DB tables, or in query mode, a connection to the DB"""
 
     # Metadata
     last_updated: datetime = None
@@ -41,11 +47,42 @@ class SourceData:
     contracted_hours_df: pd.DataFrame = None
     income_stmt_df: pd.DataFrame = None
 
+    # In query mode, an engine for the datamart, and the tables above are not loaded
+    db_engine: Engine = None
+
     contracted_hours_updated_month: str = None
 
+    # Navigation metadata for the sidebar, calculated once from the tables when this object is created.
+    # Range of months in YYYY-MM format from the earliest data to the latest month with volumes, hours
+    # and income statement data.
+    min_month: str = None
+    max_month: str = None
+    # Months with any volumes, hours or income statement data for each cost center, latest first
+    months_by_wd_id: dict = None
+    # Months with income statement data, latest first
+    income_stmt_months: list = None
+
+    def __post_init__(self):
+        tables = [self.volumes_df, self.hours_df, self.income_stmt_df]
+        if any(df is None for df in tables) or self.min_month is not None:
+            return
+
+        self.min_month = min(df["month"].min() for df in tables)
+        self.max_month = min(df["month"].max() for df in tables)
+        months = pd.concat(
+            [df[["dept_wd_id", "month"]] for df in tables], ignore_index=True
+        ).drop_duplicates()
+        months = months.sort_values(by=["month"], ascending=False)
+        self.months_by_wd_id = months.groupby("dept_wd_id")["month"].agg(list).to_dict()
+        self.income_stmt_months = sorted(
+            self.income_stmt_df["month"].dropna().unique(), reverse=True
+        )
+
 
 def read() -> SourceData:
-    if DATA_FILE:
+    if DATA_MODE == "query":
+        src_data = query_file(DATA_FILE, DATA_JSON) if DATA_FILE else query_s3()
+    elif DATA_FILE:
         src_data = from_file(DATA_FILE, DATA_JSON)
     else:
         src_data = from_s3()
@@ -107,3 +144,82 @@ def from_db(db_engine) -> SourceData:
         contracted_hours_df=pd.read_sql_table("contracted_hours", db_engine),
         income_stmt_df=pd.read_sql_table("income_stmt", db_engine),
     )
+
+
+# -------------------------------------------------------
+# Query mode
+# -------------------------------------------------------
+# Decrypted datamart files fetched in query mode, oldest first. The previous file is kept for requests
+# still using the previous version of the data.
+_query_files = []
+
+
+@st.cache_resource(ttl=timedelta(minutes=2))
+def query_file(file: str, json_file: str) -> SourceData:
+    engine = source_data_util.sqlite_pool_engine_from_file(file)
+    src_data = from_db_query(engine)
+    kvdata = source_data_util.json_from_file(json_file)
+    src_data.contracted_hours_updated_month = kvdata.get(
+        "contracted_hours_updated_month"
+    )
+    return src_data
+
+
+@st.cache_resource(ttl=timedelta(hours=6), show_spinner="Loading...")
+def query_s3() -> SourceData:
+    r2_config = source_data_util.S3Config(R2_ACCT_ID, R2_ACCT_KEY, R2_URL)
+    file = source_data_util.sqlite_file_from_s3(
+        r2_config, R2_BUCKET, "prh-finance.sqlite3.enc", DATA_KEY
+    )
+    _query_files.append(file)
+    while len(_query_files) > 2:
+        os.remove(_query_files.pop(0))
+
+    engine = source_data_util.sqlite_pool_engine_from_file(file)
+    src_data = from_db_query(engine)
+    kvdata = source_data_util.json_from_s3(
+        r2_config, R2_BUCKET, "prh-finance.json.enc", DATA_KEY
+    )
+    src_data.contracted_hours_updated_month = kvdata.get(
+        "contracted_hours_updated_month"
+    )
+    return src_data
+
+
+def from_db_query(db_engine: Engine) -> SourceData:
+    """
+    Return source data in query mode for the specified DB connection, which must stay open. Only the metadata
+    for navigation is read. Department data is queried as needed (see dept.base.rollup.QueryRollup).
+    """
+    logging.info("Reading DB metadata")
+    last_updated = pd.read_sql_query("SELECT MAX(modified) FROM meta", db_engine)
+    month_ranges = pd.read_sql_query(
+        """
+        SELECT MIN(month) AS min_month, MAX(month) AS max_month FROM volumes
+        UNION ALL SELECT MIN(month), MAX(month) FROM hours
+        UNION ALL SELECT MIN(month), MAX(month) FROM income_stmt
+        """,
+        db_engine,
+    )
+    months = pd.read_sql_query(
+        """
+        SELECT DISTINCT dept_wd_id, month FROM volumes
+        UNION SELECT DISTINCT dept_wd_id, month FROM hours
+        UNION SELECT DISTINCT dept_wd_id, month FROM income_stmt
+        ORDER BY month DESC
+        """,
+        db_engine,
+    )
+    income_stmt_months = pd.read_sql_query(
+        "SELECT DISTINCT month FROM income_stmt WHERE month IS NOT NULL ORDER BY month DESC",
+        db_engine,
+    )
+
+    return SourceData(
+        last_updated=last_updated.iloc[0, 0],
+        db_engine=db_engine,
+        min_month=month_ranges["min_month"].min(),
+        max_month=month_ranges["max_month"].min(),
+        months_by_wd_id=months.groupby("dept_wd_id")["month"].agg(list).to_dict(),
+        income_stmt_months=income_stmt_months["month"].tolist(),
+    )
@@ -8,6 +8,9 @@ DEFAULT = "default"
 UPDATE = "update"
 FETCH = "fetch"
 
+# ID for the consolidated, hospital-wide dashboard
+ALL_DEPTS = "all"
+
 # IDs for department dashboards
 ALL_CLINICS = "clinics"
 ACUPUNCTURE = "acupuncture"
@@ -152,7 +155,7 @@ def route_by_query(query_params: dict) -> str:
         return FETCH
     if api and api in API:
         return api
-    if dept and dept in DEPTS:
+    if dept and (dept in DEPTS or dept == ALL_DEPTS):
         return dept
 
     return DEFAULT
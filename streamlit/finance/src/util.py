@@ -153,15 +153,19 @@ def fte_hrs_in_year(year: int) -> int:
     )
 
 
+# Month number to full month name, like 1 -> January
+_MONTH_NAMES = {i: calendar.month_name[i] for i in range(1, 13)}
+
+
 # Group a set of data with two columns by month from Jan to Dec. month_col should be the name of a column
 # in the format "2020-01" and value_col the name of the data column.
 def group_data_by_month(src, month_col, value_col):
     # Split source month column in the form 2020-01 into month and year numbers. Year should be a string
-    # instead of number so it can be used as a categorical classifier for plotly graphs
+    # instead of number so it can be used as a categorical classifier for plotly graphs. Slice the strings
+    # rather than parsing them as dates.
     df = pd.DataFrame(columns=["Month", value_col, "Year"])
-    _first_day_of_month = pd.to_datetime(src[month_col])
-    df["Month"] = _first_day_of_month.dt.month_name()
-    df["Year"] = _first_day_of_month.dt.year.astype("str")
+    df["Month"] = src[month_col].str[5:7].astype(int).map(_MONTH_NAMES)
+    df["Year"] = src[month_col].str[:4]
     df[value_col] = src[value_col]
 
     # Sort data by year, so that bars show up in order of year
@@ -0,0 +1,388 @@
+"""
+Run the ingest for every dashboard (*/ingest/ingest_datamart.py) as one job.
+
+Warehouse tables read by more than one dashboard, like prw_patients and prw_encounters_outpt, are extracted once
+into a local cache of parquet files (see common.extract_util.CACHE_DIR_ENV). Each dashboard's ingest starts in its
+own process as soon as the shared tables it reads are extracted, so the transforms run in parallel and dashboards
+that share nothing start right away. Timings for each stage are logged at the end.
+
+Usage, from this directory:
+    python ingest_all.py --prw <warehouse URL> --out-dir out/ [--key KEY --s3url URL --s3auth AUTH]
+        [--only panel residency] [--jobs 4] [--pipeline-args "panel=--max-memory 256 --bulk-load"]
+"""
+
+import sys, os
+
+sys.path.append(os.path.dirname(__file__))
+
+import argparse
+import importlib.util
+import logging
+import multiprocessing
+import shlex
+import shutil
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from dataclasses import dataclass
+from sqlalchemy.engine import make_url
+from prw_common import db_utils
+from common import extract_util
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+@dataclass
+class Pipeline:
+    # Dashboard directory, which has ingest/ingest_datamart.py
+    name: str
+    # Warehouse tables that the ingest reads
+    tables: tuple
+    # Whether the ingest also writes a key/value JSON file (--kv)
+    kv: bool = False
+
+    @property
+    def out_name(self) -> str:
+        """Base name of the output files, as fetched by the dashboard"""
+        return f"prh-{self.name}"
+
+
+PIPELINES = [
+    Pipeline(
+        "finance",
+        (
+            "prw_volumes",
+            "prw_uos",
+            "prw_budget",
+            "prw_hours",
+            "prw_contracted_hours",
+            "prw_income_stmt",
+            "prw_balance_sheet",
+            "prw_aged_ar",
+        ),
+    ),
+    Pipeline(
+        "panel",
+        ("prw_patients", "prw_patient_panels", "prw_encounters_outpt"),
+        kv=True,
+    ),
+    Pipeline(
+        "residency",
+        ("prw_patients", "prw_encounters_outpt", "prw_notes_inpt", "prw_notes_ed"),
+    ),
+    Pipeline(
+        "marketing",
+        ("prw_patients", "prw_patient_panels", "prw_mychart", "prw_encounters_outpt"),
+    ),
+    Pipeline("rvupeds", ("prw_charges",)),
+]
+
+
+def shared_tables(pipelines: list) -> list:
+    """Return the warehouse tables read by more than one of the pipelines, which are extracted once up front"""
+    counts = Counter(table for p in pipelines for table in p.tables)
+    return [table for table, n in counts.items() if n > 1]
+
+
+def pipeline_argv(pipeline: Pipeline, args) -> list:
+    """Return the command line arguments for a pipeline's ingest_datamart.py"""
+    ext = ".enc" if args.key else ""
+    out_dir = os.path.abspath(args.out_dir)
+    argv = [
+        "--prw",
+        args.prw,
+        "--out",
+        os.path.join(out_dir, f"{pipeline.out_name}.sqlite3{ext}"),
+    ]
+    if pipeline.kv:
+        argv += ["--kv", os.path.join(out_dir, f"{pipeline.out_name}.json{ext}")]
+    if args.key:
+        argv += ["--key", args.key]
+    if args.s3url and args.s3auth:
+        argv += ["--s3url", args.s3url, "--s3auth", args.s3auth]
+    argv += ["--report", os.path.join(out_dir, f"{pipeline.out_name}.report.json")]
+    if args.pipelined_publish:
+        argv.append("--pipelined-publish")
+    if args.skip_unchanged:
+        argv.append("--skip-unchanged")
+    return argv + args.extra_args.get(pipeline.name, [])
+
+
+def absolute_sqlite_url(url: str) -> str:
+    """
+    Return url with a relative SQLite file path made absolute, since each ingest runs in its own work directory
+    """
+    parsed = make_url(url)
+    database = parsed.database
+    if (
+        not parsed.drivername.startswith("sqlite")
+        or not database
+        or database == ":memory:"
+        or os.path.isabs(database)
+    ):
+        return url
+    return parsed.set(database=os.path.abspath(database)).render_as_string(
+        hide_password=False
+    )
+
+
+# -------------------------------------------------------
+# Pipeline worker process
+# -------------------------------------------------------
+def run_pipeline(
+    pipeline: Pipeline, argv: list, cache_dir: str, cached_tables: list, work_dir: str
+) -> dict:
+    """
+    Run a pipeline's ingest_datamart.py main() with the given arguments in the current process, reading the
+    shared tables in cached_tables from cache_dir. Each ingest writes its temporary files to the current
+    directory, so it is run in work_dir. Returns the seconds spent in each stage: extract (read_source_tables()), transform, and total.
+    Runs in a separate process for each pipeline, since every dashboard has its own src package.
+    """
+    os.environ[extract_util.CACHE_DIR_ENV] = cache_dir
+    os.environ[extract_util.CACHE_TABLES_ENV] = ",".join(cached_tables)
+    os.makedirs(work_dir, exist_ok=True)
+    os.chdir(work_dir)
+    logging.basicConfig(
+        level=logging.INFO, format=f"[{pipeline.name}] %(message)s", force=True
+    )
+
+    path = os.path.join(BASE_DIR, pipeline.name, "ingest", "ingest_datamart.py")
+    spec = importlib.util.spec_from_file_location("ingest_datamart", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    # main() looks these up as module globals, so wrapping them here times each stage
+    timings = {}
+    module.read_source_tables = _timed(module.read_source_tables, timings, "extract")
+    module.transform = _timed(module.transform, timings, "transform")
+
+    start = time.perf_counter()
+    sys.argv = [path] + argv
+    try:
+        module.main()
+    except SystemExit as e:
+        if e.code:
+            raise RuntimeError(f"{pipeline.name} ingest exited with status {e.code}")
+    timings["total"] = time.perf_counter() - start
+    return timings
+
+
+def _timed(fn, timings: dict, stage: str):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        ret = fn(*args, **kwargs)
+        timings[stage] = time.perf_counter() - start
+        return ret
+
+    return wrapper
+
+
+# -------------------------------------------------------
+# Scheduling
+# -------------------------------------------------------
+def run_all(pipelines: list, args, cache_dir: str, work_dir: str) -> dict:
+    """
+    Extract the shared tables on a thread pool, and start each pipeline in the process pool once the shared
+    tables it reads are extracted. If a table fails to extract, the pipelines that read it still run, and read
+    it from the warehouse themselves.
+
+    Returns a dict of pipeline name to its stage timings, with an "error" key if it failed, and "extract" to a
+    dict of table name to (rows, seconds) for the shared tables that were extracted.
+    """
+    tables = shared_tables(pipelines)
+    # Remove tables kept in cache_dir from an earlier run, so they are never read in place of the warehouse
+    for file in os.listdir(cache_dir):
+        if file.endswith((".parquet", ".parquet.tmp")):
+            os.remove(os.path.join(cache_dir, file))
+
+    pending = {p.name: set(p.tables) & set(tables) for p in pipelines}
+    by_name = {p.name: p for p in pipelines}
+    results = {"extract": {}}
+    prw_engine = db_utils.get_db_connection(args.prw)
+
+    def extract(table):
+        start = time.perf_counter()
+        n_rows = extract_util.extract_to_cache(prw_engine, table, cache_dir)
+        return n_rows, time.perf_counter() - start
+
+    # Each pipeline runs in a new process, so its modules and memory are released when it finishes
+    mp_context = multiprocessing.get_context("spawn")
+    with (
+        ThreadPoolExecutor(max_workers=max(1, args.workers)) as extract_pool,
+        ProcessPoolExecutor(
+            max_workers=args.jobs, mp_context=mp_context, max_tasks_per_child=1
+        ) as pipeline_pool,
+    ):
+        futures = {
+            extract_pool.submit(extract, table): ("extract", table) for table in tables
+        }
+
+        def submit_ready():
+            for name in [name for name, waiting in pending.items() if not waiting]:
+                del pending[name]
+                argv = pipeline_argv(by_name[name], args)
+                future = pipeline_pool.submit(
+                    run_pipeline,
+                    by_name[name],
+                    argv,
+                    cache_dir,
+                    sorted(set(by_name[name].tables) & set(results["extract"])),
+                    os.path.join(work_dir, name),
+                )
+                futures[future] = ("pipeline", name)
+
+        submit_ready()
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                kind, name = futures.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logging.error(f"ERROR: {kind} {name} failed: {e}")
+                    result = {"error": str(e)}
+
+                if kind == "extract":
+                    if "error" not in result:
+                        results["extract"][name] = result
+                    for waiting in pending.values():
+                        waiting.discard(name)
+                else:
+                    results[name] = result
+            submit_ready()
+
+    prw_engine.dispose()
+    return results
+
+
+def log_timings(results: dict, pipelines: list, total_secs: float):
+    lines = ["Stage timings:"]
+    for table, (n_rows, secs) in results["extract"].items():
+        lines.append(f"  extract {table}: {n_rows:,} rows in {secs:.1f}s")
+    for p in pipelines:
+        t = results.get(p.name, {})
+        if "error" in t:
+            lines.append(f"  {p.name}: FAILED ({t['error']})")
+            continue
+        extract, transform = t.get("extract", 0), t.get("transform", 0)
+        rest = t["total"] - extract - transform
+        lines.append(
+            f"  {p.name}: extract {extract:.1f}s, transform {transform:.1f}s, "
+            + f"load/encrypt/upload {rest:.1f}s, total {t['total']:.1f}s"
+        )
+    lines.append(f"  all: {total_secs:.1f}s")
+    logging.info("\n".join(lines))
+
+
+# -------------------------------------------------------
+# Main entry point
+# -------------------------------------------------------
+def parse_arguments():
+    names = [p.name for p in PIPELINES]
+    parser = argparse.ArgumentParser(
+        description="Ingest data from PRW warehouse to the datamarts for all dashboards."
+    )
+    parser.add_argument("--prw", required=True, help="PRW warehouse DB URL")
+    parser.add_argument(
+        "--out-dir",
+        required=True,
+        help="Output directory. Files are named as fetched by the dashboards, e.g. prh-panel.sqlite3.enc, with "
+        + "each ingest's run report (see common.profile_util) in <name>.report.json.",
+    )
+    parser.add_argument(
+        "--key",
+        help="Encrypt with given key. Must be specified to upload to S3. Defaults to no encryption if not specified.",
+    )
+    parser.add_argument("--s3url", help="S3 URL to upload output files to")
+    parser.add_argument("--s3auth", help="S3 authentication for uploads")
+    parser.add_argument(
+        "--pipelined-publish",
+        action="store_true",
+        help="Pass --pipelined-publish to every ingest, to upload output files to S3 as they are encrypted",
+    )
+    parser.add_argument(
+        "--skip-unchanged",
+        action="store_true",
+        help="Pass --skip-unchanged to every ingest, to skip publishing datamarts that have not changed",
+    )
+    parser.add_argument(
+        "--only",
+        nargs="+",
+        choices=names,
+        help="Dashboards to ingest. Defaults to all.",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of dashboard ingests to run at the same time. Defaults to the number of CPUs.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=extract_util.DEFAULT_WORKERS,
+        help="Number of shared tables to extract from the warehouse at the same time",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="Directory for the extracted shared tables, which is kept after the run. Defaults to a temporary "
+        + "directory that is removed.",
+    )
+    parser.add_argument(
+        "--pipeline-args",
+        action="append",
+        default=[],
+        metavar="NAME=ARGS",
+        help='Extra arguments for one dashboard\'s ingest_datamart.py, e.g. "panel=--max-memory 256". '
+        + "Can be repeated.",
+    )
+    args = parser.parse_args()
+
+    args.extra_args = {}
+    for value in args.pipeline_args:
+        name, _, extra = value.partition("=")
+        if name not in names:
+            parser.error(f"--pipeline-args: unknown dashboard {name}")
+        args.extra_args[name] = args.extra_args.get(name, []) + shlex.split(extra)
+    return args
+
+
+def main():
+    args = parse_arguments()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    args.prw = absolute_sqlite_url(args.prw)
+    pipelines = [p for p in PIPELINES if not args.only or p.name in args.only]
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    cache_dir = args.cache_dir or tempfile.mkdtemp(prefix="prw-extract-")
+    os.makedirs(cache_dir, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix="prw-ingest-")
+    logging.info(
+        f"Ingesting {', '.join(p.name for p in pipelines)}, shared tables: "
+        + f"{', '.join(shared_tables(pipelines)) or 'none'}"
+    )
+
+    start = time.perf_counter()
+    try:
+        results = run_all(pipelines, args, os.path.abspath(cache_dir), work_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        if not args.cache_dir:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+    log_timings(results, pipelines, time.perf_counter() - start)
+
+    failed = [p.name for p in pipelines if "error" in results.get(p.name, {})]
+    if failed:
+        logging.error(f"ERROR: failed to ingest {', '.join(failed)}")
+        exit(1)
+    logging.info("Done")
+
+
+if __name__ == "__main__":
+    main()
@@ -14,6 +14,7 @@ from prw_common import db_utils
 from prw_common import cli_utils
 from prw_common.encrypt import encrypt_file
 from prw_common.remote_utils import upload_file_to_s3
+from common import extract_util, profile_util, publish_util
 
 
 # -------------------------------------------------------
@@ -37,51 +38,61 @@ class OutData:
 # -------------------------------------------------------
 # Extract
 # -------------------------------------------------------
-def read_source_tables(prw_engine) -> SrcData:
+ENCOUNTER_COLUMNS = [
+    "prw_id",
+    "dept",
+    "encounter_date",
+    "encounter_age",
+    "encounter_type",
+    "appt_status",
+]
+
+
+def read_source_tables(
+    prw_engine, workers: int = extract_util.DEFAULT_WORKERS
+) -> SrcData:
     """
-    Read source tables from the warehouse DB
+    Read source tables from the warehouse DB, reading up to workers tables at the same time
     """
     logging.info("Reading source tables")
 
-    patients_df = pd.read_sql_query(
-        select(
-            text("prw_id"),
-            text("age"),
-        ).select_from(text("prw_patients")),
-        prw_engine,
-    )
-
-    panel_df = pd.read_sql_query(
-        select(
-            text("prw_id"),
-            text("panel_location"),
-            text("panel_provider"),
-        ).select_from(text("prw_patient_panels")),
-        prw_engine,
-    )
-
-    mychart_df = pd.read_sql_query(
-        select(
-            text("prw_id"),
-            text("mychart_status"),
-            text("mychart_activation_date"),
-        ).select_from(text("prw_mychart")),
-        prw_engine,
-    )
-
-    encounters_df = pd.read_sql_query(
-        select(
-            text("prw_id"),
-            text("dept"),
-            text("encounter_date"),
-            text("encounter_age"),
-            text("encounter_type"),
-            text("appt_status"),
+    def encounters_reader(conn):
+        # Filter in the DB, unless the table was already extracted by the ingest orchestrator
+        if extract_util.cached_table_path("prw_encounters_outpt"):
+            df = extract_util.read_table(
+                conn, "prw_encounters_outpt", columns=ENCOUNTER_COLUMNS
+            )
+            df = df[df["appt_status"].isin(["Completed", "No Show"])]
+            return df.reset_index(drop=True)
+        return pd.read_sql_query(
+            select(*[text(c) for c in ENCOUNTER_COLUMNS])
+            .select_from(text("prw_encounters_outpt"))
+            .where(text("appt_status = 'Completed' or appt_status = 'No Show'")),
+            conn,
         )
-        .select_from(text("prw_encounters_outpt"))
-        .where(text("appt_status = 'Completed' or appt_status = 'No Show'")),
+
+    tables = extract_util.read_tables(
         prw_engine,
+        {
+            "patients_df": extract_util.table_reader(
+                "prw_patients", columns=["prw_id", "age"]
+            ),
+            "panel_df": extract_util.table_reader(
+                "prw_patient_panels",
+                columns=["prw_id", "panel_location", "panel_provider"],
+            ),
+            "mychart_df": extract_util.table_reader(
+                "prw_mychart",
+                columns=["prw_id", "mychart_status", "mychart_activation_date"],
+            ),
+            "encounters_df": encounters_reader,
+        },
+        workers,
     )
+    patients_df = tables["patients_df"]
+    panel_df = tables["panel_df"]
+    mychart_df = tables["mychart_df"]
+    encounters_df = tables["encounters_df"]
 
     # Set datetime column types
     mychart_df["mychart_activation_date"] = pd.to_datetime(
@@ -135,6 +146,27 @@ def parse_arguments():
         "--key",
         help="Encrypt with given key. Defaults to no encryption if not specified.",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=extract_util.DEFAULT_WORKERS,
+        help="Number of source tables to read from the warehouse at the same time",
+    )
+    parser.add_argument(
+        "--pipelined-publish",
+        action="store_true",
+        help="Encrypt output files in chunks and upload them to S3 as they are encrypted, all files in parallel. "
+        + "Requires dashboards that read chunk encrypted files (common.publish_util.decrypt()).",
+    )
+    parser.add_argument(
+        "--skip-unchanged",
+        action="store_true",
+        help="Skip encrypting and uploading if the datamart content is the same as the last published version",
+    )
+    parser.add_argument(
+        "--report",
+        help="Write a JSON run report with the time, CPU and memory used by each stage to this path",
+    )
     return parser.parse_args()
 
 
@@ -151,10 +183,10 @@ def main():
     s3_url = args.s3url
     s3_auth = args.s3auth
     tmp_db_file = "datamart.sqlite3"
+    profiler = profile_util.StageProfiler("marketing")
 
     logging.info(
-        f"Input: {db_utils.mask_conn_pw(prw_db_url)}, output: {output_db_file}, encrypt: {encrypt_key is not None}, upload: {s3_url}",
-        flush=True,
+        f"Input: {db_utils.mask_conn_pw(prw_db_url)}, output: {output_db_file}, encrypt: {encrypt_key is not None}, upload: {s3_url}"
     )
 
     # Create the sqlite output database and create the tables as defined in ../src/model/db.py
@@ -163,33 +195,62 @@ def main():
 
     # Read from PRW warehouse (MSSQL in prod, sqlite in dev)
     prw_engine = db_utils.get_db_connection(prw_db_url)
-    src = read_source_tables(prw_engine)
+    with profiler.stage("extract"):
+        src = read_source_tables(prw_engine, args.workers)
     if src is None:
         error_exit("ERROR: failed to read source data (see above)")
 
     # Transform data
-    out = transform(src)
+    with profiler.stage("transform"):
+        out = transform(src)
 
     # Write tables to datamart
-    session = Session(out_engine)
-    db_utils.clear_tables_and_insert_data(
-        session,
-        [
-            db_utils.TableData(table=db.Patients, df=out.patients_df),
-            db_utils.TableData(table=db.Encounters, df=out.encounters_df),
-            db_utils.TableData(table=db.NoShows, df=out.no_shows_df),
-        ],
-    )
-
-    # Update last ingest time and modified times for source data files
-    db_utils.write_meta(session, db.Meta)
-    session.commit()
+    with profiler.stage("load"):
+        session = Session(out_engine)
+        db_utils.clear_tables_and_insert_data(
+            session,
+            [
+                db_utils.TableData(table=db.Patients, df=out.patients_df),
+                db_utils.TableData(table=db.Encounters, df=out.encounters_df),
+                db_utils.TableData(table=db.NoShows, df=out.no_shows_df),
+            ],
+        )
 
-    # Finally encrypt output files, or just copy if no encryption key is provided
-    if encrypt_key and encrypt_key.lower() != "none":
-        encrypt_file(tmp_db_file, output_db_file, encrypt_key)
-    else:
-        shutil.copy(tmp_db_file, output_db_file)
+        # Update last ingest time and modified times for source data files
+        db_utils.write_meta(session, db.Meta)
+        session.commit()
+
+    # Store rows per table and the stages so far in the meta table
+    profiler.count_rows(out_engine)
+    profiler.write_meta(out_engine)
+
+    # With --skip-unchanged, compare a hash of the content with the manifest of the last published version, and
+    # skip encrypting and uploading if they are the same
+    upload = encrypt_key and s3_url and s3_auth
+    s3_args = (s3_url, s3_auth) if upload else ()
+    content_hash, unchanged = None, False
+    if args.skip_unchanged:
+        with profiler.stage("hash"):
+            content_hash = publish_util.content_hash(tmp_db_file)
+            unchanged = publish_util.is_published(
+                content_hash, output_db_file, *s3_args
+            )
+
+    # Finally encrypt output files, or just copy if no encryption key is provided. With --pipelined-publish,
+    # files are uploaded to S3 as they are encrypted.
+    with profiler.stage("publish" if args.pipelined_publish else "encrypt"):
+        if unchanged:
+            logging.info(
+                "Content is unchanged since the last publish, skipping encrypt and upload"
+            )
+        elif encrypt_key and args.pipelined_publish:
+            publish_util.publish(
+                [(tmp_db_file, output_db_file)], encrypt_key, s3_url, s3_auth
+            )
+        elif encrypt_key and encrypt_key.lower() != "none":
+            encrypt_file(tmp_db_file, output_db_file, encrypt_key)
+        else:
+            shutil.copy(tmp_db_file, output_db_file)
 
     # Cleanup
     os.remove(tmp_db_file)
@@ -197,9 +258,16 @@ def main():
     out_engine.dispose()
 
     # Upload to S3. Only upload encrypted content.
-    if encrypt_key and s3_url and s3_auth:
-        upload_file_to_s3(s3_url, s3_auth, output_db_file)
+    if upload and not unchanged and not args.pipelined_publish:
+        with profiler.stage("upload"):
+            upload_file_to_s3(s3_url, s3_auth, output_db_file)
+
+    # Record the published content, for the next run with --skip-unchanged
+    if content_hash and not unchanged:
+        publish_util.write_manifest(content_hash, output_db_file, *s3_args)
 
+    profiler.add_files(output_db_file)
+    profiler.write_report(args.report)
     logging.info("Done")
 
 
@@ -0,0 +1,192 @@
+"""
+Benchmarks for the panel ingest, using synthetic data with the same schema as the datamart.
+
+Usage, from this directory:
+    python bench.py load [--patients 100000]
+    python bench.py transform [--patients 100000]
+"""
+
+# Add main repo directory to include path to access common/ modules
+import sys, os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import argparse
+import logging
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from datetime import datetime
+
+
+# -------------------------------------------------------
+# Synthetic data
+# -------------------------------------------------------
+def synthetic_encounters(
+    patients: int = 100000, encounters_per_patient: int = 10, seed: int = 0
+) -> pd.DataFrame:
+    """
+    Generate office visits with the same columns as the datamart encounters table, over the last 3 years
+    """
+    rng = np.random.default_rng(seed)
+    n = patients * encounters_per_patient
+    clinics = np.array(["CLINIC A", "CLINIC B", "CLINIC C", "CLINIC D"])
+    providers = np.array([f"Provider {i}, MD" for i in range(40)] + [None])
+    start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    age = rng.integers(0, 100, n)
+    return pd.DataFrame(
+        {
+            "prw_id": [f"PRW{i:08d}" for i in rng.integers(0, patients, n)],
+            "location": clinics[rng.integers(0, len(clinics), n)],
+            "encounter_date": pd.Timestamp(start)
+            - pd.to_timedelta(rng.integers(0, 3 * 365, n), unit="D"),
+            "encounter_age": age,
+            "encounter_age_in_mo_under_3": np.where(
+                age < 3, age * 12 + rng.integers(0, 12, n), np.nan
+            ),
+            "encounter_type": "Office Visit",
+            "service_provider": providers[rng.integers(0, len(providers), n)],
+            "with_pcp": rng.random(n) < 0.7,
+            "diagnoses": "Encounter for general adult medical examination",
+            "diagnoses_icd": "Z00.00",
+            "level_of_service": "LVL 3",
+        }
+    )
+
+
+def synthetic_src_data(patients: int = 100000, seed: int = 0):
+    """
+    Generate ingest source data: patients, their panel assignments, and 3 years of encounters as returned by
+    ingest_datamart.read_source_tables()
+    """
+    from ingest import ingest_datamart
+
+    rng = np.random.default_rng(seed)
+    encounters_df = synthetic_encounters(patients=patients, seed=seed)
+    clinics = np.array(list(ingest_datamart.CLINIC_IDS.values()))
+    encounters_df["location"] = clinics[
+        rng.integers(0, len(clinics), len(encounters_df))
+    ]
+    encounters_df["encounter_type"] = np.array(
+        ["CC OFFICE VISIT", "CC WELL CHILD", "CC LAB"]
+    )[rng.integers(0, 3, len(encounters_df))]
+
+    prw_ids = [f"PRW{i:08d}" for i in range(patients)]
+    age = rng.integers(0, 100, patients)
+    patients_df = pd.DataFrame(
+        {
+            "prw_id": prw_ids,
+            "sex": np.array(["Male", "Female"])[rng.integers(0, 2, patients)],
+            "age": age,
+            "age_in_mo_under_3": np.where(
+                age < 3, age * 12 + rng.integers(0, 12, patients), np.nan
+            ),
+            "city": "pullman",
+            "state": "wa",
+            "pcp": None,
+        }
+    )
+    providers = np.array([f"Provider {i}, MD" for i in range(40)] + [None])
+    patient_panel_df = pd.DataFrame(
+        {
+            "prw_id": prw_ids,
+            "panel_location": clinics[rng.integers(0, len(clinics), patients)],
+            "panel_provider": providers[rng.integers(0, len(providers), patients)],
+            "assignment_details": "Rule 1: Visits with provider",
+        }
+    )
+    return ingest_datamart.SrcData(
+        patients_df=patients_df,
+        patient_panel_df=patient_panel_df,
+        encounters_df=encounters_df,
+    )
+
+
+def _time_load(metadata, write) -> float:
+    """Return the wall time in seconds of write(engine) on a new datamart file with the tables in metadata"""
+    from prw_common import db_utils
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        engine = db_utils.get_db_connection(f"sqlite:///{tmp_dir}/datamart.sqlite3")
+        metadata.create_all(engine)
+        start = time.perf_counter()
+        write(engine)
+        elapsed = time.perf_counter() - start
+        engine.dispose()
+    return elapsed
+
+
+# -------------------------------------------------------
+# Benchmarks
+# -------------------------------------------------------
+def bench_load(args):
+    """
+    Writing the encounters table to a new datamart file, using db_utils.clear_tables_and_insert_data(), as the
+    ingest does by default, and common.load_util.bulk_load() (ingest_datamart.py --bulk-load)
+    """
+    from sqlmodel import Session
+    from prw_common import db_utils
+    from common import load_util
+    from src.model import db
+
+    encounters_df = synthetic_encounters(patients=args.patients)
+    tables = [db_utils.TableData(table=db.Encounter, df=encounters_df)]
+
+    def insert(engine):
+        with Session(engine) as session:
+            db_utils.clear_tables_and_insert_data(session, tables)
+            session.commit()
+
+    def bulk_load(engine):
+        load_util.bulk_load(engine, tables)
+
+    metadata = db.DatamartModel.metadata
+    before = min(_time_load(metadata, insert) for _ in range(3))
+    after = min(_time_load(metadata, bulk_load) for _ in range(3))
+    logging.info(
+        f"load: {encounters_df.shape[0]:,} encounters rows, clear_tables_and_insert_data {before:.2f}s, "
+        + f"bulk_load {after:.2f}s ({before / after:.1f}x)"
+    )
+
+
+def bench_transform(args):
+    """
+    ingest_datamart.transform() on 3 years of encounters
+    """
+    from ingest import ingest_datamart
+
+    src = synthetic_src_data(patients=args.patients)
+    elapsed = []
+    for _ in range(3):
+        start = time.perf_counter()
+        ingest_datamart.transform(src)
+        elapsed.append(time.perf_counter() - start)
+    logging.info(
+        f"transform: {src.patients_df.shape[0]:,} patients, {src.encounters_df.shape[0]:,} encounters rows, "
+        + f"{min(elapsed):.2f}s"
+    )
+
+
+BENCHMARKS = {
+    "load": bench_load,
+    "transform": bench_transform,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Panel ingest benchmarks.")
+    parser.add_argument("benchmark", choices=BENCHMARKS.keys())
+    parser.add_argument(
+        "--patients",
+        type=int,
+        default=100000,
+        help="Number of patients in synthetic data, with 10 encounters each",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    main()
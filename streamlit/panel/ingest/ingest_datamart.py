@@ -7,15 +7,17 @@ sys.path.append(os.path.join(os.path.dirname(__file__), "..", ".."))
 import shutil
 import json
 import logging
+import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta
 from dataclasses import dataclass
 from sqlmodel import Session
-from src.model import db
+from src.model import db, continuity, encounter_stats
 from prw_common import db_utils
 from prw_common import cli_utils
 from prw_common.encrypt import encrypt_file
 from prw_common.remote_utils import upload_file_to_s3
+from common import extract_util, load_util, profile_util, publish_util
 
 
 # -------------------------------------------------------
@@ -33,6 +35,7 @@ class OutData:
     patients_df: pd.DataFrame
     encounters_df: pd.DataFrame
     new_patients_by_month: pd.DataFrame
+    provider_continuity_df: pd.DataFrame
 
     kv: dict
 
@@ -40,25 +43,73 @@ class OutData:
 # -------------------------------------------------------
 # Extract
 # -------------------------------------------------------
-def read_source_tables(prw_engine) -> SrcData:
+def read_source_tables(
+    prw_engine,
+    workers: int = extract_util.DEFAULT_WORKERS,
+    max_memory_mb: float = None,
+) -> SrcData:
     """
-    Read source tables from the warehouse DB
+    Read source tables from the warehouse DB, reading up to workers tables at the same time.
+    Encounters are filtered as they are read (see filter_encounters()). If max_memory_mb is given, encounters
+    are read and filtered in chunks of about that size, so the whole table is never in memory.
     """
     logging.info("Reading source tables")
 
-    patients_df = pd.read_sql_table("prw_patients", prw_engine, index_col="id")
-    patient_panel_df = pd.read_sql_table(
-        "prw_patient_panels", prw_engine, index_col="id"
-    )
-    encounters_df = pd.read_sql_table(
-        "prw_encounters_outpt", prw_engine, index_col="id"
+    # Limit encounters to the last 3 years
+    min_date = datetime.now() - timedelta(days=1095)
+    if max_memory_mb:
+        encounters_reader = extract_util.chunked_reader(
+            "prw_encounters_outpt",
+            max_memory_mb,
+            lambda df: filter_encounters(df, min_date),
+            index_col="id",
+        )
+    else:
+        encounters_reader = lambda conn: filter_encounters(
+            extract_util.read_table(conn, "prw_encounters_outpt", index_col="id"),
+            min_date,
+        )
+
+    tables = extract_util.read_tables(
+        prw_engine,
+        {
+            "patients_df": extract_util.table_reader("prw_patients", index_col="id"),
+            "patient_panel_df": extract_util.table_reader(
+                "prw_patient_panels", index_col="id"
+            ),
+            "encounters_df": encounters_reader,
+        },
+        workers,
     )
-    return SrcData(
-        patients_df=patients_df,
-        patient_panel_df=patient_panel_df,
-        encounters_df=encounters_df,
+    return SrcData(**tables)
+
+
+def filter_encounters(encounters_df: pd.DataFrame, min_date: datetime) -> pd.DataFrame:
+    """
+    Keep completed encounters at PCP clinics on or after min_date, with the location column set to the clinic ID.
+    Each row is handled independently, so this can be applied to chunks of the encounters table.
+    """
+    # Only consider completed encounters
+    encounters_df = encounters_df[encounters_df.appt_status == "Completed"].copy()
+
+    # Force date columns to be date only, no time
+    encounters_df["encounter_date"] = pd.to_datetime(encounters_df["encounter_date"])
+    # Map encounter location to clinic IDs, dropping encounters at non-PCP offices
+    encounters_df["location"] = encounters_df["dept"].map(CLINIC_IDS)
+    encounters_df = encounters_df[encounters_df["location"].notnull()]
+
+    # Delete unused columns: dept, encounter_time, billing_provider, appt_status
+    encounters_df = encounters_df.drop(
+        columns=[
+            "dept",
+            "encounter_time",
+            "billing_provider",
+            "appt_status",
+        ],
     )
 
+    return encounters_df[encounters_df["encounter_date"] >= min_date]
+
 
 # -------------------------------------------------------
 # Transform
@@ -72,41 +123,53 @@ CLINIC_IDS = {
     "CC WPL PALOUSE MED PRIMARY CARE": "Palouse Medical",
 }
 
+# Clinics whose locations are counted together for new patient volumes
+COMBINED_CLINICS = {
+    "Palouse Pediatrics Pullman": "Palouse Pediatrics",
+    "Palouse Pediatrics Moscow": "Palouse Pediatrics",
+    "Pullman Family Medicine (Palouse Health Center)": "Pullman Family Medicine",
+}
+
 
 def transform(src: SrcData) -> OutData:
     """
     Transform source data into datamart tables
     """
     logging.info("Transforming data")
-    # Patients
-    patients_df = src.patients_df.copy()
+    # Encounters were already limited to completed PCP office encounters in the last 3 years when read
+    # (see filter_encounters()). Limit patients to those with encounters.
+    encounters_df = src.encounters_df
+    patients_df = src.patients_df[
+        src.patients_df["prw_id"].isin(encounters_df["prw_id"])
+    ].copy()
 
     # age (floor of age in years) and age_in_mo (if < 2 years old)
-    patients_df["age_display"] = patients_df.apply(
-        lambda row: (
-            f"{int(row['age_in_mo_under_3'])} mo" if row["age"] < 2 else str(row["age"])
-        ),
-        axis=1,
+    under_2 = patients_df["age"] < 2
+    patients_df["age_display"] = np.where(
+        under_2,
+        patients_df["age_in_mo_under_3"].where(under_2, 0).astype(int).astype(str)
+        + " mo",
+        patients_df["age"].astype(str),
     )
 
     # Combine city and state into location column
-    patients_df["city"] = patients_df["city"].str.title()
-    patients_df["state"] = patients_df["state"].str.upper()
-    patients_df["location"] = patients_df["city"] + ", " + patients_df["state"]
-
-    # Copy panel_location and panel_provider from patient_panel_df based on prw_id
-    patients_df["panel_location"] = patients_df["prw_id"].map(
-        src.patient_panel_df.set_index("prw_id")["panel_location"]
-    )
-    patients_df["panel_provider"] = patients_df["prw_id"].map(
-        src.patient_panel_df.set_index("prw_id")["panel_provider"]
+    patients_df["location"] = (
+        patients_df["city"].str.title() + ", " + patients_df["state"].str.upper()
     )
-    patients_df["panel_assignment_rule"] = patients_df["prw_id"].map(
-        src.patient_panel_df.set_index("prw_id")["assignment_details"]
+
+    # Copy panel_location, panel_provider and the assignment rule from patient_panel_df based on prw_id.
+    # Raises if a patient has more than one panel row, rather than duplicating the patient.
+    panel_df = src.patient_panel_df[
+        ["prw_id", "panel_location", "panel_provider"]
+    ].assign(
+        panel_assignment_rule=src.patient_panel_df["assignment_details"]
         .fillna("")
         .str.split(":", n=1)
         .str[0]
     )
+    patients_df = patients_df.join(
+        panel_df.set_index("prw_id", verify_integrity=True), on="prw_id"
+    )
 
     # Delete unused columns
     patients_df.drop(
@@ -117,34 +180,6 @@ def transform(src: SrcData) -> OutData:
         inplace=True,
     )
 
-    # Only consider completed encounters
-    encounters_df = src.encounters_df[
-        src.encounters_df.appt_status == "Completed"
-    ].copy()
-
-    # Force date columns to be date only, no time
-    encounters_df["encounter_date"] = pd.to_datetime(encounters_df["encounter_date"])
-    # Map encounter location to clinic IDs, dropping encounters at non-PCP offices
-    encounters_df["location"] = encounters_df["dept"].map(CLINIC_IDS)
-    encounters_df = encounters_df[encounters_df["location"].notnull()]
-
-    # Delete unused columns: dept, encounter_time, billing_provider, appt_status
-    encounters_df.drop(
-        columns=[
-            "dept",
-            "encounter_time",
-            "billing_provider",
-            "appt_status",
-        ],
-        inplace=True,
-    )
-
-    # Limit to patients and encounters to the last 3 years
-    encounters_df = encounters_df[
-        encounters_df["encounter_date"] >= (datetime.now() - timedelta(days=1095))
-    ]
-    patients_df = patients_df[patients_df["prw_id"].isin(encounters_df["prw_id"])]
-
     # --------------------------------------------------------------------------
     # Filter to only include office visits
     # --------------------------------------------------------------------------
@@ -181,37 +216,25 @@ def transform(src: SrcData) -> OutData:
         encounters_df["encounter_type"].isin(office_visit_types)
     ]
 
+    # --------------------------------------------------------------------------
+    # Per-patient encounter stats, stored so the dashboard does not recompute them on every rerun
+    # --------------------------------------------------------------------------
+    patients_df = encounter_stats.add_encounter_stats(
+        patients_df, office_visits_df, datetime.now()
+    )
+
     # --------------------------------------------------------------------------
     # Calculate monthly new patient volumes
     # --------------------------------------------------------------------------
     # Combine visit counts for Palouse Pediatrics locations and Pullman Family Medicine locations
-    peds_locations = ["Palouse Pediatrics Pullman", "Palouse Pediatrics Moscow"]
-    pfm_locations = [
-        "Pullman Family Medicine",
-        "Pullman Family Medicine (Palouse Health Center)",
-    ]
-    combined_clinic_visits_df = office_visits_df.copy()
-    combined_clinic_visits_df["clinic"] = combined_clinic_visits_df["location"].map(
-        lambda x: "Palouse Pediatrics" if x in peds_locations else x
-    )
-    combined_clinic_visits_df = combined_clinic_visits_df.map(
-        lambda x: "Pullman Family Medicine" if x in pfm_locations else x
+    combined_clinic_visits_df = office_visits_df[["prw_id", "encounter_date"]].assign(
+        clinic=office_visits_df["location"].replace(COMBINED_CLINICS)
     )
 
-    # Deduplicate visits to one per location per day. Use a key with {id}_{clinic}_{date} to group.
-    combined_clinic_visits_df["patient_day"] = (
-        combined_clinic_visits_df["prw_id"]
-        + "_"
-        + combined_clinic_visits_df["clinic"]
-        + "_"
-        + combined_clinic_visits_df["encounter_date"].dt.strftime("%Y%m%d")
-    )
+    # Deduplicate visits to one per location per day. Encounter dates have no time, so this is one per date.
     deduplicated_visits = combined_clinic_visits_df.drop_duplicates(
-        subset=["patient_day"]
-    )
-    deduplicated_visits["year_month"] = deduplicated_visits[
-        "encounter_date"
-    ].dt.strftime("%Y-%m")
+        subset=["prw_id", "clinic", "encounter_date"]
+    ).assign(year_month=lambda df: df["encounter_date"].dt.to_period("M").astype(str))
 
     # Get the first visit date for each patient
     first_visits = (
@@ -278,10 +301,21 @@ def transform(src: SrcData) -> OutData:
             provider for provider in panel_providers if provider is not None
         ]
 
+    # --------------------------------------------------------------------------
+    # Provider continuity table for each clinic that can be selected in the dashboard, with all providers
+    # --------------------------------------------------------------------------
+    provider_continuity_df = continuity.provider_continuity_by_clinic(
+        patients_df,
+        office_visits_df,
+        ["All Clinics"] + clinics + ["Unassigned"],
+        datetime.now(),
+    )
+
     return OutData(
         patients_df=patients_df,
         encounters_df=office_visits_df,
         new_patients_by_month=new_patients_by_month,
+        provider_continuity_df=provider_continuity_df,
         kv={
             "clinics": list(clinics),
             "providers": providers_by_clinic,
@@ -308,6 +342,38 @@ def parse_arguments():
         "--key",
         help="Encrypt with given key. Defaults to no encryption if not specified.",
     )
+    parser.add_argument(
+        "--max-memory",
+        type=float,
+        metavar="MB",
+        help="Read the encounters table in chunks of about this many MB, instead of all at once",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=extract_util.DEFAULT_WORKERS,
+        help="Number of source tables to read from the warehouse at the same time",
+    )
+    parser.add_argument(
+        "--bulk-load",
+        action="store_true",
+        help="Write the datamart with loading PRAGMAs and executemany(), and build indexes after loading",
+    )
+    parser.add_argument(
+        "--pipelined-publish",
+        action="store_true",
+        help="Encrypt output files in chunks and upload them to S3 as they are encrypted, all files in parallel. "
+        + "Requires dashboards that read chunk encrypted files (common.publish_util.decrypt()).",
+    )
+    parser.add_argument(
+        "--skip-unchanged",
+        action="store_true",
+        help="Skip encrypting and uploading if the datamart content is the same as the last published version",
+    )
+    parser.add_argument(
+        "--report",
+        help="Write a JSON run report with the time, CPU and memory used by each stage to this path",
+    )
     return parser.parse_args()
 
 
@@ -326,10 +392,10 @@ def main():
     s3_auth = args.s3auth
     tmp_db_file = "datamart.sqlite3"
     tmp_kv_file = "datamart.json"
+    profiler = profile_util.StageProfiler("panel")
 
     logging.info(
-        f"Input: {db_utils.mask_conn_pw(prw_db_url)}, output: {output_db_file}, encrypt: {encrypt_key is not None}, upload: {s3_url}",
-        flush=True,
+        f"Input: {db_utils.mask_conn_pw(prw_db_url)}, output: {output_db_file}, encrypt: {encrypt_key is not None}, upload: {s3_url}"
     )
 
     # Create the sqlite output database and create the tables as defined in ../src/model/db.py
@@ -338,39 +404,75 @@ def main():
 
     # Read from PRW warehouse (MSSQL in prod, sqlite in dev)
     prw_engine = db_utils.get_db_connection(prw_db_url)
-    src = read_source_tables(prw_engine)
+    with profiler.stage("extract"):
+        src = read_source_tables(prw_engine, args.workers, args.max_memory)
     if src is None:
         error_exit("ERROR: failed to read source data (see above)")
 
     # Transform data
-    out = transform(src)
+    with profiler.stage("transform"):
+        out = transform(src)
 
     # Write tables to datamart
-    session = Session(out_engine)
-    db_utils.clear_tables_and_insert_data(
-        session,
-        [
+    with profiler.stage("load"):
+        session = Session(out_engine)
+        tables = [
             db_utils.TableData(table=db.Patient, df=out.patients_df),
             db_utils.TableData(table=db.Encounter, df=out.encounters_df),
             db_utils.TableData(table=db.NewPatients, df=out.new_patients_by_month),
-        ],
-    )
-
-    # Update last ingest time and modified times for source data files
-    db_utils.write_meta(session, db.Meta)
-    session.commit()
-
-    # Write to the output key/value file as JSON
-    with open(tmp_kv_file, "w") as f:
-        json.dump(out.kv, f, indent=2)
-
-    # Finally encrypt output files, or just copy if no encryption key is provided
-    if encrypt_key and encrypt_key.lower() != "none":
-        encrypt_file(tmp_db_file, output_db_file, encrypt_key)
-        encrypt_file(tmp_kv_file, output_kv_file, encrypt_key)
-    else:
-        shutil.copy(tmp_db_file, output_db_file)
-        shutil.copy(tmp_kv_file, output_kv_file)
+            db_utils.TableData(
+                table=db.ProviderContinuity, df=out.provider_continuity_df
+            ),
+        ]
+        if args.bulk_load:
+            load_util.bulk_load(out_engine, tables)
+        else:
+            db_utils.clear_tables_and_insert_data(session, tables)
+
+        # Update last ingest time and modified times for source data files
+        db_utils.write_meta(session, db.Meta)
+        session.commit()
+
+        # Write to the output key/value file as JSON
+        with open(tmp_kv_file, "w") as f:
+            json.dump(out.kv, f, indent=2)
+
+    # Store rows per table and the stages so far in the meta table
+    profiler.count_rows(out_engine)
+    profiler.write_meta(out_engine)
+
+    # With --skip-unchanged, compare a hash of the content with the manifest of the last published version, and
+    # skip encrypting and uploading if they are the same
+    upload = encrypt_key and s3_url and s3_auth
+    s3_args = (s3_url, s3_auth) if upload else ()
+    content_hash, unchanged = None, False
+    if args.skip_unchanged:
+        with profiler.stage("hash"):
+            content_hash = publish_util.content_hash(tmp_db_file, [tmp_kv_file])
+            unchanged = publish_util.is_published(
+                content_hash, output_db_file, *s3_args
+            )
+
+    # Finally encrypt output files, or just copy if no encryption key is provided. With --pipelined-publish,
+    # files are uploaded to S3 as they are encrypted.
+    with profiler.stage("publish" if args.pipelined_publish else "encrypt"):
+        if unchanged:
+            logging.info(
+                "Content is unchanged since the last publish, skipping encrypt and upload"
+            )
+        elif encrypt_key and args.pipelined_publish:
+            publish_util.publish(
+                [(tmp_db_file, output_db_file), (tmp_kv_file, output_kv_file)],
+                encrypt_key,
+                s3_url,
+                s3_auth,
+            )
+        elif encrypt_key and encrypt_key.lower() != "none":
+            encrypt_file(tmp_db_file, output_db_file, encrypt_key)
+            encrypt_file(tmp_kv_file, output_kv_file, encrypt_key)
+        else:
+            shutil.copy(tmp_db_file, output_db_file)
+            shutil.copy(tmp_kv_file, output_kv_file)
 
     # Clean up tmp files
     os.remove(tmp_db_file)
@@ -379,10 +481,17 @@ def main():
     out_engine.dispose()
 
     # Upload to S3. Only upload encrypted content.
-    if encrypt_key and s3_url and s3_auth:
-        upload_file_to_s3(s3_url, s3_auth, output_db_file)
-        upload_file_to_s3(s3_url, s3_auth, output_kv_file)
+    if upload and not unchanged and not args.pipelined_publish:
+        with profiler.stage("upload"):
+            upload_file_to_s3(s3_url, s3_auth, output_db_file)
+            upload_file_to_s3(s3_url, s3_auth, output_kv_file)
+
+    # Record the published content, for the next run with --skip-unchanged
+    if content_hash and not unchanged:
+        publish_util.write_manifest(content_hash, output_db_file, *s3_args)
 
+    profiler.add_files(output_db_file, output_kv_file)
+    profiler.write_report(args.report)
     logging.info("Done")
 
 
@@ -0,0 +1,183 @@
+"""
+Provider continuity: how many of each provider's encounters in the last 24 months were with patients paneled
+to them. Used both by the dashboard and by the ingest, which stores the table for each clinic in the datamart,
+so this module must not depend on streamlit.
+"""
+
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta
+
+PEDS_LOCATIONS = ["Palouse Pediatrics Pullman", "Palouse Pediatrics Moscow"]
+PFM_LOCATIONS = [
+    "Pullman Family Medicine",
+    "Pullman Family Medicine (Palouse Health Center)",
+]
+
+# Pediatrics providers left out of the continuity table
+EXCLUDED_PEDS_PROVIDERS = ["MANDERVILLE, TRACY"]
+
+
+def filter_by_clinic(
+    patients_df: pd.DataFrame, encounters_df: pd.DataFrame, clinic: str
+):
+    """
+    Return (patients_df, encounters_df, paneled_patients_df, unpaneled_patients_df) for a clinic selected in the
+    dashboard, including "All Clinics" and "Unassigned". For a single clinic, patients and encounters are limited
+    to those seen at the clinic, and unpaneled patients are those seen at the clinic but not paneled to it.
+    """
+    if clinic == "All Clinics":
+        paneled_patients_df = patients_df[~patients_df["panel_location"].isna()]
+        # Unpaneled patients with any encounter
+        unpaneled_patients_df = patients_df[
+            patients_df["panel_location"].isna()
+            & patients_df["prw_id"].isin(encounters_df["prw_id"])
+        ]
+    elif clinic == "Unassigned":
+        paneled_patients_df = patients_df[patients_df["panel_location"].isna()]
+        unpaneled_patients_df = pd.DataFrame(columns=patients_df.columns)
+    else:
+        # Filter encounters for this clinic
+        if clinic == "Palouse Pediatrics":
+            encounters_df = encounters_df[
+                encounters_df["location"].isin(PEDS_LOCATIONS)
+            ]
+        elif clinic == "Pullman Family Medicine":
+            encounters_df = encounters_df[encounters_df["location"].isin(PFM_LOCATIONS)]
+        else:
+            encounters_df = encounters_df[encounters_df["location"] == clinic]
+
+        patients_df = patients_df[patients_df["prw_id"].isin(encounters_df["prw_id"])]
+
+        # Patients paneled to this clinic
+        paneled_patients_df = patients_df[patients_df["panel_location"] == clinic]
+
+        # Patients seen in this clinic but paneled elsewhere or not paneled
+        unpaneled_patients_df = patients_df[
+            (
+                (patients_df["panel_location"] != clinic)
+                | patients_df["panel_location"].isna()
+            )
+            & patients_df["prw_id"].isin(encounters_df["prw_id"])
+        ]
+
+    return patients_df, encounters_df, paneled_patients_df, unpaneled_patients_df
+
+
+def last_24_months(encounters_df: pd.DataFrame, current_date: datetime) -> pd.DataFrame:
+    """Return encounters in the 730 days before current_date"""
+    return encounters_df[
+        encounters_df["encounter_date"] >= (current_date - timedelta(days=730))
+    ]
+
+
+def encounters_with_patient_info(
+    encounters_df: pd.DataFrame, patients_df: pd.DataFrame
+) -> pd.DataFrame:
+    """
+    Return encounters joined with patient info, with a paneled column that is True if the encounter was with the
+    patient's paneled provider. For encounters at Palouse Pediatrics Pullman or Moscow, the patient only needs to
+    be paneled to Palouse Pediatrics.
+    """
+    df = encounters_df.merge(patients_df, on="prw_id", suffixes=("", "_patient"))
+    df["paneled"] = (df["panel_provider"] == df["service_provider"]) | (
+        (df["panel_location"] == "Palouse Pediatrics")
+        & df["location"].isin(PEDS_LOCATIONS)
+    )
+    return df
+
+
+def continuity_providers(
+    clinic: str,
+    provider: str,
+    encounters_df: pd.DataFrame,
+    patients_df: pd.DataFrame,
+    paneled_patients_df: pd.DataFrame,
+) -> list:
+    """
+    Return the providers to list in the continuity table for the selected clinic and provider, sorted and
+    without unknown providers. The arguments are the outputs of filter_by_clinic(), further filtered by provider.
+    """
+    # Get pediatric providers
+    peds_providers = (
+        encounters_df[encounters_df["location"].isin(PEDS_LOCATIONS)][
+            "service_provider"
+        ]
+        .dropna()
+        .unique()
+    )
+    peds_providers = [p for p in peds_providers if p not in EXCLUDED_PEDS_PROVIDERS]
+
+    if clinic == "Palouse Pediatrics":
+        providers = peds_providers
+    elif clinic == "All Clinics" or clinic == "Unassigned":
+        providers = patients_df["panel_provider"].dropna().unique()
+        providers = np.append(providers, peds_providers)
+    elif provider == "All Providers":
+        providers = paneled_patients_df["panel_provider"].dropna().unique()
+        providers = np.append(providers, peds_providers)
+    else:
+        providers = [provider]
+
+    # Remove unknown providers
+    return [p for p in sorted(providers) if p != "" and not p.startswith("*")]
+
+
+def provider_continuity(
+    encounters_with_patient_info_df: pd.DataFrame, providers: list
+) -> pd.DataFrame:
+    """
+    Return the continuity table for providers from the output of encounters_with_patient_info(), counting all
+    providers' paneled and total encounters in one groupby. Providers with no encounters are left out.
+    """
+    counts = (
+        encounters_with_patient_info_df.groupby("service_provider")["paneled"]
+        .agg(["sum", "size"])
+        .reindex(providers)
+        .dropna()
+        .astype(int)
+        .rename_axis("provider")
+        .reset_index()
+    )
+    return pd.DataFrame(
+        {
+            "provider": counts["provider"],
+            "pct_paneled_encounters_last_24_months": (
+                counts["sum"] / counts["size"] * 100
+            ).round(1),
+            "paneled_encounters_last_24_months": counts["sum"],
+            "encounters_last_24_months": counts["size"],
+        }
+    )
+
+
+def provider_continuity_by_clinic(
+    patients_df: pd.DataFrame,
+    encounters_df: pd.DataFrame,
+    clinics: list,
+    current_date: datetime,
+) -> pd.DataFrame:
+    """
+    Return the continuity table with all providers for each of clinics, as shown in the dashboard when no
+    provider is selected, with a clinic column
+    """
+    tables = []
+    for clinic in clinics:
+        clinic_patients_df, clinic_encounters_df, paneled_patients_df, _ = (
+            filter_by_clinic(patients_df, encounters_df, clinic)
+        )
+        providers = continuity_providers(
+            clinic,
+            "All Providers",
+            clinic_encounters_df,
+            clinic_patients_df,
+            paneled_patients_df,
+        )
+        df = provider_continuity(
+            encounters_with_patient_info(
+                last_24_months(clinic_encounters_df, current_date), clinic_patients_df
+            ),
+            providers,
+        )
+        tables.append(df.assign(clinic=clinic))
+    return pd.concat(tables, ignore_index=True)
@@ -32,6 +32,10 @@ class Patient(DatamartModel, table=True):
     panel_location: str | None = None
     panel_provider: str | None = None
     panel_assignment_rule: str | None = None
+    first_encounter_date: date | None = None
+    encounter_count: int | None = None
+    years_as_patient: float | None = None
+    avg_encounters_per_year: float | None = None
 
 
 class Encounter(DatamartModel, table=True):
@@ -62,3 +66,14 @@ class NewPatients(DatamartModel, table=True):
     clinic: str
     new_count: int
     total_count: int
+
+
+class ProviderContinuity(DatamartModel, table=True):
+    __tablename__ = "provider_continuity"
+
+    id: int | None = Field(default=None, primary_key=True)
+    clinic: str
+    provider: str
+    pct_paneled_encounters_last_24_months: float
+    paneled_encounters_last_24_months: int
+    encounters_last_24_months: int
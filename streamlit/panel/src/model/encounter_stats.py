@@ -0,0 +1,44 @@
+"""
+Per-patient encounter stats. Computed by the ingest and stored on the patients table, or by the dashboard for a
+datamart written before the stats were stored, so this module must not depend on streamlit.
+"""
+
+import numpy as np
+import pandas as pd
+from datetime import datetime
+
+
+def add_encounter_stats(
+    patients_df: pd.DataFrame, encounters_df: pd.DataFrame, current_date: datetime
+) -> pd.DataFrame:
+    """
+    Add each patient's first encounter date, encounter count, years since the first encounter as of
+    current_date, and average encounters per year. Patients with no encounters have an average of 0.
+    """
+    stats = encounters_df.groupby("prw_id")["encounter_date"].agg(
+        first_encounter_date="min", encounter_count="size"
+    )
+    patients_df = patients_df.join(stats, on="prw_id")
+    patients_df["encounter_count"] = patients_df["encounter_count"].astype("Int64")
+
+    # Calculate years since first encounter (or set to NaN if no encounters)
+    patients_df["years_as_patient"] = (
+        current_date - patients_df["first_encounter_date"]
+    ).dt.days / 365.25
+
+    # For patients with less than 1 year history, use actual encounter count,
+    # otherwise divide by years_as_patient. Round to 1 decimal place.
+    encounter_count = patients_df["encounter_count"].astype(float)
+    patients_df["avg_encounters_per_year"] = (
+        pd.Series(
+            np.where(
+                patients_df["years_as_patient"] >= 1,
+                encounter_count / patients_df["years_as_patient"],
+                encounter_count,
+            ),
+            index=patients_df.index,
+        )
+        .fillna(0)
+        .round(1)
+    )
+    return patients_df
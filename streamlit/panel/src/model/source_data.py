@@ -4,11 +4,13 @@ Source data as in-memory copy of all DB tables as dataframes
 
 import logging
 import pandas as pd
+import sqlalchemy
 import streamlit as st
 from dataclasses import dataclass
 from datetime import datetime, timedelta
 from sqlmodel import Session, text
 from common import source_data_util
+from . import encounter_stats
 
 # Remote URL in Cloudflare R2
 R2_ACCT_ID = st.secrets.get("PRH_PANEL_R2_ACCT_ID")
@@ -31,6 +33,7 @@ class SourceData:
     patients_df: pd.DataFrame = None
     encounters_df: pd.DataFrame = None
     new_visits_by_month: pd.DataFrame = None
+    provider_continuity_df: pd.DataFrame = None
 
     modified: datetime = None
 
@@ -82,16 +85,32 @@ def from_db(db_engine) -> SourceData:
     modified = result.iloc[0, 0] if result.size > 0 else None
 
     # Read dashboard data into dataframes
-    patients_df = pd.read_sql_table("patients", db_engine)
+    patients_df = pd.read_sql_query("select * from patients", db_engine)
     encounters_df = pd.read_sql_query(
         "select * from encounters", db_engine, index_col="id"
     )
     encounters_df["encounter_date"] = pd.to_datetime(encounters_df["encounter_date"])
+    if "avg_encounters_per_year" in patients_df.columns:
+        patients_df["first_encounter_date"] = pd.to_datetime(
+            patients_df["first_encounter_date"]
+        )
+    else:
+        # Datamart written before the ingest stored per-patient encounter stats
+        patients_df = encounter_stats.add_encounter_stats(
+            patients_df, encounters_df, datetime.now()
+        )
     new_visits_by_month = pd.read_sql_table("new_patients", db_engine)
+    # Datamarts written before the continuity table was precomputed do not have it. It is then calculated
+    # by app_data.process() instead.
+    if sqlalchemy.inspect(db_engine).has_table("provider_continuity"):
+        provider_continuity_df = pd.read_sql_table("provider_continuity", db_engine)
+    else:
+        provider_continuity_df = None
 
     return SourceData(
         modified=modified,
         patients_df=patients_df,
         encounters_df=encounters_df,
         new_visits_by_month=new_visits_by_month,
+        provider_continuity_df=provider_continuity_df,
     )
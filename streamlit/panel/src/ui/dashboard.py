@@ -3,7 +3,7 @@ import streamlit as st
 import pandas as pd
 import plotly.express as px
 from common import st_util
-from ..model import source_data, app_data
+from ..model import source_data, app_data, settings
 from . import ui
 
 
@@ -43,6 +43,15 @@ def show(src_data: source_data.SourceData):
         ui.st_provider_continuity_table(data)
 
     st.subheader("Patients")
+    _show_patients(user_settings, data)
+
+
+@st.fragment
+def _show_patients(user_settings: settings.Settings, data: app_data.AppData):
+    """
+    Patient list and the encounters of the selected patient. This is a fragment, so selecting a patient or
+    the patient list type only reruns this section.
+    """
     with st_util.st_card_container("patient_list_container", padding_css="10px 16px"):
         # Add select box to choose patients paneled vs unpaneled by seen in clinic
         if data.clinic != "Unassigned" and data.clinic != "All Clinics":
@@ -71,11 +71,11 @@ def st_demographics(data: app_data.AppData):
     with col1:
         age_bins = [0, 1, 18, 65, float("inf")]
         age_labels = ["<1y", "1-18y", "18-65y", ">65y"]
-        patients_df["age_group"] = pd.cut(
+        age_groups = pd.cut(
             patients_df["age"], bins=age_bins, labels=age_labels, right=False
-        )
+        ).rename("age_group")
 
-        age_group_counts = patients_df["age_group"].value_counts().sort_index()
+        age_group_counts = age_groups.value_counts().sort_index()
 
         fig = px.pie(
             age_group_counts,
@@ -199,8 +199,9 @@ def st_demographics(data: app_data.AppData):
 def st_new_patients(data: app_data.AppData):
     df = data.new_visits_by_month
 
-    # Convert year_month to datetime for proper sorting
-    df["date"] = pd.to_datetime(df["year_month"])
+    # Convert year_month to datetime for proper sorting. data is shared between sessions, so add the column
+    # to a copy.
+    df = df.assign(date=pd.to_datetime(df["year_month"]))
 
     # Sort by date
     df = df.sort_values("date")
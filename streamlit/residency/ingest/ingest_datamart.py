@@ -15,6 +15,7 @@ from prw_common import db_utils
 from prw_common import cli_utils
 from prw_common.encrypt import encrypt_file
 from prw_common.remote_utils import upload_file_to_s3
+from common import extract_util, profile_util, publish_util
 
 
 # -------------------------------------------------------
@@ -64,16 +65,39 @@ ALL_RESIDENTS = (
 # -------------------------------------------------------
 # Extract
 # -------------------------------------------------------
-def read_source_tables(prw_engine) -> SrcData:
+def read_source_tables(
+    prw_engine,
+    workers: int = extract_util.DEFAULT_WORKERS,
+    max_memory_mb: float = None,
+) -> SrcData:
     """
-    Read source tables from the warehouse DB
+    Read source tables from the warehouse DB, reading up to workers tables at the same time.
+    Encounters and notes are filtered to residents as they are read. If max_memory_mb is given, they are read
+    and filtered in chunks of about that size, so the whole table is never in memory.
     """
     logging.info("Reading source tables")
 
-    patients = pd.read_sql_table("prw_patients", prw_engine)
-    encounters = pd.read_sql_table("prw_encounters_outpt", prw_engine)
-    notes_inpt = pd.read_sql_table("prw_notes_inpt", prw_engine)
-    notes_ed = pd.read_sql_table("prw_notes_ed", prw_engine)
+    def filtered_reader(table_name, filter_fn):
+        if max_memory_mb:
+            return extract_util.chunked_reader(table_name, max_memory_mb, filter_fn)
+        return lambda conn: filter_fn(extract_util.read_table(conn, table_name))
+
+    tables = extract_util.read_tables(
+        prw_engine,
+        {
+            "patients": extract_util.table_reader("prw_patients"),
+            "encounters": filtered_reader(
+                "prw_encounters_outpt", filter_resident_encounters
+            ),
+            "notes_inpt": filtered_reader("prw_notes_inpt", filter_notes),
+            "notes_ed": filtered_reader("prw_notes_ed", filter_notes),
+        },
+        workers,
+    )
+    patients = tables["patients"]
+    encounters = tables["encounters"]
+    notes_inpt = tables["notes_inpt"]
+    notes_ed = tables["notes_ed"]
 
     # Convert columns to datetime
     encounters["encounter_date"] = pd.to_datetime(encounters["encounter_date"])
@@ -95,22 +119,10 @@ def transform(src: SrcData) -> OutData:
     """
     Transform source data into datamart tables
     """
-    # Filter to only include completed encounters and relevant notes for residents
-    encounters = src.encounters[src.encounters["service_provider"].isin(ALL_RESIDENTS)]
-    encounters = encounters[encounters["appt_status"] == "Completed"]
-
-    # Rename columns to match datamart table names
-    notes_columns = {
-        "author_name": "signing_author",
-        "first_author_name": "initial_author",
-        "cosign_author_name": "cosign_author",
-    }
-    notes_inpt = src.notes_inpt.rename(columns=notes_columns)
-    notes_ed = src.notes_ed.rename(columns=notes_columns)
-
-    # Filter notes to just residents
-    notes_inpt = filter_resident_notes(notes_inpt, ALL_RESIDENTS)
-    notes_ed = filter_resident_notes(notes_ed, ALL_RESIDENTS)
+    # Encounters and notes were already filtered to residents when read
+    encounters = src.encounters
+    notes_inpt = src.notes_inpt
+    notes_ed = src.notes_ed
 
     # Assign a resident to each note
     for resident in ALL_RESIDENTS:
@@ -161,6 +173,28 @@ def transform(src: SrcData) -> OutData:
     )
 
 
+def filter_resident_encounters(encounters):
+    """
+    Filter to only include completed encounters for residents
+    """
+    encounters = encounters[encounters["service_provider"].isin(ALL_RESIDENTS)]
+    return encounters[encounters["appt_status"] == "Completed"]
+
+
+def filter_notes(notes):
+    """
+    Rename columns to match datamart table names, and filter notes to just residents
+    """
+    notes = notes.rename(
+        columns={
+            "author_name": "signing_author",
+            "first_author_name": "initial_author",
+            "cosign_author_name": "cosign_author",
+        }
+    )
+    return filter_resident_notes(notes, ALL_RESIDENTS)
+
+
 def filter_resident_notes(notes, residents):
     """
     Find all relevant provider notes where the resident is the author or initial author
@@ -419,6 +453,33 @@ def parse_arguments():
         "--key",
         help="Encrypt with given key. Must be specified to upload to S3. Defaults to no encryption if not specified.",
     )
+    parser.add_argument(
+        "--max-memory",
+        type=float,
+        metavar="MB",
+        help="Read the encounters and notes tables in chunks of about this many MB, instead of all at once",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=extract_util.DEFAULT_WORKERS,
+        help="Number of source tables to read from the warehouse at the same time",
+    )
+    parser.add_argument(
+        "--pipelined-publish",
+        action="store_true",
+        help="Encrypt output files in chunks and upload them to S3 as they are encrypted, all files in parallel. "
+        + "Requires dashboards that read chunk encrypted files (common.publish_util.decrypt()).",
+    )
+    parser.add_argument(
+        "--skip-unchanged",
+        action="store_true",
+        help="Skip encrypting and uploading if the datamart content is the same as the last published version",
+    )
+    parser.add_argument(
+        "--report",
+        help="Write a JSON run report with the time, CPU and memory used by each stage to this path",
+    )
     return parser.parse_args()
 
 
@@ -435,10 +496,10 @@ def main():
     s3_url = args.s3url
     s3_auth = args.s3auth
     tmp_db_file = "datamart.sqlite3"
+    profiler = profile_util.StageProfiler("residency")
 
     logging.info(
-        f"Input: {db_utils.mask_conn_pw(prw_db_url)}, output: {output_db_file}, encrypt: {encrypt_key is not None}, upload: {s3_url}",
-        flush=True,
+        f"Input: {db_utils.mask_conn_pw(prw_db_url)}, output: {output_db_file}, encrypt: {encrypt_key is not None}, upload: {s3_url}"
     )
 
     # Create the sqlite output database and create the tables as defined in ../src/model/db.py
@@ -447,41 +508,70 @@ def main():
 
     # Read from PRW warehouse (MSSQL in prod, sqlite in dev)
     prw_engine = db_utils.get_db_connection(prw_db_url)
-    src = read_source_tables(prw_engine)
+    with profiler.stage("extract"):
+        src = read_source_tables(prw_engine, args.workers, args.max_memory)
     if src is None:
         error_exit("ERROR: failed to read source data (see above)")
 
     # Transform data
-    out = transform(src)
+    with profiler.stage("transform"):
+        out = transform(src)
 
-    # Calculate key/value data
-    kv_data = {
-        "residents": RESIDENTS_BY_YEAR,
-        "stats": calc_stats(out, ALL_RESIDENTS),
-    }
+        # Calculate key/value data
+        kv_data = {
+            "residents": RESIDENTS_BY_YEAR,
+            "stats": calc_stats(out, ALL_RESIDENTS),
+        }
 
     # Write tables to datamart
-    session = Session(out_engine)
-    db_utils.clear_tables_and_insert_data(
-        session,
-        [
-            db_utils.TableData(table=db.Encounters, df=out.encounters),
-            db_utils.TableData(
-                table=db.Notes, df=pd.concat([out.notes_inpt, out.notes_ed])
-            ),
-        ],
-    )
-    db_utils.write_kv_table(kv_data, session, db.KvTable)
-
-    # Update last ingest time and modified times for source data files
-    db_utils.write_meta(session, db.Meta)
-    session.commit()
-
-    # Finally encrypt output files, or just copy if no encryption key is provided
-    if encrypt_key and encrypt_key.lower() != "none":
-        encrypt_file(tmp_db_file, output_db_file, encrypt_key)
-    else:
-        shutil.copy(tmp_db_file, output_db_file)
+    with profiler.stage("load"):
+        session = Session(out_engine)
+        db_utils.clear_tables_and_insert_data(
+            session,
+            [
+                db_utils.TableData(table=db.Encounters, df=out.encounters),
+                db_utils.TableData(
+                    table=db.Notes, df=pd.concat([out.notes_inpt, out.notes_ed])
+                ),
+            ],
+        )
+        db_utils.write_kv_table(kv_data, session, db.KvTable)
+
+        # Update last ingest time and modified times for source data files
+        db_utils.write_meta(session, db.Meta)
+        session.commit()
+
+    # Store rows per table and the stages so far in the meta table
+    profiler.count_rows(out_engine)
+    profiler.write_meta(out_engine)
+
+    # With --skip-unchanged, compare a hash of the content with the manifest of the last published version, and
+    # skip encrypting and uploading if they are the same
+    upload = encrypt_key and s3_url and s3_auth
+    s3_args = (s3_url, s3_auth) if upload else ()
+    content_hash, unchanged = None, False
+    if args.skip_unchanged:
+        with profiler.stage("hash"):
+            content_hash = publish_util.content_hash(tmp_db_file)
+            unchanged = publish_util.is_published(
+                content_hash, output_db_file, *s3_args
+            )
+
+    # Finally encrypt output files, or just copy if no encryption key is provided. With --pipelined-publish,
+    # files are uploaded to S3 as they are encrypted.
+    with profiler.stage("publish" if args.pipelined_publish else "encrypt"):
+        if unchanged:
+            logging.info(
+                "Content is unchanged since the last publish, skipping encrypt and upload"
+            )
+        elif encrypt_key and args.pipelined_publish:
+            publish_util.publish(
+                [(tmp_db_file, output_db_file)], encrypt_key, s3_url, s3_auth
+            )
+        elif encrypt_key and encrypt_key.lower() != "none":
+            encrypt_file(tmp_db_file, output_db_file, encrypt_key)
+        else:
+            shutil.copy(tmp_db_file, output_db_file)
 
     # Cleanup
     os.remove(tmp_db_file)
@@ -489,9 +579,16 @@ def main():
     out_engine.dispose()
 
     # Upload to S3. Only upload encrypted content.
-    if encrypt_key and s3_url and s3_auth:
-        upload_file_to_s3(s3_url, s3_auth, output_db_file)
+    if upload and not unchanged and not args.pipelined_publish:
+        with profiler.stage("upload"):
+            upload_file_to_s3(s3_url, s3_auth, output_db_file)
+
+    # Record the published content, for the next run with --skip-unchanged
+    if content_hash and not unchanged:
+        publish_util.write_manifest(content_hash, output_db_file, *s3_args)
 
+    profiler.add_files(output_db_file)
+    profiler.write_report(args.report)
     logging.info("Done")
 
 
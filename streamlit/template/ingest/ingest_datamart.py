@@ -14,6 +14,7 @@ from prw_common import db_utils
 from prw_common import cli_utils
 from prw_common.encrypt import encrypt_file
 from prw_common.remote_utils import upload_file_to_s3
+from common import profile_util, publish_util
 
 
 # -------------------------------------------------------
@@ -71,6 +72,21 @@ def parse_arguments():
         "--key",
         help="Encrypt with given key. Must be specified to upload to S3. Defaults to no encryption if not specified.",
     )
+    parser.add_argument(
+        "--pipelined-publish",
+        action="store_true",
+        help="Encrypt output files in chunks and upload them to S3 as they are encrypted, all files in parallel. "
+        + "Requires dashboards that read chunk encrypted files (common.publish_util.decrypt()).",
+    )
+    parser.add_argument(
+        "--skip-unchanged",
+        action="store_true",
+        help="Skip encrypting and uploading if the datamart content is the same as the last published version",
+    )
+    parser.add_argument(
+        "--report",
+        help="Write a JSON run report with the time, CPU and memory used by each stage to this path",
+    )
     return parser.parse_args()
 
 
@@ -87,10 +103,10 @@ def main():
     s3_url = args.s3url
     s3_auth = args.s3auth
     tmp_db_file = "datamart.sqlite3"
+    profiler = profile_util.StageProfiler("template")
 
     logging.info(
-        f"Input: {db_utils.mask_conn_pw(prw_db_url)}, output: {output_db_file}, encrypt: {encrypt_key is not None}, upload: {s3_url}",
-        flush=True,
+        f"Input: {db_utils.mask_conn_pw(prw_db_url)}, output: {output_db_file}, encrypt: {encrypt_key is not None}, upload: {s3_url}"
     )
 
     # Create the sqlite output database and create the tables as defined in ../src/model/db.py
@@ -99,32 +115,61 @@ def main():
 
     # Read from PRW warehouse (MSSQL in prod, sqlite in dev)
     prw_engine = db_utils.get_db_connection(prw_db_url)
-    src = read_source_tables(prw_engine)
+    with profiler.stage("extract"):
+        src = read_source_tables(prw_engine)
     if src is None:
         error_exit("ERROR: failed to read source data (see above)")
 
     # Transform data
-    out = transform(src)
+    with profiler.stage("transform"):
+        out = transform(src)
 
-    # Calculate key/value data
-    kv_data = {}
+        # Calculate key/value data
+        kv_data = {}
 
     # Write tables to datamart
-    session = Session(out_engine)
-    db_utils.clear_tables_and_insert_data(
-        session, [db_utils.TableData(table=db.DataTable, df=out.data_df)]
-    )
-    db_utils.write_kv_table(kv_data, session, db.KvTable)
-
-    # Update last ingest time and modified times for source data files
-    db_utils.write_meta(session, db.Meta)
-    session.commit()
-
-    # Finally encrypt output files, or just copy if no encryption key is provided
-    if encrypt_key and encrypt_key.lower() != "none":
-        encrypt_file(tmp_db_file, output_db_file, encrypt_key)
-    else:
-        shutil.copy(tmp_db_file, output_db_file)
+    with profiler.stage("load"):
+        session = Session(out_engine)
+        db_utils.clear_tables_and_insert_data(
+            session, [db_utils.TableData(table=db.DataTable, df=out.data_df)]
+        )
+        db_utils.write_kv_table(kv_data, session, db.KvTable)
+
+        # Update last ingest time and modified times for source data files
+        db_utils.write_meta(session, db.Meta)
+        session.commit()
+
+    # Store rows per table and the stages so far in the meta table
+    profiler.count_rows(out_engine)
+    profiler.write_meta(out_engine)
+
+    # With --skip-unchanged, compare a hash of the content with the manifest of the last published version, and
+    # skip encrypting and uploading if they are the same
+    upload = encrypt_key and s3_url and s3_auth
+    s3_args = (s3_url, s3_auth) if upload else ()
+    content_hash, unchanged = None, False
+    if args.skip_unchanged:
+        with profiler.stage("hash"):
+            content_hash = publish_util.content_hash(tmp_db_file)
+            unchanged = publish_util.is_published(
+                content_hash, output_db_file, *s3_args
+            )
+
+    # Finally encrypt output files, or just copy if no encryption key is provided. With --pipelined-publish,
+    # files are uploaded to S3 as they are encrypted.
+    with profiler.stage("publish" if args.pipelined_publish else "encrypt"):
+        if unchanged:
+            logging.info(
+                "Content is unchanged since the last publish, skipping encrypt and upload"
+            )
+        elif encrypt_key and args.pipelined_publish:
+            publish_util.publish(
+                [(tmp_db_file, output_db_file)], encrypt_key, s3_url, s3_auth
+            )
+        elif encrypt_key and encrypt_key.lower() != "none":
+            encrypt_file(tmp_db_file, output_db_file, encrypt_key)
+        else:
+            shutil.copy(tmp_db_file, output_db_file)
 
     # Cleanup
     os.remove(tmp_db_file)
@@ -132,9 +177,16 @@ def main():
     out_engine.dispose()
 
     # Upload to S3. Only upload encrypted content.
-    if encrypt_key and s3_url and s3_auth:
-        upload_file_to_s3(s3_url, s3_auth, output_db_file)
+    if upload and not unchanged and not args.pipelined_publish:
+        with profiler.stage("upload"):
+            upload_file_to_s3(s3_url, s3_auth, output_db_file)
+
+    # Record the published content, for the next run with --skip-unchanged
+    if content_hash and not unchanged:
+        publish_util.write_manifest(content_hash, output_db_file, *s3_args)
 
+    profiler.add_files(output_db_file)
+    profiler.write_report(args.report)
     logging.info("Done")
 
 